@@ -16,6 +16,9 @@ public class ServerClient : MonoBehaviour
 
     private CancellationTokenSource cts;
 
+    // World the server picked for the last /gen, sent back with every /inpaint
+    private string world = "";
+
     void Awake()
     {
         cts = new CancellationTokenSource();
@@ -40,6 +43,7 @@ public class ServerClient : MonoBehaviour
 
             if (request.result == UnityWebRequest.Result.Success)
             {
+                world = request.GetResponseHeader("X-World") ?? "";
                 return DownloadHandlerTexture.GetContent(request);
             }
             else
@@ -106,6 +110,7 @@ public class ServerClient : MonoBehaviour
         form.AddField("target_x", target_x.ToString());
         form.AddField("target_y", target_y.ToString());
         form.AddField("extend_direction", direction);
+        form.AddField("world", world);
 
         var request = UnityWebRequest.Post(baseUrl + "/inpaint", form);
         request.downloadHandler = new DownloadHandlerTexture(true);
@@ -1,8 +1,13 @@
+import asyncio
+import httpx
 import openai
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 from dotenv import load_dotenv
 import os
 
+from chat_history import ChatHistory
+from prompt_cache import PromptCache, make_cache_key
+
 # Load environment variables from .env file
 load_dotenv()
 
@@ -25,16 +30,35 @@ class GPTAPIHelper:
             "Do not include any information on whether the scene is extending. "
             "Just give me the scene that should be seen there. "
         ),
+        api_base: str = None,
+        cache: Optional[PromptCache] = None,
+        reuse_cached: bool = False,
+        max_history_tokens: int = 1500,
+        summarize_history: bool = False,
     ):
         """
         :param api_key: OpenAI API key for authentication.
         :param model: OpenAI model to use (e.g., "gpt-4", "gpt-3.5-turbo").
         :param system_instruction: Instruction text prepended to every interaction.
+        :param api_base: Base URL of an OpenAI compatible endpoint, e.g. a local stand-in LLM.
+        :param cache: Response cache. Every response is recorded in it when given.
+        :param reuse_cached: Answer from the cache instead of the API when the same prompt (system instruction and
+            user message, whitespace-normalized, same sampling parameters) was answered before, whatever the history.
+        :param max_history_tokens: Token budget of the chat history sent with every request.
+        :param summarize_history: Fold turns that fall out of the history window into a short summary (one extra API call per compaction).
         """
         openai.api_key = api_key or os.getenv("OPENAI_KEY")
+        api_base = api_base or os.getenv("OPENAI_API_BASE")
+        if api_base:
+            openai.api_base = api_base
         self.model = model
         self.system_instruction = system_instruction
-        self.chat_history: List[Dict[str, str]] = []
+        self.history = ChatHistory(
+            max_tokens=max_history_tokens,
+            summarizer=self.summarize if summarize_history else None,
+        )
+        self.cache = cache
+        self.reuse_cached = reuse_cached
 
     def chat(
         self,
@@ -42,13 +66,19 @@ class GPTAPIHelper:
         max_tokens: int = 150,
         temperature: float = 0.8,
         top_p: float = 0.9,
+        reuse_cached: bool = None,
     ) -> str:
         """
         Send a message to the GPT model and receive a response.
+
+        :param reuse_cached: Overrides the helper's reuse_cached setting for this call.
         """
-        self.chat_history.append({"role": "user", "content": user_message})
-        messages = [{"role": "system", "content": self.system_instruction}]
-        messages.extend(self.chat_history)
+        messages, cache_key, assistant_message = self._begin_turn(
+            user_message, max_tokens, temperature, top_p, reuse_cached
+        )
+        if assistant_message is not None:
+            self._end_turn(user_message, assistant_message)
+            return assistant_message
 
         try:
             response = openai.ChatCompletion.create(
@@ -59,13 +89,10 @@ class GPTAPIHelper:
                 top_p=top_p,
             )
             # for memory efficiency pop the recent user message
-            # self.chat_history.pop()
+            # self.history.pop()
             assistant_message = response["choices"][0]["message"]["content"].strip()
-            self.chat_history.append(
-                {"role": "assistant", "content": assistant_message}
-            )
-            print("\n--- Assistant response ---")
-            print(assistant_message)
+            self._record_response(cache_key, assistant_message)
+            self._end_turn(user_message, assistant_message)
             return assistant_message
 
         except openai.error.OpenAIError as e:
@@ -73,6 +100,169 @@ class GPTAPIHelper:
             raise e
             # return "An error occurred while processing your request."
 
+    def _begin_turn(
+        self,
+        user_message: str,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        reuse_cached: Optional[bool],
+    ) -> Tuple[List[Dict[str, str]], Optional[str], Optional[str]]:
+        """
+        Build the messages for a request and look it up in the cache.
+
+        The user turn only enters the history together with its answer (see _end_turn), so requests
+        in flight at the same time never see each other's unanswered turns.
+
+        :return: (messages, cache key, cached response or None)
+        """
+        if reuse_cached is None:
+            reuse_cached = self.reuse_cached
+
+        messages = [{"role": "system", "content": self.system_instruction}]
+        messages.extend(self.history.messages())
+        messages.append({"role": "user", "content": user_message})
+
+        cache_key = None
+        if self.cache is not None:
+            # Keyed on what determines the answer, not the shared history: it interleaves other tiles'
+            # turns and keeps growing, so a repeated (source prompt, direction) would almost never hit.
+            # The source prompt and the direction are part of the user message.
+            cache_key = make_cache_key(
+                [messages[0], messages[-1]],
+                model=self.model,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                top_p=top_p,
+            )
+            if reuse_cached:
+                assistant_message = self.cache.get(cache_key)
+                if assistant_message is not None:
+                    print("\n--- Assistant response (cached) ---")
+                    print(assistant_message)
+                    return messages, cache_key, assistant_message
+        return messages, cache_key, None
+
+    def _end_turn(self, user_message: str, assistant_message: str):
+        self.history.extend(
+            [
+                {"role": "user", "content": user_message},
+                {"role": "assistant", "content": assistant_message},
+            ]
+        )
+
+    def _record_response(self, cache_key: Optional[str], assistant_message: str):
+        if cache_key is not None:
+            self.cache.put(cache_key, assistant_message)
+        print("\n--- Assistant response ---")
+        print(assistant_message)
+
+    @property
+    def chat_history(self) -> List[Dict[str, str]]:
+        return self.history.messages()
+
+    def summarize(self, previous_summary: str, turns: List[Dict[str, str]]) -> str:
+        """
+        Fold turns that fell out of the history window into a short running summary.
+        """
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        response = openai.ChatCompletion.create(
+            model=self.model,
+            messages=[
+                {
+                    "role": "system",
+                    "content": "Summarize the scenes designed so far in at most three short sentences. "
+                    "Keep place names, biomes and landmarks, drop everything else.",
+                },
+                {
+                    "role": "user",
+                    "content": f"Previous summary: {previous_summary}\n\nNew turns:\n{transcript}",
+                },
+            ],
+            max_tokens=120,
+            temperature=0.2,
+        )
+        return response["choices"][0]["message"]["content"].strip()
+
+
+class AsyncGPTAPIHelper(GPTAPIHelper):
+    def __init__(
+        self,
+        *args,
+        max_connections: int = 16,
+        timeout: float = 60.0,
+        **kwargs,
+    ):
+        """
+        GPTAPIHelper with a non-blocking achat that talks to the chat completions endpoint
+        over a pooled keep-alive HTTP connection instead of the blocking openai client.
+
+        :param max_connections: Size of the connection pool, i.e. the number of concurrent LLM requests.
+        :param timeout: Seconds before a request is abandoned.
+        """
+        super().__init__(*args, **kwargs)
+        self.api_base = (openai.api_base or "https://api.openai.com/v1").rstrip("/")
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self._client: Optional[httpx.AsyncClient] = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                base_url=self.api_base,
+                headers={"Authorization": f"Bearer {openai.api_key}"},
+                limits=httpx.Limits(
+                    max_connections=self.max_connections,
+                    max_keepalive_connections=self.max_connections,
+                ),
+                timeout=self.timeout,
+            )
+        return self._client
+
+    async def achat(
+        self,
+        user_message: str,
+        max_tokens: int = 150,
+        temperature: float = 0.8,
+        top_p: float = 0.9,
+        reuse_cached: bool = None,
+    ) -> str:
+        """
+        Async version of chat, safe to await from the event loop.
+        """
+        messages, cache_key, assistant_message = self._begin_turn(
+            user_message, max_tokens, temperature, top_p, reuse_cached
+        )
+        if assistant_message is None:
+            response = await self.client.post(
+                "/chat/completions",
+                json={
+                    "model": self.model,
+                    "messages": messages,
+                    "max_tokens": max_tokens,
+                    "temperature": temperature,
+                    "top_p": top_p,
+                },
+            )
+            if response.status_code != 200:
+                print(f"Error: {response.status_code} {response.text}")
+                response.raise_for_status()
+            assistant_message = response.json()["choices"][0]["message"]["content"].strip()
+            self._record_response(cache_key, assistant_message)
+
+        if self.history.summarizer is not None:
+            # History compaction may call the (blocking) summarizer, keep it off the event loop
+            await asyncio.to_thread(self._end_turn, user_message, assistant_message)
+        else:
+            self._end_turn(user_message, assistant_message)
+        return assistant_message
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
 
 # # Example usage
 # if __name__ == "__main__":
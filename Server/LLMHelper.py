@@ -2,6 +2,8 @@ import torch
 from transformers import AutoTokenizer, AutoModelForCausalLM
 from typing import List, Dict
 
+from chat_history import ChatHistory
+
 
 class LLMHelper:
     def __init__(
@@ -15,11 +17,13 @@ class LLMHelper:
             "Remember that you should generate a top-view, satellite view image for the pixel game. "
             "Only give me prompt sentence for generating the scene. Add no other instructions or title."
         ),
+        max_history_tokens: int = 1024,
     ):
         """
         :param model_name: The Hugging Face model identifier to load.
         :param device: "cpu", "cuda", or "mps". If None, auto-detect is attempted.
         :param system_instruction: Instruction text prepended to every prompt.
+        :param max_history_tokens: Token budget of the chat history rebuilt into every prompt.
         """
 
         # 1) Auto-detect device if not provided
@@ -44,8 +48,11 @@ class LLMHelper:
         self.model.to(self.device)
         self.model.eval()
 
-        # 3) Keep a chat history if needed
-        self.chat_history: List[Dict[str, str]] = []
+        # 3) Keep a chat history bounded by a token budget
+        self.history = ChatHistory(
+            max_tokens=max_history_tokens,
+            count_tokens=lambda text: len(self.tokenizer.encode(text)),
+        )
         self.system_instruction = system_instruction
 
     def chat(
@@ -68,19 +75,21 @@ class LLMHelper:
         :return: The assistant's extracted response (string).
         """
         # 1) Add the user message to chat history
-        self.chat_history.append({"role": "user", "content": user_message})
+        self.history.append("user", user_message)
 
         # 2) Build the combined prompt
         prompt = f"System: {self.system_instruction}\n"
-        for turn in self.chat_history:
+        for turn in self.history.messages():
             if turn["role"] == "user":
                 prompt += f"User: {turn['content']}\n"
+            elif turn["role"] == "system":
+                prompt += f"System: {turn['content']}\n"
             else:
                 prompt += f"Assistant: {turn['content']}\n"
         # Add a final "Assistant:" to indicate the model should produce the next turn
         prompt += "Assistant:"
 
-        self.chat_history.pop()  # Remove the last "Assistant:" turn (for memory)
+        self.history.pop()  # Remove the last "Assistant:" turn (for memory)
 
         # 3) Tokenize
         # prompt = "Create me a rich and descriptive but concise text prompt for generating a landscape image with AI based on my description: forest."
@@ -111,7 +120,7 @@ class LLMHelper:
         assistant_response = assistant_response.replace('"', "")
 
         # 7) Append the assistant's response to chat history
-        self.chat_history.append({"role": "assistant", "content": assistant_response})
+        self.history.append("assistant", assistant_response)
 
         # Debug prints (optional)
         print("===== FULL GENERATED TEXT =====")
@@ -0,0 +1,96 @@
+"""
+Memory and speed of the world canvas as a world grows, drawing recorded tiles along a spiral:
+
+    python benchmarks/canvas_bench.py --tiles 2000 --report-every 250
+
+Anonymous memory (the process heap) should stay flat, file-backed pages are the page cache's to evict.
+"""
+
+import argparse
+import itertools
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from mock_backend import MockWorld
+from world_canvas import WorldCanvas
+
+
+def spiral():
+    x = y = 0
+    dx, dy = 1, 0
+    leg, walked, turns = 1, 0, 0
+    while True:
+        yield x, y
+        x, y = x + dx, y + dy
+        walked += 1
+        if walked == leg:
+            walked = 0
+            dx, dy = -dy, dx
+            turns += 1
+            if turns % 2 == 0:
+                leg += 1
+
+
+def memory_mib():
+    values = {}
+    with open("/proc/self/status") as f:
+        for line in f:
+            if line.startswith(("RssAnon:", "RssFile:")):
+                name, value = line.split()[:2]
+                values[name[:-1]] = int(value) / 1024
+    return values["RssAnon"], values["RssFile"]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--world", default="city")
+    parser.add_argument("--tiles", type=int, default=2000)
+    parser.add_argument("--report-every", type=int, default=250)
+    args = parser.parse_args()
+
+    world = MockWorld(args.world, root=os.path.join(SERVER_DIR, "mock"))
+    images = [np.asarray(world.image(*key)) for key in sorted(world.tiles)]
+    directory = tempfile.mkdtemp()
+    canvas = WorldCanvas(directory)
+
+    print(
+        f"{'tiles':>6} {'chunks':>7} {'file MiB':>9} {'anon MiB':>9} {'file-backed MiB':>16} "
+        f"{'write ms':>9} {'source ms':>10} {'minimap ms':>11}"
+    )
+    write_time = 0.0
+    positions = list(itertools.islice(spiral(), args.tiles + 1))
+    for count in range(1, args.tiles + 1):
+        x, y = positions[count - 1]
+        start = time.perf_counter()
+        canvas.write_tile(x, y, images[count % len(images)])
+        write_time += time.perf_counter() - start
+        if count % args.report_every:
+            continue
+
+        start = time.perf_counter()
+        # The next tile on the spiral, extended from the ones drawn so far
+        canvas.inpaint_source(*positions[count])
+        source_time = time.perf_counter() - start
+        size = canvas.chunk_size
+        start = time.perf_counter()
+        # 9x9 tiles around the latest one at 1/8 scale
+        canvas.read_region((x - 4) * size, (-y - 4) * size, 10 * size, 10 * size, step=8)
+        minimap_time = time.perf_counter() - start
+        anon, file_backed = memory_mib()
+        stats = canvas.stats()
+        print(
+            f"{count:6d} {stats['chunks']:7d} {stats['file_bytes'] / 2**20:9.0f} {anon:9.0f} "
+            f"{file_backed:16.0f} {1000 * write_time / args.report_every:9.2f} "
+            f"{1000 * source_time:10.2f} {1000 * minimap_time:11.2f}"
+        )
+        write_time = 0.0
+    canvas.close()
+    shutil.rmtree(directory)
@@ -0,0 +1,61 @@
+"""
+Encode time, decode time and size of every output format on recorded 768x768 tiles:
+
+    python benchmarks/encoding_bench.py --world city --tiles 8 --repeat 3
+"""
+
+import argparse
+import os
+import sys
+import time
+from io import BytesIO
+
+from PIL import Image
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from encoding import FORMATS, decode_raw_rgba
+from mock_backend import MockWorld
+
+
+def decode(data: bytes, fmt: str):
+    if fmt == "rgba":
+        return decode_raw_rgba(data)
+    image = Image.open(BytesIO(data))
+    image.load()
+    return image
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--world", default="city")
+    parser.add_argument("--tiles", type=int, default=8)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    world = MockWorld(args.world, root=os.path.join(SERVER_DIR, "mock"))
+    images = [world.image(*key) for key in sorted(world.tiles)[: args.tiles]]
+    colours = [len(image.getcolors(1 << 24)) for image in images]
+    print(
+        f"{len(images)} tiles of {images[0].size[0]}x{images[0].size[1]}, "
+        f"{min(colours)}-{max(colours)} distinct colours"
+    )
+
+    print(f"{'format':<12} {'encode ms':>10} {'decode ms':>10} {'KiB':>8}")
+    for fmt, (_, encode) in FORMATS.items():
+        encode_time = decode_time = size = 0.0
+        for _ in range(args.repeat):
+            for image in images:
+                start = time.perf_counter()
+                data = encode(image)
+                encode_time += time.perf_counter() - start
+                start = time.perf_counter()
+                decode(data, fmt)
+                decode_time += time.perf_counter() - start
+                size += len(data)
+        runs = args.repeat * len(images)
+        print(
+            f"{fmt:<12} {1000 * encode_time / runs:10.1f} {1000 * decode_time / runs:10.1f} "
+            f"{size / runs / 1024:8.0f}"
+        )
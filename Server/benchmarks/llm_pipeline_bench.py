@@ -0,0 +1,89 @@
+"""
+Tile throughput with and without LLM/sampling pipelining, against the local mock LLM.
+
+The sampler is simulated with a sleep so the benchmark runs without a GPU:
+
+    python benchmarks/llm_pipeline_bench.py --tiles 16 --llm-latency 0.8 --sample-time 1.0
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import GPTHelper
+from mock_llm import MockLLMHandler
+from scheduler import JobScheduler
+
+
+class FakeRequest:
+    batch_key = "tile"
+
+
+def start_mock_llm(latency: float) -> ThreadingHTTPServer:
+    MockLLMHandler.latency = latency
+    MockLLMHandler.jitter = 0.0
+    server = ThreadingHTTPServer(("127.0.0.1", 0), MockLLMHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+async def run_serial(helper, tiles: int, sample_time: float) -> float:
+    start = time.perf_counter()
+    for i in range(tiles):
+        await helper.achat(f"tile {i}")
+        await asyncio.to_thread(time.sleep, sample_time)
+    return time.perf_counter() - start
+
+
+async def run_pipelined(helper, tiles: int, sample_time: float) -> float:
+    scheduler = JobScheduler(
+        batch_handler=lambda payloads: [time.sleep(sample_time)] * len(payloads),
+        batch_window=0,
+        max_batch_size=1,
+    )
+    scheduler.start()
+
+    async def prepare(i):
+        await helper.achat(f"tile {i}")
+        return FakeRequest()
+
+    start = time.perf_counter()
+    jobs = [scheduler.submit_deferred(prepare(i)) for i in range(tiles)]
+    await asyncio.gather(*[scheduler.wait(job) for job in jobs])
+    elapsed = time.perf_counter() - start
+    scheduler.stop()
+    return elapsed
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tiles", type=int, default=16)
+    parser.add_argument("--llm-latency", type=float, default=0.8)
+    parser.add_argument("--sample-time", type=float, default=1.0)
+    args = parser.parse_args()
+
+    server = start_mock_llm(args.llm_latency)
+    helper = GPTHelper.AsyncGPTAPIHelper(
+        api_key="mock", api_base=f"http://127.0.0.1:{server.server_address[1]}/v1"
+    )
+
+    serial = await run_serial(helper, args.tiles, args.sample_time)
+    pipelined = await run_pipelined(helper, args.tiles, args.sample_time)
+    await helper.aclose()
+    server.shutdown()
+
+    sampling_only = args.tiles * args.sample_time
+    print(f"tiles={args.tiles} llm={args.llm_latency}s sample={args.sample_time}s")
+    print(f"pure sampling : {args.tiles / sampling_only:6.2f} tiles/s")
+    print(f"serial        : {args.tiles / serial:6.2f} tiles/s ({serial:.1f}s)")
+    print(f"pipelined     : {args.tiles / pipelined:6.2f} tiles/s ({pipelined:.1f}s)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,330 @@
+"""
+Load test with simulated players exploring the map the way the Unity client does.
+
+Each client calls /gen once, then walks the tile grid. After every move it requests, concurrently, the
+missing tiles around the player with /inpaint (source = the player's tile, target, extend_direction),
+like MapGenerator.CheckAdditionalMapTile. Latency histograms, the prepare/queue/service split reported by
+the server and failures are printed at the end.
+
+Against a running server (start it with MOCK_WORLD=city for a GPU-less run):
+
+    python benchmarks/load_test.py --url http://127.0.0.1:8765 --clients 16 --steps 20
+
+Or fully in-process against the mock backend, no server needed:
+
+    python benchmarks/load_test.py --in-process --clients 64 --steps 20 --latency-scale 0.01
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+from collections import Counter, defaultdict
+from io import BytesIO
+from typing import Dict, List, Optional
+
+import httpx
+import numpy as np
+from PIL import Image
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from inpaint_source import ORTHOGONAL_OFFSETS, extend_direction
+
+HISTOGRAM_BOUNDS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 60]
+TIMING_HEADERS = {
+    "prepare": "x-prepare-time",
+    "queue": "x-queue-time",
+    "service": "x-service-time",
+}
+
+
+class Stats:
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.stages: Dict[str, List[float]] = defaultdict(list)
+        self.cache = Counter()
+        self.failures = Counter()
+        self.elapsed = 0.0
+        self.server = None
+
+    def record(self, endpoint: str, seconds: float, response: httpx.Response):
+        self.latencies[endpoint].append(seconds)
+        self.cache[response.headers.get("x-tile-cache", "none")] += 1
+        for stage, header in TIMING_HEADERS.items():
+            if header in response.headers:
+                self.stages[stage].append(float(response.headers[header]))
+
+    def fail(self, endpoint: str, reason: str):
+        self.failures[f"{endpoint}: {reason}"] += 1
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(values: List[float]) -> str:
+    if not values:
+        return "n=0"
+    return (
+        f"n={len(values)} mean={sum(values) / len(values):.3f}s "
+        f"p50={percentile(values, 50):.3f}s p90={percentile(values, 90):.3f}s "
+        f"p99={percentile(values, 99):.3f}s max={max(values):.3f}s"
+    )
+
+
+def histogram(values: List[float], width: int = 40) -> List[str]:
+    counts = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+    for value in values:
+        counts[next((i for i, b in enumerate(HISTOGRAM_BOUNDS) if value <= b), -1)] += 1
+    peak = max(counts) or 1
+    labels = [f"<= {b}s" for b in HISTOGRAM_BOUNDS] + [f"> {HISTOGRAM_BOUNDS[-1]}s"]
+    return [
+        f"  {label:>9} {count:6d} {'#' * round(width * count / peak)}"
+        for label, count in zip(labels, counts)
+        if count
+    ]
+
+
+def make_inpaint_upload(size: int = 768) -> bytes:
+    """
+    A half transparent RGBA PNG about as large as the ones the client uploads.
+    """
+    rng = np.random.default_rng(0)
+    pixels = rng.integers(0, 256, (size, size, 4), dtype=np.uint8)
+    pixels[..., 3] = 255
+    pixels[: size // 2, :, 3] = 0
+    buffer = BytesIO()
+    Image.fromarray(pixels, "RGBA").save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+async def timed(stats, endpoint: str, send) -> Optional[httpx.Response]:
+    start = time.perf_counter()
+    try:
+        response = await send()
+    except httpx.HTTPError as e:
+        stats.fail(endpoint, type(e).__name__)
+        return None
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        stats.fail(endpoint, f"HTTP {response.status_code}")
+        return None
+    stats.record(endpoint, elapsed, response)
+    return response
+
+
+async def run_client(
+    index: int,
+    client: httpx.AsyncClient,
+    stats: Stats,
+    upload: bytes,
+    steps: int,
+    think_time: float,
+    shared_world: bool,
+    rng: random.Random,
+):
+    scene = "a quiet harbour town" if shared_world else f"a harbour town number {index}"
+    response = await timed(
+        stats, "/gen", lambda: client.get("/gen", params={"pos_prompt": scene})
+    )
+    if response is None:
+        return
+    world = response.headers.get("x-world", "")
+
+    rendered = {(0, 0)}
+    player = (0, 0)
+    heading = rng.choice(list(ORTHOGONAL_OFFSETS))
+
+    for _ in range(steps):
+        requests = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                target = (player[0] + dx, player[1] + dy)
+                if target in rendered:
+                    continue
+                # Offsets (target - neighbour) of the rendered tiles the inpaint source is built from
+                offsets = [
+                    offset
+                    for offset in ORTHOGONAL_OFFSETS
+                    if (target[0] - offset[0], target[1] - offset[1]) in rendered
+                ]
+                direction = extend_direction(offsets)
+                if direction is None:
+                    continue
+                requests.append((target, direction))
+
+        async def inpaint(target, direction):
+            data = {
+                "source_x": player[0],
+                "source_y": player[1],
+                "target_x": target[0],
+                "target_y": target[1],
+                "extend_direction": direction,
+            }
+            if world:
+                data["world"] = world
+            response = await timed(
+                stats,
+                "/inpaint",
+                lambda: client.post(
+                    "/inpaint",
+                    data=data,
+                    files={"image_file": ("source.png", upload, "image/png")},
+                ),
+            )
+            if response is not None:
+                rendered.add(target)
+
+        await asyncio.gather(*[inpaint(target, direction) for target, direction in requests])
+
+        # Mostly keep walking the same way, sometimes turn
+        if rng.random() < 0.3:
+            heading = rng.choice(list(ORTHOGONAL_OFFSETS))
+        player = (player[0] + heading[0], player[1] + heading[1])
+        if think_time:
+            await asyncio.sleep(rng.expovariate(1 / think_time))
+
+
+async def run(args) -> Stats:
+    stats = Stats()
+    upload = make_inpaint_upload()
+    limits = httpx.Limits(max_connections=args.clients * 9)
+    timeout = httpx.Timeout(args.timeout)
+
+    async def run_all(client):
+        rng = random.Random(args.seed)
+        await asyncio.gather(
+            *[
+                run_client(
+                    i,
+                    client,
+                    stats,
+                    upload,
+                    args.steps,
+                    args.think_time,
+                    args.shared_world,
+                    random.Random(rng.random()),
+                )
+                for i in range(args.clients)
+            ]
+        )
+
+    if not args.in_process:
+        async with httpx.AsyncClient(
+            base_url=args.url, limits=limits, timeout=timeout
+        ) as client:
+            start = time.perf_counter()
+            await asyncio.wait_for(run_all(client), args.max_duration)
+            stats.elapsed = time.perf_counter() - start
+        return stats
+
+    # The server module reads its mock settings at import time
+    os.environ["MOCK_WORLD"] = args.mock_world
+    os.environ["MOCK_LATENCY_SCALE"] = str(args.latency_scale)
+    os.chdir(SERVER_DIR)
+    import main
+
+    with tempfile.TemporaryDirectory() as state_dir:
+        # Everything the server persists goes to the temporary directory, not the source tree
+        main.TILE_STORE_DIR = os.path.join(state_dir, "tiles")
+        main.CANVAS_DIR = os.path.join(state_dir, "canvas")
+        main.LATENT_CACHE_DIR = os.path.join(state_dir, "latents")
+        main.LLM_CACHE_PATH = os.path.join(state_dir, "llm_cache.sqlite3")
+        main.TILE_PROMPTS_PATH = os.path.join(state_dir, "tile_prompts.json")
+        async with main.lifespan(main.app):
+            transport = httpx.ASGITransport(app=main.app)
+            async with httpx.AsyncClient(
+                transport=transport, base_url="http://load-test", timeout=timeout
+            ) as client:
+                start = time.perf_counter()
+                await asyncio.wait_for(run_all(client), args.max_duration)
+                stats.elapsed = time.perf_counter() - start
+                stats.server = (await client.get("/stats")).json()
+    return stats
+
+
+def report(stats: Stats, args):
+    requests = sum(len(values) for values in stats.latencies.values())
+    print(
+        f"{args.clients} clients x {args.steps} steps: {requests} tiles in {stats.elapsed:.1f}s "
+        f"({requests / stats.elapsed:.1f} tiles/s), {sum(stats.failures.values())} failures"
+    )
+    for endpoint, values in sorted(stats.latencies.items()):
+        print(f"{endpoint}: {summarize(values)}")
+        for line in histogram(values):
+            print(line)
+    for stage in TIMING_HEADERS:
+        if stats.stages.get(stage):
+            print(f"server {stage}: {summarize(stats.stages[stage])}")
+    print("tile cache:", dict(stats.cache))
+    for reason, count in stats.failures.most_common():
+        print(f"failed {count}x {reason}")
+    if stats.server:
+        print("server stats:", json.dumps(stats.server))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(
+                {
+                    "clients": args.clients,
+                    "steps": args.steps,
+                    "elapsed": stats.elapsed,
+                    "latencies": stats.latencies,
+                    "stages": stats.stages,
+                    "cache": stats.cache,
+                    "failures": stats.failures,
+                },
+                f,
+            )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--url", default="http://127.0.0.1:8765")
+    parser.add_argument(
+        "--in-process",
+        action="store_true",
+        help="Run the server app in this process on the mock backend instead of using --url",
+    )
+    parser.add_argument("--mock-world", default="city", help="With --in-process")
+    parser.add_argument(
+        "--latency-scale",
+        type=float,
+        default=1.0,
+        help="With --in-process, scales the simulated LLM and sampling durations",
+    )
+    parser.add_argument("--clients", type=int, default=8)
+    parser.add_argument("--steps", type=int, default=10, help="Moves per client")
+    parser.add_argument(
+        "--think-time", type=float, default=0.0, help="Mean seconds between moves"
+    )
+    parser.add_argument(
+        "--shared-world",
+        action="store_true",
+        help="All clients explore the same world, so they hit each other's tiles",
+    )
+    parser.add_argument("--timeout", type=float, default=300.0)
+    parser.add_argument(
+        "--max-duration",
+        type=float,
+        default=1800.0,
+        help="Seconds the whole run may take before it is aborted as hung",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", help="Also write the raw samples to this file")
+    args = parser.parse_args()
+
+    try:
+        stats = asyncio.run(run(args))
+    except asyncio.TimeoutError:
+        sys.exit(f"Load test did not finish within {args.max_duration:.0f}s, aborted")
+    report(stats, args)
@@ -0,0 +1,146 @@
+"""
+Time against visual difference of sampling tiles at 1/scale and upscaling them by repeating pixels.
+
+Recorded tiles show what a tile loses when it only has 1/scale of its resolution, reduced by averaging
+scale x scale blocks or by keeping one pixel per block, then upscaled back:
+
+    python benchmarks/lowres_bench.py --world city --scales 1 2 3 4
+
+With ComfyUI and the checkpoints installed, --sample also samples tiles at every scale through TilePipeline,
+timing them and measuring the same difference on the full resolution ones:
+
+    python benchmarks/lowres_bench.py --sample --seeds 4 --steps 20 --scales 1 2 4
+
+Difference is the mean absolute error (0-255) and PSNR against the full resolution tile, plus the share of
+pixels whose colour does not occur in it (0 means the palette is preserved).
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from typing import Dict, List
+
+import numpy as np
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from mock_backend import MockWorld
+
+
+def reduce(pixels: np.ndarray, scale: int, method: str) -> np.ndarray:
+    height, width, channels = pixels.shape
+    if method == "nearest":
+        return pixels[scale // 2 :: scale, scale // 2 :: scale]
+    blocks = pixels.reshape(height // scale, scale, width // scale, scale, channels)
+    return blocks.mean(axis=(1, 3)).round().astype(np.uint8)
+
+
+def upscale(pixels: np.ndarray, scale: int) -> np.ndarray:
+    return pixels.repeat(scale, axis=0).repeat(scale, axis=1)
+
+
+def colours(pixels: np.ndarray) -> np.ndarray:
+    pixels = pixels.astype(np.uint32)
+    return (pixels[..., 0] << 16) | (pixels[..., 1] << 8) | pixels[..., 2]
+
+
+def difference(original: np.ndarray, restored: np.ndarray) -> Dict[str, float]:
+    error = original.astype(np.float32) - restored.astype(np.float32)
+    mse = float((error**2).mean())
+    return {
+        "mae": float(np.abs(error).mean()),
+        "psnr": 10 * np.log10(255.0**2 / mse) if mse > 0 else float("inf"),
+        "new_colours": float((~np.isin(colours(restored), colours(original))).mean()),
+    }
+
+
+def print_differences(tiles: List[np.ndarray], scales: List[int], seconds: Dict[int, float] = None):
+    print(
+        f"{'scale':>5} {'sampled at':>10} {'s/tile':>7} {'speedup':>8} {'method':>8} "
+        f"{'MAE':>6} {'PSNR dB':>8} {'new colours':>12}"
+    )
+    height, width = tiles[0].shape[:2]
+    for scale in scales:
+        for method in ("box", "nearest"):
+            results = [
+                difference(tile, upscale(reduce(tile, scale, method), scale)) for tile in tiles
+            ]
+            mean = {key: np.mean([result[key] for result in results]) for key in results[0]}
+            timing = speedup = ""
+            if seconds is not None:
+                timing = f"{seconds[scale]:.2f}"
+                speedup = f"{seconds[scales[0]] / seconds[scale]:.1f}x"
+            print(
+                f"{scale:5d} {f'{width // scale}x{height // scale}':>10} {timing:>7} {speedup:>8} "
+                f"{method:>8} {mean['mae']:6.2f} {mean['psnr']:8.2f} {100 * mean['new_colours']:11.2f}%"
+            )
+
+
+def sample_tiles(args) -> (List[np.ndarray], Dict[int, float]):
+    """
+    Sample every seed at every scale, return the full resolution tiles and the seconds per tile of each scale.
+    """
+    from image_gen import import_custom_nodes
+    from latent_cache import LatentCache
+    from pipeline import TilePipeline, TileRequest, load_models
+
+    import_custom_nodes()
+    pipeline = TilePipeline(
+        load_models(args.ckpt, args.lora), latent_cache=LatentCache(tempfile.mkdtemp())
+    )
+
+    def run(seed: int, scale: int) -> np.ndarray:
+        request = TileRequest(
+            "gen",
+            args.prompt,
+            "",
+            world="bench",
+            tile=(seed, 0),
+            steps=args.steps,
+            seed=seed,
+            scale=scale,
+        )
+        return np.asarray(pipeline.run_batch([request])[0].convert("RGB"))
+
+    for scale in args.scales:
+        run(0, scale)  # warm up: prompt encoding, kernels for this latent size
+    tiles, seconds = [], {}
+    for scale in args.scales:
+        start = time.perf_counter()
+        images = [run(seed, scale) for seed in range(1, args.seeds + 1)]
+        seconds[scale] = (time.perf_counter() - start) / args.seeds
+        if scale == 1:
+            tiles = images
+    return tiles, seconds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--world", default="city")
+    parser.add_argument("--tiles", type=int, default=25)
+    parser.add_argument("--scales", type=int, nargs="+", default=[1, 2, 3, 4])
+    parser.add_argument("--sample", action="store_true")
+    parser.add_argument("--seeds", type=int, default=4)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument(
+        "--prompt",
+        default="A 2D game sprite, Pixel art, 64 bit, top down view, 2d game map, urban, town, open world",
+    )
+    parser.add_argument("--ckpt", default="pixelXL_xl.safetensors")
+    parser.add_argument("--lora", default="pixel-art-xl-v1.1.safetensors")
+    args = parser.parse_args()
+    if 1 not in args.scales:
+        args.scales = [1] + args.scales
+
+    world = MockWorld(args.world, root=os.path.join(SERVER_DIR, "mock"))
+    recorded = [np.asarray(world.image(*key)) for key in sorted(world.tiles)[: args.tiles]]
+    print(f"Recorded tiles ({args.world}, {len(recorded)})")
+    print_differences(recorded, args.scales)
+
+    if args.sample:
+        tiles, seconds = sample_tiles(args)
+        print(f"\nSampled tiles ({args.seeds} seeds, {args.steps} steps)")
+        print_differences(tiles, args.scales, seconds)
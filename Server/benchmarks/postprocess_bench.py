@@ -0,0 +1,94 @@
+"""
+Decoded tensor -> PIL image, the former per-tile numpy path against ImagePostprocessor:
+
+    python benchmarks/postprocess_bench.py --batch 4 --repeat 20
+    python benchmarks/postprocess_bench.py --device cuda
+"""
+
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import torch
+from PIL import Image
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from postprocess import ImagePostprocessor
+
+
+def legacy_to_pil(images: torch.Tensor):
+    results = []
+    for image in images:
+        image = 255.0 * image.cpu().numpy()
+        results.append(Image.fromarray(np.clip(image, 0, 255).astype(np.uint8)))
+    return results
+
+
+def run(name, convert, make_images, repeat, device):
+    # Warm up (allocates the reusable buffers)
+    convert(make_images())
+    elapsed = 0.0
+    tracemalloc.start()
+    for _ in range(repeat):
+        images = make_images()
+        if device.type == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        convert(images)
+        elapsed += time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--size", type=int, default=768)
+    parser.add_argument("--repeat", type=int, default=20)
+    parser.add_argument("--device", default="cpu")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    shape = (args.batch, args.size, args.size, 3)
+    pixels = args.size * args.size
+
+    def make_images():
+        return torch.rand(shape, device=device)
+
+    postprocessor = ImagePostprocessor()
+    tiles = args.batch * args.repeat
+    # Host bytes copied or allocated per tile, by construction of each path
+    legacy_bytes = {
+        "device->host": pixels * 3 * 4 if device.type == "cuda" else 0,
+        "host temporaries": pixels * 3 * (4 + 4 + 4 + 1),
+        "PIL copy": pixels * 4,
+    }
+    if device.type == "cuda":
+        new_bytes = {
+            "device->host": pixels * 4 * (2 if postprocessor.pin_memory else 1),
+            "host temporaries": pixels * 4,
+            "PIL copy": 0,
+        }
+    else:
+        new_bytes = {"device->host": 0, "host temporaries": pixels * 3, "PIL copy": pixels * 4}
+
+    print(f"{tiles} tiles of {args.size}x{args.size} on {device}, batches of {args.batch}")
+    print(f"{'path':<14} {'ms/tile':>8} {'traced peak MiB':>16}  bytes per tile")
+    for name, convert, per_tile in (
+        ("numpy", legacy_to_pil, legacy_bytes),
+        ("postprocessor", postprocessor.to_pil, new_bytes),
+    ):
+        elapsed, peak = run(name, convert, make_images, args.repeat, device)
+        detail = ", ".join(f"{k} {v / 2**20:.1f} MiB" for k, v in per_tile.items())
+        print(f"{name:<14} {1000 * elapsed / tiles:8.2f} {peak / 2**20:16.1f}  {detail}")
+
+    # Same pixels either way
+    images = make_images()
+    expected = [np.asarray(image) for image in legacy_to_pil(images.clone())]
+    actual = [np.asarray(image)[..., :3] for image in postprocessor.to_pil(images)]
+    assert all((a == b).all() for a, b in zip(expected, actual))
@@ -0,0 +1,154 @@
+"""
+Throughput and memory of SamplerPool for 1, 2 and 4 CPU sampler processes, on a stand-in model of
+matmul layers whose weights come from a memory-mapped safetensors file, the way the fused checkpoint
+is loaded:
+
+    python benchmarks/worker_pool_bench.py --workers 1 2 4 --tiles 32 --layers 16 --width 2048
+
+Memory is Rss/Pss/Private of each worker from /proc/<pid>/smaps_rollup (Linux). Pass --copy-weights
+to load the weights into private memory instead, as a plain load_state_dict would.
+"""
+
+import argparse
+import json
+import os
+import struct
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+
+import numpy as np
+import torch
+from PIL import Image
+
+SERVER_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SERVER_DIR)
+
+from fused_checkpoint import alias_mapped_weights, load_mmap_state_dict
+from worker_pool import SamplerPool
+
+
+def write_safetensors(path: str, state_dict):
+    header, offset = {}, 0
+    for name, tensor in state_dict.items():
+        size = tensor.numel() * tensor.element_size()
+        header[name] = {
+            "dtype": "F32",
+            "shape": list(tensor.shape),
+            "data_offsets": [offset, offset + size],
+        }
+        offset += size
+    encoded = json.dumps(header).encode("utf-8")
+    with open(path, "wb") as f:
+        f.write(struct.pack("<Q", len(encoded)))
+        f.write(encoded)
+        for tensor in state_dict.values():
+            f.write(tensor.contiguous().numpy().tobytes())
+
+
+class StubPipeline:
+    def __init__(self, weights_path: str, layers: int, width: int, rows: int, copy_weights: bool):
+        """
+        Sampler stand-in: every tile pushes rows activations through the layers.
+        """
+        self.rows = rows
+        self.model = torch.nn.Sequential(
+            *[torch.nn.Linear(width, width, bias=False) for _ in range(layers)]
+        )
+        state_dict, _ = load_mmap_state_dict(weights_path)
+        self.model.load_state_dict(state_dict)
+        if not copy_weights:
+            alias_mapped_weights(self.model, state_dict)
+        self.width = width
+
+    def run_batch(self, requests):
+        images = []
+        with torch.inference_mode():
+            for request in requests:
+                generator = torch.Generator().manual_seed(request.seed)
+                x = torch.randn(self.rows, self.width, generator=generator)
+                x = torch.tanh(self.model(x))
+                pixels = ((x[:64, :192] + 1) * 127.5).to(torch.uint8).numpy()
+                images.append(Image.fromarray(pixels.reshape(64, 64, 3)))
+        return images
+
+
+def build_stub_pipeline(**kwargs) -> StubPipeline:
+    return StubPipeline(**kwargs)
+
+
+def memory(pid: int):
+    values = {}
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            parts = line.split()
+            if parts[0] in ("Rss:", "Pss:", "Private_Clean:", "Private_Dirty:"):
+                values[parts[0][:-1]] = int(parts[1]) / 1024
+    return values["Rss"], values["Pss"], values["Private_Clean"] + values["Private_Dirty"]
+
+
+def run(pool: SamplerPool, num_tiles: int) -> float:
+    # The fields of TileRequest the pool and the stub read, without importing ComfyUI
+    requests = [
+        SimpleNamespace(
+            world="bench", tile=(i, 0), seed=i + 1, cancelled=False, preview=None
+        )
+        for i in range(num_tiles)
+    ]
+    # One dispatching thread per worker, like JobScheduler(num_workers=...)
+    with ThreadPoolExecutor(pool.num_workers) as executor:
+        start = time.perf_counter()
+        list(executor.map(lambda request: pool.run_batch([request]), requests))
+        return num_tiles / (time.perf_counter() - start)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--tiles", type=int, default=32)
+    parser.add_argument("--layers", type=int, default=16)
+    parser.add_argument("--width", type=int, default=2048)
+    parser.add_argument("--rows", type=int, default=256)
+    parser.add_argument("--copy-weights", action="store_true")
+    args = parser.parse_args()
+
+    weights_path = os.path.join(tempfile.mkdtemp(), "stub.safetensors")
+    generator = torch.Generator().manual_seed(0)
+    write_safetensors(
+        weights_path,
+        {
+            f"{i}.weight": torch.randn(args.width, args.width, generator=generator)
+            / args.width**0.5
+            for i in range(args.layers)
+        },
+    )
+    weights_mib = os.path.getsize(weights_path) / 2**20
+    print(
+        f"{os.cpu_count()} CPUs, {weights_mib:.0f} MiB of weights, "
+        f"{'copied' if args.copy_weights else 'mapped'}"
+    )
+    print(f"{'workers':>7} {'tiles/s':>8} {'Rss MiB':>8} {'Pss MiB':>8} {'Private MiB':>12}")
+    for num_workers in args.workers:
+        pool = SamplerPool(
+            "worker_pool_bench:build_stub_pipeline",
+            num_workers=num_workers,
+            factory_kwargs={
+                "weights_path": weights_path,
+                "layers": args.layers,
+                "width": args.width,
+                "rows": args.rows,
+                "copy_weights": args.copy_weights,
+            },
+        )
+        pool.start()
+        try:
+            run(pool, num_workers)  # warm up every worker
+            throughput = run(pool, args.tiles)
+            usage = np.array([memory(worker.pid) for worker in pool.workers])
+            rss, pss, private = usage.mean(axis=0)
+            print(f"{num_workers:7d} {throughput:8.2f} {rss:8.0f} {pss:8.0f} {private:12.0f}")
+        finally:
+            pool.stop()
+    os.remove(weights_path)
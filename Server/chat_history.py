@@ -0,0 +1,161 @@
+import threading
+from typing import Callable, Dict, List, Optional
+
+
+def approximate_token_count(text: str) -> int:
+    """
+    Rough token count for English text (about 4 characters per token).
+    """
+    return max(1, len(text) // 4)
+
+
+class ChatHistory:
+    def __init__(
+        self,
+        max_tokens: int = 1500,
+        count_tokens: Callable[[str], int] = approximate_token_count,
+        summarizer: Optional[Callable[[str, List[Dict[str, str]]], str]] = None,
+        max_summary_tokens: int = 200,
+        low_water_ratio: float = 0.5,
+    ):
+        """
+        Sliding-window chat history bounded by a token budget.
+
+        When the turns exceed max_tokens the oldest ones are dropped until the history is back under
+        low_water_ratio * max_tokens, so trimming (and summarizing) happens once per many calls instead of every call.
+
+        :param max_tokens: Token budget for the turns (and the summary) sent with each request.
+        :param count_tokens: Returns the number of tokens in a string.
+        :param summarizer: Optional summarizer(previous_summary, dropped_turns) -> new summary.
+            Without it dropped turns are simply forgotten.
+        :param max_summary_tokens: The summary is cut to this many tokens (at most a quarter of max_tokens).
+        :param low_water_ratio: Fraction of max_tokens the history is trimmed down to.
+        """
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.summarizer = summarizer
+        # The summary must leave room for the turns themselves
+        self.max_summary_tokens = min(max_summary_tokens, max_tokens // 4)
+        self.low_water_ratio = low_water_ratio
+        self.summary = ""
+        self._turns: List[Dict[str, str]] = []
+        self._turn_tokens: List[int] = []
+        self._tokens = 0
+        # Bumped by clear, tells a summary computed meanwhile that its turns are gone
+        self._generation = 0
+        self._compacting = False
+        self._lock = threading.Lock()
+
+    @property
+    def tokens(self) -> int:
+        """
+        Tokens currently held by the turns and the summary.
+        """
+        return self._tokens + (self.count_tokens(self.summary) if self.summary else 0)
+
+    def append(self, role: str, content: str):
+        self.extend([{"role": role, "content": content}])
+
+    def extend(self, turns: List[Dict[str, str]]):
+        """
+        Append turns in one step, so concurrent writers never interleave them (e.g. a question and its answer).
+        May call the summarizer, which blocks for an API round trip without holding up other readers and writers.
+        """
+        with self._lock:
+            for turn in turns:
+                tokens = self.count_tokens(turn["content"])
+                self._turns.append({"role": turn["role"], "content": turn["content"]})
+                self._turn_tokens.append(tokens)
+                self._tokens += tokens
+            if self.tokens <= self.max_tokens or self._compacting:
+                return
+            if self.summarizer is None:
+                self._drop_oldest(self._oldest_to_drop())
+                return
+            count = self._oldest_to_drop()
+            if count == 0:
+                return
+            # The turns stay visible while they are summarized, they are only replaced by the summary once it is in
+            self._compacting = True
+            dropped = self._turns[:count]
+            previous_summary = self.summary
+            generation = self._generation
+        try:
+            summary = self.summarizer(previous_summary, [dict(turn) for turn in dropped])
+        except Exception as e:
+            print(f"Could not summarize chat history: {e}")
+            summary = None
+        with self._lock:
+            self._compacting = False
+            unchanged = (
+                self._generation == generation
+                and self.summary == previous_summary
+                and len(self._turns) >= count
+                and all(a is b for a, b in zip(self._turns, dropped))
+            )
+            if not unchanged:
+                # Cleared or compacted by someone else in the meantime, the summary describes stale turns
+                return
+            self._drop_oldest(count)
+            if summary is not None:
+                self.summary = self._truncate(summary.strip(), self.max_summary_tokens)
+
+    def pop(self) -> Dict[str, str]:
+        with self._lock:
+            self._tokens -= self._turn_tokens.pop()
+            return self._turns.pop()
+
+    def messages(self) -> List[Dict[str, str]]:
+        """
+        The turns to send with the next request, preceded by the summary (as a system message) if there is one.
+        """
+        with self._lock:
+            messages = []
+            if self.summary:
+                messages.append(
+                    {
+                        "role": "system",
+                        "content": "Summary of the earlier conversation: " + self.summary,
+                    }
+                )
+            messages.extend(dict(turn) for turn in self._turns)
+            return messages
+
+    def clear(self):
+        with self._lock:
+            self._turns.clear()
+            self._turn_tokens.clear()
+            self._tokens = 0
+            self.summary = ""
+            self._generation += 1
+
+    def __len__(self) -> int:
+        return len(self._turns)
+
+    def _oldest_to_drop(self) -> int:
+        """
+        Number of oldest turns to drop to get back under the low water mark. Caller holds the lock.
+        """
+        summary_tokens = self.count_tokens(self.summary) if self.summary else 0
+        target = int(self.max_tokens * self.low_water_ratio) - summary_tokens
+        tokens = self._tokens
+        count = 0
+        # Always keep the newest turn, it is the one being answered
+        while count < len(self._turns) - 1 and tokens > target:
+            tokens -= self._turn_tokens[count]
+            count += 1
+        return count
+
+    def _drop_oldest(self, count: int):
+        """
+        Caller holds the lock.
+        """
+        self._tokens -= sum(self._turn_tokens[:count])
+        del self._turns[:count]
+        del self._turn_tokens[:count]
+
+    def _truncate(self, text: str, max_tokens: int) -> str:
+        words = text.split()
+        while words and self.count_tokens(" ".join(words)) > max_tokens:
+            words = words[: max(1, len(words) * 3 // 4)] if len(words) > 1 else []
+        return " ".join(words)
@@ -0,0 +1,85 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Tuple
+
+import torch
+
+
+def conditioning_nbytes(value: Any) -> int:
+    """
+    Bytes held by every tensor inside a (nested) ComfyUI conditioning.
+    """
+    if isinstance(value, torch.Tensor):
+        return value.element_size() * value.nelement()
+    if isinstance(value, dict):
+        return sum(conditioning_nbytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(conditioning_nbytes(v) for v in value)
+    return 0
+
+
+class ConditioningCache:
+    def __init__(self, max_bytes: int = 256 * 1024 * 1024, max_entries: int = 1024):
+        """
+        LRU cache of CLIP text conditionings keyed by (text, clip identity).
+
+        :param max_bytes: Upper bound on the tensor memory held by cached conditionings.
+        :param max_entries: Upper bound on the number of cached prompts.
+        """
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, int], Tuple[Any, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get_or_encode(self, text: str, clip: Any, encode: Callable[[], Any]) -> Any:
+        """
+        Return the cached conditioning for text, calling encode() only on a miss.
+        """
+        key = (text, id(clip))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+
+        conditioning = encode()
+        self.put(key, conditioning)
+        return conditioning
+
+    def put(self, key: Tuple[str, int], conditioning: Any):
+        size = conditioning_nbytes(conditioning)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self.nbytes -= previous[1]
+            self._entries[key] = (conditioning, size)
+            self.nbytes += size
+            while self._entries and (
+                self.nbytes > self.max_bytes or len(self._entries) > self.max_entries
+            ):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
@@ -0,0 +1,198 @@
+import asyncio
+import contextvars
+import struct
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+from typing import Callable, Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from metrics import STAGE_LABELS, time_stage
+
+# Raw frames are this header followed by width * height * 4 bytes of row-major RGBA, top row first
+RAW_MAGIC = b"RGBA"
+RAW_HEADER = struct.Struct("<4sII")
+
+
+def opaque_rgb(image: Image.Image) -> Image.Image:
+    """
+    Sampled tiles are wrapped as RGBA with an opaque alpha (see postprocess.py), drop it before compressing.
+    """
+    return image if image.mode == "RGB" else image.convert("RGB")
+
+
+def encode_png(image: Image.Image) -> bytes:
+    buffer = BytesIO()
+    opaque_rgb(image).save(buffer, format="PNG")
+    return buffer.getvalue()
+
+
+def encode_png_fast(image: Image.Image) -> bytes:
+    # zlib level 1: most of the size win of deflate at a fraction of the time
+    buffer = BytesIO()
+    opaque_rgb(image).save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def encode_png_palette(image: Image.Image) -> bytes:
+    """
+    Palette-indexed PNG. Exact when the tile has at most 256 colours (typical for pixel art),
+    otherwise the colours are reduced to 256.
+    """
+    image = opaque_rgb(image)
+    colors = image.getcolors(256)
+    quantized = image.quantize(
+        colors=len(colors) if colors is not None else 256,
+        method=Image.Quantize.MEDIANCUT if colors is not None else Image.Quantize.FASTOCTREE,
+        dither=Image.Dither.NONE,
+    )
+    buffer = BytesIO()
+    quantized.save(buffer, format="PNG", compress_level=1)
+    return buffer.getvalue()
+
+
+def encode_webp(image: Image.Image) -> bytes:
+    buffer = BytesIO()
+    opaque_rgb(image).save(buffer, format="WEBP", lossless=True, quality=0, method=0)
+    return buffer.getvalue()
+
+
+def encode_raw_rgba(image: Image.Image) -> bytes:
+    rgba = np.asarray(image if image.mode == "RGBA" else image.convert("RGBA"))
+    height, width = rgba.shape[:2]
+    return RAW_HEADER.pack(RAW_MAGIC, width, height) + rgba.tobytes()
+
+
+def decode_raw_rgba(data: bytes) -> np.ndarray:
+    magic, width, height = RAW_HEADER.unpack_from(data)
+    if magic != RAW_MAGIC:
+        raise ValueError("Not a raw RGBA tile")
+    return np.frombuffer(data, dtype=np.uint8, offset=RAW_HEADER.size).reshape(
+        height, width, 4
+    )
+
+
+# name: (media type, encoder)
+FORMATS: Dict[str, Tuple[str, Callable[[Image.Image], bytes]]] = {
+    "png": ("image/png", encode_png),
+    "png-fast": ("image/png", encode_png_fast),
+    "png-palette": ("image/png", encode_png_palette),
+    "webp": ("image/webp", encode_webp),
+    "rgba": ("application/x-tile-rgba", encode_raw_rgba),
+}
+
+DEFAULT_FORMAT = "png"
+
+# Formats picked for a media type in the Accept header, when no format is asked for explicitly
+ACCEPTED_MEDIA_TYPES = {
+    "image/webp": "webp",
+    "application/x-tile-rgba": "rgba",
+    "image/png": "png",
+}
+
+
+def negotiate_format(requested: str = "", accept: str = "") -> str:
+    """
+    Output format of a response: the format query parameter if given, else the first Accept media type we can produce.
+
+    :raises ValueError: If the requested format is unknown.
+    """
+    if requested:
+        if requested not in FORMATS:
+            raise ValueError(
+                f"Unknown format {requested}, expected one of {', '.join(FORMATS)}"
+            )
+        return requested
+
+    candidates = []
+    for position, part in enumerate(accept.split(",")):
+        media_type, *params = [piece.strip() for piece in part.split(";")]
+        quality = 1.0
+        for param in params:
+            if param.startswith("q="):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    pass
+        if media_type in ACCEPTED_MEDIA_TYPES and quality > 0:
+            candidates.append((-quality, position, ACCEPTED_MEDIA_TYPES[media_type]))
+    return min(candidates)[2] if candidates else DEFAULT_FORMAT
+
+
+def media_type(fmt: str) -> str:
+    return FORMATS[fmt][0]
+
+
+def encode_image(image: Image.Image, fmt: str) -> bytes:
+    with time_stage("encode_" + fmt):
+        return FORMATS[fmt][1](image)
+
+
+def transcode_png(png: bytes, fmt: str) -> bytes:
+    with time_stage("decode_png"):
+        image = Image.open(BytesIO(png))
+        image.load()
+    return encode_image(image, fmt)
+
+
+class TileResult:
+    def __init__(self, image: Image.Image, png: Future):
+        """
+        A sampled tile: its pixels, and its canonical PNG which is encoded (and stored) in the background.
+        """
+        self.image = image
+        self.png = png
+
+
+class TileEncoder:
+    def __init__(self, max_workers: int = 2, background_workers: int = 1):
+        """
+        Thread pool doing every image encode, so the sampling worker moves on to the next batch right away.
+        PIL releases the GIL while compressing, so encodes run in parallel with sampling and each other.
+
+        Encodes nobody is waiting for (the stores of prefetched and refined tiles) go to their own pool, so
+        a burst of them never delays the tile a client asked for.
+
+        :param background_workers: Threads of the background pool.
+        """
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="tile-encoder"
+        )
+        self._background = ThreadPoolExecutor(
+            max_workers=background_workers, thread_name_prefix="tile-encoder-background"
+        )
+
+    def submit(
+        self,
+        fn,
+        *args,
+        background: bool = False,
+        stage_labels: Optional[Tuple[str, str]] = None,
+    ) -> Future:
+        """
+        :param stage_labels: (endpoint, cache) the encode's stage timings are recorded under, those of the
+            caller's context when None (see metrics.STAGE_LABELS).
+        """
+        context = contextvars.copy_context()
+        if stage_labels is not None:
+            context.run(STAGE_LABELS.set, stage_labels)
+        executor = self._background if background else self._executor
+        return executor.submit(context.run, fn, *args)
+
+    async def encode(self, result: TileResult, fmt: str) -> bytes:
+        if fmt == DEFAULT_FORMAT:
+            return await asyncio.wrap_future(result.png)
+        return await asyncio.wrap_future(self.submit(encode_image, result.image, fmt))
+
+    async def transcode(self, png: bytes, fmt: str) -> bytes:
+        """
+        A stored PNG in another format.
+        """
+        if fmt == DEFAULT_FORMAT:
+            return png
+        return await asyncio.wrap_future(self.submit(transcode_png, png, fmt))
+
+    def shutdown(self, wait: bool = True):
+        self._executor.shutdown(wait=wait)
+        self._background.shutdown(wait=wait)
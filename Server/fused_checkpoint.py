@@ -0,0 +1,256 @@
+"""
+Fuse a LoRA into its base checkpoint once and load the result straight from a memory map.
+
+The server calls load_fused_models at startup: the first boot builds the artifact, later boots (and
+uvicorn reloads) only map it. To build it ahead of time, from the Server directory:
+
+    python fused_checkpoint.py --ckpt pixelXL_xl.safetensors --lora pixel-art-xl-v1.1.safetensors
+"""
+
+import argparse
+import hashlib
+import json
+import mmap
+import os
+import struct
+import time
+from typing import Dict, Tuple
+
+import torch
+
+# Bump when the artifact layout changes so stale artifacts are rebuilt
+FUSED_FORMAT_VERSION = 1
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+    SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+
+def file_fingerprint(path: str) -> str:
+    stat = os.stat(path)
+    return f"{os.path.basename(path)}:{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def fused_checkpoint_path(
+    cache_dir: str,
+    ckpt_path: str,
+    lora_path: str,
+    strength_model: float,
+    strength_clip: float,
+) -> str:
+    """
+    Artifact path, keyed by both input files (name, size, mtime) and the LoRA strengths.
+    """
+    key = json.dumps(
+        [
+            FUSED_FORMAT_VERSION,
+            file_fingerprint(ckpt_path),
+            file_fingerprint(lora_path),
+            strength_model,
+            strength_clip,
+        ]
+    )
+    digest = hashlib.sha256(key.encode("utf-8")).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(ckpt_path))[0]
+    return os.path.join(cache_dir, f"{name}-fused-{digest}.safetensors")
+
+
+def load_mmap_state_dict(path: str) -> Tuple[Dict[str, torch.Tensor], Dict[str, str]]:
+    """
+    Tensors of a safetensors file as views into a private memory map of it.
+
+    Nothing is read up front: pages are faulted in when a tensor is first touched, and unmodified
+    pages stay shared with the page cache (and with every other process mapping the same file).
+
+    :return: (state dict, metadata)
+    """
+    with open(path, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+        # Copy-on-write: the tensors are writable without ever writing to the file
+        buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    metadata = header.pop("__metadata__", {}) or {}
+    data_start = 8 + header_size
+    state_dict = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        if count == 0:
+            state_dict[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        state_dict[name] = torch.frombuffer(
+            buffer, dtype=dtype, count=count, offset=data_start + begin
+        ).view(info["shape"])
+    return state_dict, metadata
+
+
+def alias_mapped_weights(
+    module: torch.nn.Module, state_dict: Dict[str, torch.Tensor], prefix: str = ""
+) -> int:
+    """
+    Point the CPU parameters and buffers of module at the matching tensors of a mapped state dict,
+    dropping the private copies load_state_dict made. Tensors whose shape or dtype differ (cast at
+    load) keep their copy.
+
+    :param prefix: Prefix of the module's entries in the state dict.
+    :return: Bytes now backed by the memory map.
+    """
+    shared = 0
+    with torch.no_grad():
+        tensors = list(module.named_parameters()) + list(module.named_buffers())
+        for name, tensor in tensors:
+            mapped = state_dict.get(prefix + name)
+            if (
+                mapped is None
+                or tensor.device.type != "cpu"
+                or mapped.shape != tensor.shape
+                or mapped.dtype != tensor.dtype
+            ):
+                continue
+            tensor.data = mapped
+            shared += mapped.numel() * mapped.element_size()
+    return shared
+
+
+def build_fused_checkpoint(
+    output_path: str,
+    ckpt_path: str,
+    lora_path: str,
+    strength_model: float,
+    strength_clip: float,
+):
+    """
+    Load the checkpoint, apply the LoRA to the weights themselves and save the result as one safetensors file.
+    """
+    import comfy.model_management
+    import comfy.sd
+    import comfy.utils
+
+    start = time.perf_counter()
+    model, clip, vae = comfy.sd.load_checkpoint_guess_config(
+        ckpt_path, output_vae=True, output_clip=True
+    )[:3]
+    lora = comfy.utils.load_torch_file(lora_path, safe_load=True)
+    model, clip = comfy.sd.load_lora_for_models(
+        model, clip, lora, strength_model, strength_clip
+    )
+    del lora
+
+    # Loading with force_patch_weights writes the LoRA deltas into the weights
+    comfy.model_management.load_models_gpu(
+        [model, clip.load_model()], force_patch_weights=True
+    )
+    state_dict = model.model.state_dict_for_saving(clip.get_sd(), vae.get_sd(), None)
+    state_dict = {
+        key: tensor.contiguous().cpu() for key, tensor in state_dict.items()
+    }
+    metadata = {
+        "fused_from": file_fingerprint(ckpt_path),
+        "fused_lora": file_fingerprint(lora_path),
+        "strength_model": str(strength_model),
+        "strength_clip": str(strength_clip),
+    }
+
+    os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+    temp_path = output_path + ".tmp"
+    comfy.utils.save_torch_file(state_dict, temp_path, metadata=metadata)
+    os.replace(temp_path, output_path)
+    del model, clip, vae, state_dict
+    comfy.model_management.unload_all_models()
+    comfy.model_management.soft_empty_cache()
+    print(f"Built {output_path} in {time.perf_counter() - start:.1f}s")
+
+
+def load_fused_models(
+    ckpt_name: str,
+    lora_name: str,
+    strength_model: float = 1,
+    strength_clip: float = 1,
+    cache_dir: str = "fused_models",
+    share_weights: bool = False,
+):
+    """
+    (model, clip, vae) of the checkpoint with the LoRA already in the weights, building the artifact if needed.
+
+    :param ckpt_name: Checkpoint name, as given to CheckpointLoaderSimple.
+    :param lora_name: LoRA name, as given to LoraLoader.
+    :param cache_dir: Where fused artifacts are kept.
+    :param share_weights: Leave the diffusion model weights in the memory map after loading, so every
+        process mapping the artifact shares the same physical pages (CPU only).
+    """
+    import comfy.sd
+    import folder_paths
+
+    ckpt_path = folder_paths.get_full_path("checkpoints", ckpt_name)
+    lora_path = folder_paths.get_full_path("loras", lora_name)
+    path = fused_checkpoint_path(
+        cache_dir, ckpt_path, lora_path, strength_model, strength_clip
+    )
+    if not os.path.exists(path):
+        print(f"No fused checkpoint for {ckpt_name} + {lora_name} yet, building it")
+        build_fused_checkpoint(path, ckpt_path, lora_path, strength_model, strength_clip)
+
+    embedding_directory = folder_paths.get_folder_paths("embeddings")
+    load_state_dict = getattr(comfy.sd, "load_state_dict_guess_config", None)
+    if load_state_dict is None:
+        # Older ComfyUI: reads the file instead of mapping it, still without LoRA patching
+        return comfy.sd.load_checkpoint_guess_config(
+            path,
+            output_vae=True,
+            output_clip=True,
+            embedding_directory=embedding_directory,
+        )[:3]
+
+    state_dict, _ = load_mmap_state_dict(path)
+    # The loader renames and drops entries of the dict it is given
+    mapped = dict(state_dict) if share_weights else None
+    model, clip, vae = load_state_dict(
+        state_dict,
+        output_vae=True,
+        output_clip=True,
+        embedding_directory=embedding_directory,
+    )[:3]
+    if mapped is not None:
+        shared = alias_mapped_weights(model.model, mapped, prefix="model.")
+        print(f"{shared / 2**20:.0f} MiB of model weights shared through {path}")
+    return model, clip, vae
+
+
+if __name__ == "__main__":
+    import image_gen  # puts ComfyUI on sys.path
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0].strip())
+    parser.add_argument("--ckpt", default="pixelXL_xl.safetensors")
+    parser.add_argument("--lora", default="pixel-art-xl-v1.1.safetensors")
+    parser.add_argument("--strength-model", type=float, default=1)
+    parser.add_argument("--strength-clip", type=float, default=1)
+    parser.add_argument("--cache-dir", default="fused_models")
+    args = parser.parse_args()
+
+    import folder_paths
+
+    ckpt_path = folder_paths.get_full_path("checkpoints", args.ckpt)
+    lora_path = folder_paths.get_full_path("loras", args.lora)
+    output_path = fused_checkpoint_path(
+        args.cache_dir, ckpt_path, lora_path, args.strength_model, args.strength_clip
+    )
+    if os.path.exists(output_path):
+        print(f"{output_path} is up to date")
+    else:
+        build_fused_checkpoint(
+            output_path, ckpt_path, lora_path, args.strength_model, args.strength_clip
+        )
@@ -0,0 +1,37 @@
+from io import BytesIO
+from typing import Tuple
+
+import numpy as np
+import torch
+from PIL import Image, ImageOps
+
+
+def rgba_to_inpaint_tensors(rgba: np.ndarray) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    (H, W, 4) uint8 array to the tensors LoadImage would produce.
+
+    Transparent pixels are the ones to generate, so the mask is 1 - alpha.
+
+    :return: pixels of shape (1, H, W, 3) in [0, 1] and mask of shape (1, H, W) in [0, 1].
+    """
+    rgba = torch.from_numpy(rgba).unsqueeze(0)
+    pixels = rgba[..., :3].to(torch.float32).div_(255.0)
+    mask = rgba[..., 3].to(torch.float32).mul_(-1.0 / 255.0).add_(1.0)
+    return pixels, mask
+
+
+def decode_rgba(data: bytes) -> np.ndarray:
+    """
+    Decode PNG (or any PIL readable) bytes into a writable (H, W, 4) uint8 array.
+    """
+    image = ImageOps.exif_transpose(Image.open(BytesIO(data)))
+    # np.array (not asarray) gives torch a writable buffer
+    return np.array(image.convert("RGBA"))
+
+
+def decode_inpaint_source(data: bytes) -> Tuple[torch.Tensor, torch.Tensor]:
+    """
+    Decode an uploaded inpaint source PNG straight into the (pixels, mask) tensors VAEEncodeForInpaint expects.
+    Images without alpha get an all-zero mask, like LoadImage.
+    """
+    return rgba_to_inpaint_tensors(decode_rgba(data))
@@ -0,0 +1,76 @@
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+# Offsets (target - neighbour) in tile index space, y pointing up like in Unity
+ORTHOGONAL_OFFSETS = {
+    (0, 1): "Up",
+    (0, -1): "Down",
+    (-1, 0): "Left",
+    (1, 0): "Right",
+}
+
+DIAGONAL_DIRECTIONS = {
+    (1, 1): "TopRight",
+    (-1, 1): "TopLeft",
+    (1, -1): "BottomRight",
+    (-1, -1): "BottomLeft",
+}
+
+
+def extend_direction(offsets) -> Optional[str]:
+    """
+    The direction name MapGenerator.cs would send for a target with neighbours at the given offsets,
+    or None when the neighbours do not describe an extension (e.g. opposite sides).
+    """
+    offsets = list(offsets)
+    if len(offsets) == 1:
+        return ORTHOGONAL_OFFSETS.get(tuple(offsets[0]))
+    if len(offsets) == 2:
+        summed = (offsets[0][0] + offsets[1][0], offsets[0][1] + offsets[1][1])
+        return DIAGONAL_DIRECTIONS.get(summed)
+    return None
+
+
+def fill_in_pixels(target: np.ndarray, source: np.ndarray, offset: Tuple[int, int]):
+    """
+    Copy the half of a neighbour tile that overlaps the target tile (tiles are placed half a tile apart).
+
+    Vectorized port of MapGenerator.fillInPixels. Arrays are (H, W, C) in image order (row 0 at the top),
+    so "up" in tile space is towards row 0.
+    """
+    height, width = source.shape[:2]
+    half_h, half_w = height // 2, width // 2
+    if offset == (0, 1):
+        # target above the neighbour: its bottom half is the neighbour's top half
+        target[half_h:] = source[:half_h]
+    elif offset == (0, -1):
+        target[:half_h] = source[half_h:]
+    elif offset == (-1, 0):
+        # target left of the neighbour: its right half is the neighbour's left half
+        target[:, half_w:] = source[:, :half_w]
+    elif offset == (1, 0):
+        target[:, :half_w] = source[:, half_w:]
+
+
+def compose_inpaint_source(
+    neighbours: Dict[Tuple[int, int], np.ndarray],
+) -> Tuple[np.ndarray, Optional[str]]:
+    """
+    Build the half-masked RGBA inpaint source for a tile from its rendered orthogonal neighbours.
+
+    :param neighbours: RGB or RGBA arrays of shape (H, W, C) keyed by offset (target - neighbour).
+    :return: (H, W, 4) uint8 array, transparent where the tile has to be generated, and the extend direction.
+    """
+    first = next(iter(neighbours.values()))
+    height, width = first.shape[:2]
+    canvas = np.zeros((height, width, 4), dtype=np.uint8)
+    for offset, pixels in neighbours.items():
+        if pixels.shape[2] == 3:
+            source = np.empty((height, width, 4), dtype=np.uint8)
+            source[..., :3] = pixels
+            source[..., 3] = 255
+        else:
+            source = pixels
+        fill_in_pixels(canvas, source, offset)
+    return canvas, extend_direction(neighbours.keys())
@@ -0,0 +1,235 @@
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+LatentKey = Tuple[str, int, int]
+
+
+class LatentEntry:
+    def __init__(self, latent: torch.Tensor, fingerprint: torch.Tensor):
+        """
+        :param latent: (C, h, w) sampled latent of a tile, what VAEDecode turned into its pixels.
+        :param fingerprint: (3, h, w) the decoded pixels averaged over each latent pixel, in [0, 1].
+            Tells whether an inpaint source really shows this tile.
+        """
+        self.latent = latent
+        self.fingerprint = fingerprint
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            tensor.element_size() * tensor.nelement()
+            for tensor in (self.latent, self.fingerprint)
+        )
+
+
+class LatentCache:
+    def __init__(
+        self,
+        spill_dir: str = "latents",
+        max_bytes: int = 256 * 1024 * 1024,
+        max_disk_bytes: int = 4 * 1024 * 1024 * 1024,
+    ):
+        """
+        Sampled latents of generated tiles keyed by (world, x, y), so extending a tile does not have to
+        VAE encode its neighbours' pixels again.
+
+        Recently used entries are kept in an in-memory LRU bounded by max_bytes. Every entry is also written
+        to spill_dir/<world>/<x>_<y>.pt, so entries evicted from memory, those of other sampler processes and
+        those from before a restart are still found there. A later put for the same tile replaces it.
+        Files are written on a background thread, and the least recently used ones are deleted once the
+        spilled files this cache knows of (those found at start, written or read since) exceed max_disk_bytes.
+        Sampler processes sharing spill_dir each keep their own account of it.
+
+        :param spill_dir: Directory holding the spilled entries.
+        :param max_bytes: Upper bound on the tensor memory held in the LRU (about 200 KB per 768x768 tile).
+        :param max_disk_bytes: Upper bound on the size of the spilled files.
+        """
+        self.spill_dir = spill_dir
+        self.max_bytes = max_bytes
+        self.max_disk_bytes = max_disk_bytes
+        self._entries: "OrderedDict[LatentKey, LatentEntry]" = OrderedDict()
+        # Put but not on disk yet, so get finds them even once evicted from the LRU
+        self._pending: Dict[LatentKey, LatentEntry] = {}
+        # Size of every spilled file, least recently used first
+        self._files: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="latent-spill")
+        self.nbytes = 0
+        self.disk_bytes = 0
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._scan()
+
+    def _scan(self):
+        """
+        Account for the files spilled before a restart, oldest first.
+        """
+        found = []
+        for directory, _, names in os.walk(self.spill_dir):
+            for name in names:
+                if not name.endswith(".pt"):
+                    continue
+                path = os.path.join(directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((stat.st_mtime, path, stat.st_size))
+        with self._lock:
+            for _, path, size in sorted(found):
+                self._account(path, size)
+            victims = self._over_disk_budget()
+        self._delete(victims)
+
+    def path(self, world: str, x: int, y: int) -> str:
+        # World ids are hex digests, but keep anything else from escaping spill_dir
+        name = "".join(c if c.isalnum() or c in "-_" else "_" for c in world)
+        return os.path.join(self.spill_dir, name, f"{x}_{y}.pt")
+
+    def get(self, world: str, x: int, y: int) -> Optional[LatentEntry]:
+        key = (world, x, y)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+            entry = self._pending.get(key)
+            if entry is not None:
+                self.hits += 1
+                self._remember(key, entry)
+                return entry
+
+        path = self.path(world, x, y)
+        try:
+            saved = torch.load(path, weights_only=True)
+            size = os.path.getsize(path)
+        except FileNotFoundError:
+            with self._lock:
+                self.misses += 1
+            return None
+        entry = LatentEntry(saved["latent"], saved["fingerprint"])
+        with self._lock:
+            self.disk_hits += 1
+            self._remember(key, entry)
+            # Possibly written by another sampler process
+            self._account(path, size)
+            victims = self._over_disk_budget(keep=path)
+        self._delete(victims)
+        return entry
+
+    def put(self, world: str, x: int, y: int, latent: torch.Tensor, fingerprint: torch.Tensor):
+        entry = LatentEntry(
+            latent.detach().to("cpu", torch.float32).clone(),
+            fingerprint.detach().to("cpu", torch.float16).clone(),
+        )
+        key = (world, x, y)
+        with self._lock:
+            self._remember(key, entry)
+            self._pending[key] = entry
+        # Off the sampling thread, in put order, so a later put for the tile is the one left on disk
+        self._writer.submit(self._spill, key, entry)
+
+    def _spill(self, key: LatentKey, entry: LatentEntry):
+        path = self.path(*key)
+        try:
+            self._write(path, entry)
+            size = os.path.getsize(path)
+        except Exception as e:
+            print(f"Could not spill the latent of {key}: {e}")
+            with self._lock:
+                if self._pending.get(key) is entry:
+                    del self._pending[key]
+            return
+        with self._lock:
+            if self._pending.get(key) is entry:
+                del self._pending[key]
+            self._account(path, size)
+            victims = self._over_disk_budget(keep=path)
+        self._delete(victims)
+
+    def _write(self, path: str, entry: LatentEntry):
+        # Atomic so a concurrent reader never sees half a file. No fsync: losing an entry only costs a VAE encode
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                torch.save({"latent": entry.latent, "fingerprint": entry.fingerprint}, f)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _account(self, path: str, size: int):
+        """
+        Record a spilled file as the most recently used one. Caller holds the lock.
+        """
+        self.disk_bytes += size - self._files.pop(path, 0)
+        self._files[path] = size
+
+    def _over_disk_budget(self, keep: Optional[str] = None) -> List[str]:
+        """
+        Forget the least recently used files until the rest fit max_disk_bytes, return their paths for _delete.
+        Caller holds the lock.
+        """
+        victims = []
+        while self.disk_bytes > self.max_disk_bytes and self._files:
+            path, size = next(iter(self._files.items()))
+            if path == keep:
+                break
+            del self._files[path]
+            self.disk_bytes -= size
+            victims.append(path)
+        return victims
+
+    @staticmethod
+    def _delete(paths: List[str]):
+        for path in paths:
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                # Another sampler process got to it first
+                pass
+
+    def _remember(self, key: LatentKey, entry: LatentEntry):
+        """
+        Put an entry in the LRU. Caller holds the lock.
+        """
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.nbytes -= previous.nbytes
+        if entry.nbytes > self.max_bytes:
+            return
+        self._entries[key] = entry
+        self.nbytes += entry.nbytes
+        while self.nbytes > self.max_bytes:
+            _, evicted = self._entries.popitem(last=False)
+            self.nbytes -= evicted.nbytes
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.nbytes,
+                "hits": self.hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "disk_files": len(self._files),
+                "disk_bytes": self.disk_bytes,
+                "pending_writes": len(self._pending),
+            }
+
+    def close(self):
+        """
+        Wait for the pending spills.
+        """
+        self._writer.shutdown(wait=True)
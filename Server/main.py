@@ -3,120 +3,360 @@ import time
 from fastapi.responses import JSONResponse, StreamingResponse
 import uvicorn
 import asyncio
+from concurrent.futures import Future
 from typing import Union
 import random
 from PIL import Image
 import numpy as np
 from io import BytesIO
 from fastapi.responses import Response
-from threading import Semaphore
-from transformers import AutoTokenizer, AutoModelForCausalLM
+from starlette.routing import Match
 import threading
-import LLMHelper
 import GPTHelper
+from scheduler import (
+    JobScheduler,
+    QueueFull,
+    PRIORITY_URGENT,
+    PRIORITY_NORMAL,
+    PRIORITY_PREFETCH,
+    PRIORITY_REFINE,
+)
 
-from fastapi import FastAPI, File, Form, UploadFile
+from fastapi import (
+    FastAPI,
+    File,
+    Form,
+    Header,
+    Query,
+    Request,
+    UploadFile,
+    WebSocket,
+    WebSocketDisconnect,
+)
 import torch
 
-from image_gen import get_value_at_index, import_custom_nodes, NODE_CLASS_MAPPINGS
+from conditioning_cache import ConditioningCache
+from latent_cache import LatentCache
+from image_io import decode_inpaint_source, decode_rgba, rgba_to_inpaint_tensors
+from prompt_cache import PromptCache
+from worker_pool import SamplerPool
+from tile_store import TileStore
+from world_canvas import CanvasStore
+from prefetch import Prefetcher
+from tile_jobs import TileJobs
+from quality import QualityTier, select_tier
+from refine import Refiner
+from inpaint_source import ORTHOGONAL_OFFSETS
+from pipeline import TilePipeline, TileRequest, load_models
+from encoding import (
+    DEFAULT_FORMAT,
+    TileEncoder,
+    TileResult,
+    encode_image,
+    media_type,
+    negotiate_format,
+)
+from previews import PreviewStream, encode_preview
+from mock_backend import LatencyModel, MockChat, MockPipeline, MockWorld
+from metrics import (
+    QUALITY_TOTAL,
+    QUEUE_DEPTH,
+    REGISTRY,
+    REQUEST_SECONDS,
+    REQUESTS_TOTAL,
+    STAGE_LABELS,
+    observe_job,
+    set_stage_cache,
+    time_stage,
+)
 
+import base64
+import hashlib
 import json
+import math
 import os
 import random
 import sys
-from typing import Sequence, Mapping, Any, Union
+from typing import Sequence, Mapping, Any, Awaitable, Callable, Dict, List, Optional, Tuple, Union
 import torch
 
 DEBUG = False
 
-STEPS = 20
+# Quality tiers a tile can be sampled at, best first. Clients name one (quality=draft), or send a deadline
+# in seconds and get the best tier expected to be done in time given the queue, so under load tiles
+# degrade to fewer steps instead of arriving late.
+QUALITY_TIERS = {
+    "final": QualityTier("final", steps=30, sampler_name="ddim", scheduler="karras"),
+    "normal": QualityTier("normal", steps=20, sampler_name="ddim", scheduler="karras"),
+    "draft": QualityTier("draft", steps=10, sampler_name="dpmpp_2m", scheduler="karras"),
+    # Sampled at 384x384 and upscaled 2x by repeating pixels, pixel art has little detail beyond that
+    "lowres": QualityTier("lowres", steps=20, sampler_name="ddim", scheduler="karras", scale=2),
+}
+DEFAULT_QUALITY = "normal"
+# Deadline assumed for foreground requests that send neither, 0 samples those at DEFAULT_QUALITY whatever the load
+DEFAULT_DEADLINE = float(os.getenv("DEFAULT_DEADLINE", "0"))
+
+# Draft tiles are sampled again at REFINE_QUALITY once the sampler is idle, starting from the draft
+# with REFINE_DENOISE so the tile keeps its layout and its seams with the neighbours extended from it
+REFINE_ENABLED = True
+REFINE_FROM = ("draft", "lowres")
+REFINE_QUALITY = "normal"
+REFINE_DENOISE = 0.45
 
 USE_LLM = True
 
-mock = "city"  # ["city", "desert"]
+# Tiles requested within BATCH_WINDOW seconds of each other are sampled together
+BATCH_WINDOW = 0.05
+MAX_BATCH_SIZE = 4
+
+# Admission control for foreground tiles (prefetching is bounded separately). At most
+# MAX_ACTIVE_JOBS tiles are being prompted, queued or sampled at once, at most MAX_QUEUE_DEPTH of
+# them waiting for the sampler. Beyond that requests get a 429 with Retry-After and the queue
+# position and wait they would have had, instead of piling up. 0 disables a limit.
+MAX_ACTIVE_JOBS = int(os.getenv("MAX_ACTIVE_JOBS", "32"))
+MAX_QUEUE_DEPTH = int(os.getenv("MAX_QUEUE_DEPTH", "16"))
+
+# How often a request waiting for its tile checks whether the client is still connected.
+# A tile nobody waits for anymore is cancelled, mid-sampling if need be.
+DISCONNECT_POLL_INTERVAL = 0.25
+
+# Streaming requests (stream=true) get an approximate low-resolution preview every PREVIEW_EVERY sampler steps
+PREVIEW_EVERY = 4
+
+# Serve a recorded world (mock/<name>) with simulated latency instead of running the models.
+# MOCK_WORLD= (empty) runs the real pipeline.
+mock = os.getenv("MOCK_WORLD", "city") or None  # ["city", "desert", "japan"]
+# Multiplies the simulated LLM and sampling durations, 0 for none
+MOCK_LATENCY_SCALE = float(os.getenv("MOCK_LATENCY_SCALE", "1"))
 
 NECESSARY_PROMPTS = (
     "A 2D game sprite, Pixel art, 64 bit, top down view, 2d tilemap, game, flat design"
 )
 
+DEFAULT_INPAINT_PROMPT = "A 2D game sprite, natural, Pixel art, 64 bit, top-view, 2d game map, urban, dessert, town, open world, connected, smooth transition, natural"
 
-gpu_lock = threading.Lock()
+DEFAULT_NEG_PROMPT = "3D, walls, unnatural, rough, unrealistic, closed area, towered, limited, side view, watermark, signature, artist, inappropriate content, objects, game ui, ui, buttons, walled, grid, character, white edges, single portrait, edged, island, bottom ui, bottom blocks, player, creatures, life, uneven roads, human, living, perspective, 3D, depth, shadows, vanishing point, isometric, gradient shading, foreshortening, parallax, skewed angles, distorted, photorealistic, realistic lighting, complex shading, dynamic lighting, occlusion"
 
+# LLM responses are recorded on disk. With REUSE_LLM_RESPONSES a request that was
+# already answered (same history, same sampling params) skips the API call.
+LLM_CACHE_PATH = "llm_cache.sqlite3"
+LLM_CACHE_MAX_ENTRIES = 10000
+REUSE_LLM_RESPONSES = os.getenv("REUSE_LLM_RESPONSES", "0") == "1"
 
-# Create a custom LockableSemaphore class
-class LockableSemaphore(Semaphore):
-    def __enter__(self):
-        self.acquire()
+# Generated tiles are persisted here and served again without sampling
+TILE_STORE_DIR = "tiles"
+# ... and drawn into a memory-mapped canvas per world, which inpaint sources and minimaps are read from
+CANVAS_DIR = "canvas"
+# Prompt of every tile sampled since startup, written on shutdown
+TILE_PROMPTS_PATH = "tile_prompts.json"
+TILE_CACHE_BYTES = 64 * 1024 * 1024
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        self.release()
-        return False
+# Speculative generation of the tiles around the last requested one while the sampler is idle
+PREFETCH_ENABLED = True
+PREFETCH_RING = 1
+PREFETCH_MAX_INFLIGHT = 2
+PREFETCH_PER_REQUEST = 4
 
+# Threads encoding tiles (PNG for the store, plus whatever format a client asks for)
+ENCODER_WORKERS = 2
 
-gpu_semaphore = LockableSemaphore(value=2)
+CHECKPOINT_NAME = "pixelXL_xl.safetensors"
+LORA_NAME = "pixel-art-xl-v1.1.safetensors"
+# Load the checkpoint with the LoRA already fused into its weights (built once into
+# FUSED_MODEL_DIR, then memory-mapped) instead of patching the LoRA in on every boot
+FUSE_LORA = True
+FUSED_MODEL_DIR = "fused_models"
 
+# Sample in this many worker processes sharing the memory-mapped fused weights, instead of
+# in the server process. Jobs are routed by tile key. 0 keeps sampling in-process.
+SAMPLER_WORKERS = int(os.getenv("SAMPLER_WORKERS", "0"))
 
-def generate_tile_id(x: int, y: int):
-    return f"{x}_{y}"
+# Concurrent LLM requests (pooled keep-alive connections) in the prompt stage
+LLM_MAX_CONNECTIONS = 8
 
+# Upper bound on the memory held by cached CLIP conditionings
+CONDITIONING_CACHE_BYTES = 256 * 1024 * 1024
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    import_custom_nodes()
+# Sampled latents of generated tiles, kept in memory up to LATENT_CACHE_BYTES and on disk under
+# LATENT_CACHE_DIR up to LATENT_CACHE_DISK_BYTES (least recently used deleted first).
+# Inpaint latents are assembled from the neighbours' instead of VAE encoding the source.
+LATENT_CACHE_DIR = "latents"
+LATENT_CACHE_BYTES = 256 * 1024 * 1024
+LATENT_CACHE_DISK_BYTES = 4 * 1024 * 1024 * 1024
 
-    with torch.inference_mode():
-        checkpointloadersimple = NODE_CLASS_MAPPINGS["CheckpointLoaderSimple"]()
-        checkpointloadersimple_1 = checkpointloadersimple.load_checkpoint(
-            ckpt_name="pixelXL_xl.safetensors"
-        )
-        loadimage = NODE_CLASS_MAPPINGS["LoadImage"]()
 
-        emptylatentimage = NODE_CLASS_MAPPINGS["EmptyLatentImage"]()
-        emptylatentimage_2 = emptylatentimage.generate(
-            width=768, height=768, batch_size=1
-        )
+def generate_tile_id(x: int, y: int):
+    return f"{x}_{y}"
 
-        loraloader = NODE_CLASS_MAPPINGS["LoraLoader"]()
-        loraloader_6 = loraloader.load_lora(
-            lora_name="pixel-art-xl-v1.1.safetensors",
-            strength_model=1,
-            strength_clip=1,
-            model=get_value_at_index(checkpointloadersimple_1, 0),
-            clip=get_value_at_index(checkpointloadersimple_1, 1),
-        )
 
-        cliptextencode = NODE_CLASS_MAPPINGS["CLIPTextEncode"]()
+def generate_world_id(seed_prompt: str):
+    """
+    Worlds are identified by the scene description the player started them with.
+    """
+    return hashlib.sha1(" ".join(seed_prompt.split()).encode("utf-8")).hexdigest()[:16]
+
+
+def load_mock_package(tile_store: TileStore):
+    """
+    The recorded world and its stand-ins for the LLM and the pipeline, no model is loaded.
+    """
+    world = MockWorld(mock)
+    latency = LatencyModel(scale=MOCK_LATENCY_SCALE)
+    app.package = {
+        "gpt_helper": MockChat(world, latency),
+        "tile_prompts": {},
+        "tile_store": tile_store,
+        "pipeline": MockPipeline(world, latency),
+    }
+
+
+def create_gpt_helper():
+    return GPTHelper.AsyncGPTAPIHelper(
+        max_connections=LLM_MAX_CONNECTIONS,
+        cache=PromptCache(LLM_CACHE_PATH, max_entries=LLM_CACHE_MAX_ENTRIES),
+        reuse_cached=REUSE_LLM_RESPONSES,
+    )
 
-        ksampler_efficient = NODE_CLASS_MAPPINGS["KSampler (Efficient)"]()
 
-        vaeencodeforinpaint = NODE_CLASS_MAPPINGS["VAEEncodeForInpaint"]()
+def load_package(tile_store: TileStore):
+    # ComfyUI (and transformers, for the local LLM) are only needed by the real backend
+    from image_gen import import_custom_nodes
 
-        gpt_helper = GPTHelper.GPTAPIHelper()
+    import_custom_nodes()
 
-        # llm_helper = LLMHelper.LLMHelper()
+    # import LLMHelper
+    # llm_helper = LLMHelper.LLMHelper()
+
+    app.package = {
+        **load_models(
+            CHECKPOINT_NAME, LORA_NAME, fuse_lora=FUSE_LORA, fused_model_dir=FUSED_MODEL_DIR
+        ),
+        "gpt_helper": create_gpt_helper(),
+        "tile_prompts": {},
+        "tile_store": tile_store,
+        # "llm_helper": llm_helper,
+    }
+
+    pipeline = TilePipeline(
+        app.package,
+        conditioning_cache=ConditioningCache(max_bytes=CONDITIONING_CACHE_BYTES),
+        latent_cache=LatentCache(
+            LATENT_CACHE_DIR,
+            max_bytes=LATENT_CACHE_BYTES,
+            max_disk_bytes=LATENT_CACHE_DISK_BYTES,
+        ),
+    )
+    with torch.inference_mode():
+        # Every request uses the default negative prompt unless told otherwise
+        pipeline.encode_text(DEFAULT_NEG_PROMPT)
+    app.package["pipeline"] = pipeline
+
+
+def load_pool_package(tile_store: TileStore):
+    """
+    Front process of the worker-pool mode: the models live in SAMPLER_WORKERS sampler processes.
+    """
+    pool = SamplerPool(
+        "pipeline:build_worker_pipeline",
+        num_workers=SAMPLER_WORKERS,
+        factory_kwargs={
+            "ckpt_name": CHECKPOINT_NAME,
+            "lora_name": LORA_NAME,
+            "fused_model_dir": FUSED_MODEL_DIR,
+            "conditioning_cache_bytes": CONDITIONING_CACHE_BYTES,
+            "latent_cache_dir": LATENT_CACHE_DIR,
+            "latent_cache_bytes": LATENT_CACHE_BYTES,
+            "latent_cache_disk_bytes": LATENT_CACHE_DISK_BYTES,
+            "warm_prompts": [DEFAULT_NEG_PROMPT],
+        },
+    )
+    pool.start()
+    app.package = {
+        "gpt_helper": create_gpt_helper(),
+        "tile_prompts": {},
+        "tile_store": tile_store,
+        "pipeline": pool,
+    }
 
-        tile_prompts = {}
 
-        app.package = {
-            "checkpoint": checkpointloadersimple_1,
-            "clip_encode": cliptextencode,
-            "empty_latent_image": emptylatentimage_2,
-            "lora_loader": loraloader_6,
-            "ksampler": ksampler_efficient,
-            "load_image": loadimage,
-            "vae_encode_for_inpaint": vaeencodeforinpaint,
-            "gpt_helper": gpt_helper,
-            "tile_prompts": tile_prompts,
-            # "llm_helper": llm_helper,
-        }
-        # print(app.package)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if mock is not None:
+        # Keep recorded tiles apart from generated ones
+        tile_store = TileStore(
+            os.path.join(TILE_STORE_DIR, "mock"), hot_cache_bytes=TILE_CACHE_BYTES
+        )
+        load_mock_package(tile_store)
+    elif SAMPLER_WORKERS > 0:
+        tile_store = TileStore(TILE_STORE_DIR, hot_cache_bytes=TILE_CACHE_BYTES)
+        load_pool_package(tile_store)
+    else:
+        tile_store = TileStore(TILE_STORE_DIR, hot_cache_bytes=TILE_CACHE_BYTES)
+        load_package(tile_store)
+    gpt_helper = app.package["gpt_helper"]
+    tile_prompts = app.package["tile_prompts"]
+    canvas_store = CanvasStore(
+        os.path.join(CANVAS_DIR, "mock") if mock is not None else CANVAS_DIR
+    )
+    app.package["canvas"] = canvas_store
+    encoder = TileEncoder(max_workers=ENCODER_WORKERS)
+    app.package["encoder"] = encoder
+
+    scheduler = JobScheduler(
+        batch_handler=run_tile_batch,
+        batch_window=BATCH_WINDOW,
+        max_batch_size=MAX_BATCH_SIZE,
+        on_finish=observe_job,
+        # one dispatching thread per sampler process
+        num_workers=max(1, SAMPLER_WORKERS) if mock is None else 1,
+        max_active_jobs=MAX_ACTIVE_JOBS or None,
+        max_queue_depth=MAX_QUEUE_DEPTH or None,
+    )
+    scheduler.start()
+    app.package["scheduler"] = scheduler
+    app.package["tile_jobs"] = TileJobs(scheduler)
+
+    prefetcher = Prefetcher(
+        scheduler,
+        tile_store,
+        submit_server_side_inpaint,
+        ring_radius=PREFETCH_RING,
+        max_inflight=PREFETCH_MAX_INFLIGHT,
+        max_per_request=PREFETCH_PER_REQUEST,
+        enabled=PREFETCH_ENABLED,
+    )
+    app.package["prefetcher"] = prefetcher
+
+    refiner = Refiner(
+        scheduler,
+        submit_refinement,
+        refine_from=REFINE_FROM,
+        enabled=REFINE_ENABLED,
+    )
+    refiner.start()
+    app.package["refiner"] = refiner
 
     # Startup logic
     print("Application startup")
     yield
     # Shutdown logic
+    prefetcher.cancel_all()
+    refiner.stop()
+    scheduler.stop(timeout=60)
+    # Let pending PNGs reach the store
+    encoder.shutdown(wait=True)
+    if isinstance(app.package["pipeline"], SamplerPool):
+        app.package["pipeline"].stop()
+    elif isinstance(app.package["pipeline"], TilePipeline):
+        # Let pending latents reach the spill directory
+        app.package["pipeline"].latent_cache.close()
+    await gpt_helper.aclose()
+    if gpt_helper.cache is not None:
+        gpt_helper.cache.close()
+    tile_store.close()
+    canvas_store.close()
     # save the dictionary to a file
-    with open("tile_prompts.json", "w") as f:
+    with open(TILE_PROMPTS_PATH, "w") as f:
         json.dump(tile_prompts, f)
     print("Application shutdown haha!")
 
@@ -124,144 +364,400 @@ async def lifespan(app: FastAPI):
 app = FastAPI(lifespan=lifespan)
 
 
+def route_template(scope) -> str:
+    """
+    Route template of a request, not its raw path, so /jobs/{job_id} stays one series.
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return route.path
+    return "unmatched"
+
+
+@app.middleware("http")
+async def record_request_metrics(request: Request, call_next):
+    start = time.perf_counter()
+    endpoint = route_template(request.scope)
+    # Stage timings of the request carry its route too, handlers add the cache result
+    STAGE_LABELS.set((endpoint, "none"))
+    response = await call_next(request)
+    cache = response.headers.get("X-Tile-Cache", "none")
+    REQUEST_SECONDS.observe(time.perf_counter() - start, endpoint=endpoint, cache=cache)
+    REQUESTS_TOTAL.inc(endpoint=endpoint, cache=cache, status=str(response.status_code))
+    return response
+
+
 @app.get("/")
 def read_root():
     return {"Hello": "World"}
 
 
-@app.get("/gen")
-def gen(
-    pos_prompt: str = "A 2D game sprite, Pixel art, 64 bit, top down view, 2d game map, urban, desert, town, open world",
-    neg_prompt: str = "3D, walls, unnatural, rough, unrealistic, closed area, towered, limited, side view, watermark, signature, artist, inappropriate content, objects, game ui, ui, buttons, walled, grid, character, white edges, single portrait, edged, island, bottom ui, bottom blocks, player, creatures, life, uneven roads, human, living, perspective, 3D, depth, shadows, vanishing point, isometric, gradient shading, foreshortening, parallax, skewed angles, distorted, photorealistic, realistic lighting, complex shading, dynamic lighting, occlusion",
-):
-    # llm_helper = app.package["llm_helper"]
-    gpt_helper = app.package["gpt_helper"]
-    tile_prompts = app.package["tile_prompts"]
-    pos_prompt = (
-        "Help me create a top down view image prompt based on this: " + pos_prompt
-    )
-    if DEBUG:
-        with open("output.png", "rb") as f:
-            return Response(content=f.read(), media_type="image/png")
+def negotiate(output_format: str, accept: str) -> str:
+    """
+    :raises ValueError: If the format query parameter names an unknown format.
+    """
+    return negotiate_format(output_format, accept or "")
 
-    if mock is not None:
-        # find 0_0.png in mock/city
-        with open(f"mock/{mock}/tile_prompts.json", "rb") as f:
-            # find 0_0 key in the json file
-            file = json.load(f)
-            prompt = file.get("0_0")
-            print(prompt)
-        with open(f"mock/{mock}/0_0.png", "rb") as f:
-            time.sleep(3)
-            return Response(content=f.read(), media_type="image/png")
 
-    if USE_LLM:
-        # pos_prompt = NECESSARY_PROMPTS + llm_helper.chat(pos_prompt)
-        pos_prompt = NECESSARY_PROMPTS + gpt_helper.chat(pos_prompt)
-    # for efficiency purposes we will return existing image
+# Worlds are scoped per client: /gen answers with its world (X-World header), later requests name it
+WORLD_REQUIRED = "world is required, send the one /gen answered with in its X-World header"
 
-    with torch.inference_mode():
-        checkpoint = app.package["checkpoint"]
-        loraloader = app.package["lora_loader"]
-        # ksampler = app.package["ksampler"]
-        ksampler = NODE_CLASS_MAPPINGS["KSampler"]()
-        vaedecode = NODE_CLASS_MAPPINGS["VAEDecode"]()
-        latent_image = app.package["empty_latent_image"]
-        clip_encode = app.package["clip_encode"]
-
-        positive_encode = clip_encode.encode(
-            text=pos_prompt,
-            clip=get_value_at_index(loraloader, 1),
-        )
 
-        negative_encode = clip_encode.encode(
-            text=neg_prompt,
-            clip=get_value_at_index(loraloader, 1),
-        )
+def check_priority(priority: int) -> int:
+    """
+    Clients only pick among foreground priorities, PRIORITY_PREFETCH and up are the server's own background work.
 
-        ksampler_8 = ksampler.sample(
-            seed=random.randint(1, 2**64),
-            steps=STEPS,
-            cfg=2.98,
-            sampler_name="ddim",
-            scheduler="karras",
-            denoise=1,
-            model=get_value_at_index(loraloader, 0),
-            positive=get_value_at_index(positive_encode, 0),
-            negative=get_value_at_index(negative_encode, 0),
-            latent_image=get_value_at_index(latent_image, 0),
+    :raises ValueError: If priority is outside [PRIORITY_URGENT, PRIORITY_PREFETCH).
+    """
+    if not PRIORITY_URGENT <= priority < PRIORITY_PREFETCH:
+        raise ValueError(
+            f"priority must be between {PRIORITY_URGENT} and {PRIORITY_PREFETCH - 1}, got {priority}"
         )
+    return priority
+
+
+def job_status(job):
+    scheduler = app.package["scheduler"]
+    position = scheduler.queue_position(job)
+    status = {**job.to_dict(), "queue_position": position}
+    if job.payload is not None:
+        status["quality"] = job.payload.quality
+    if position >= 0:
+        status["eta_seconds"] = round(scheduler.estimate_wait(position), 1)
+    return status
+
+
+def respond_busy(error: QueueFull):
+    return JSONResponse(
+        content={
+            "error": str(error),
+            "queue_position": error.position,
+            "eta_seconds": round(error.eta, 1),
+        },
+        status_code=429,
+        headers={"Retry-After": str(max(1, math.ceil(error.retry_after)))},
+    )
 
-        vaedecode_9 = vaedecode.decode(
-            samples=get_value_at_index(ksampler_8, 0),
-            vae=get_value_at_index(checkpoint, 2),
+
+def choose_tier(
+    quality: str = "",
+    deadline: Optional[float] = None,
+    priority: int = PRIORITY_NORMAL,
+    deferred: bool = True,
+) -> QualityTier:
+    """
+    Quality tier of a tile about to be submitted.
+
+    :param quality: Tier name, or "" / "auto" to pick one from the deadline.
+    :param deadline: Seconds the client is willing to wait for the tile, DEFAULT_DEADLINE when None.
+        Without either, DEFAULT_QUALITY.
+    :param deferred: Whether the job has a prompt stage, which counts against the deadline.
+    :raises ValueError: If quality names no tier.
+    """
+    if quality and quality != "auto":
+        tier = QUALITY_TIERS.get(quality)
+        if tier is None:
+            raise ValueError(
+                f"Unknown quality {quality!r}, expected one of {', '.join(QUALITY_TIERS)} or auto"
+            )
+        choice = "requested"
+    elif deadline or DEFAULT_DEADLINE:
+        scheduler = app.package["scheduler"]
+        tier = select_tier(
+            list(QUALITY_TIERS.values()),
+            deadline or DEFAULT_DEADLINE,
+            lambda tier: scheduler.estimate_completion(priority, tier.cost, deferred),
         )
+        choice = "deadline"
+    else:
+        tier = QUALITY_TIERS[DEFAULT_QUALITY]
+        choice = "default"
+    QUALITY_TOTAL.inc(tier=tier.name, choice=choice)
+    return tier
+
+
+def release_job(job):
+    """
+    The client waiting for job went away: stop it, or hand it back to the prefetcher if it was a claimed prefetch.
+    Jobs other clients still wait for (see TileJobs) are left alone.
+    """
+    if not app.package["tile_jobs"].leave(job):
+        return
+    scheduler = app.package["scheduler"]
+    if job.kind == "prefetch":
+        # Its tile still lands in the store, it just stops jumping the queue
+        scheduler.reprioritize(job, PRIORITY_PREFETCH)
+    elif scheduler.cancel(job, abort_running=True):
+        print(f"Cancelled job {job.id} ({job.kind}), its client disconnected")
+
+
+async def wait_for_job(job, request: Request):
+    """
+    Await the result of a job, releasing the job if the client disconnects first.
+
+    :return: The result, or None if the client disconnected.
+    :raises asyncio.CancelledError: If the job was cancelled.
+    """
+    result = asyncio.ensure_future(app.package["scheduler"].wait(job))
+    try:
+        while True:
+            done, _ = await asyncio.wait({result}, timeout=DISCONNECT_POLL_INTERVAL)
+            if done:
+                return result.result()
+            if await request.is_disconnected():
+                release_job(job)
+                return None
+    finally:
+        result.cancel()
+
+
+async def respond_with_job(
+    job, wait: bool, fmt: str = DEFAULT_FORMAT, request: Optional[Request] = None
+):
+    """
+    Either await the job and return its tile, or hand the job id back so the client can await it later.
+
+    :param request: The client's request. When given, the job is released (see release_job) if the client disconnects.
+    """
+    scheduler = app.package["scheduler"]
+    if not wait:
+        return JSONResponse(content=job_status(job), status_code=202)
+    try:
+        if request is not None:
+            result = await wait_for_job(job, request)
+        else:
+            result = await scheduler.wait(job)
+    except asyncio.CancelledError:
+        if job.status != "cancelled":
+            raise
+        return JSONResponse(content={"error": "Job cancelled"}, status_code=409)
+    if result is None:
+        # Nobody is there to read it, 499 as in nginx's "client closed request"
+        return Response(status_code=499)
+    content = await app.package["encoder"].encode(result, fmt)
+    headers = {
+        "X-Tile-Cache": "miss",
+        "X-Tile-Format": fmt,
+        "X-Tile-Quality": job.payload.quality,
+    }
+    for stage, seconds in job.timings().items():
+        headers[f"X-{stage.capitalize()}-Time"] = f"{seconds:.4f}"
+    return Response(content=content, media_type=media_type(fmt), headers=headers)
+
+
+async def respond_with_stored_tile(record, fmt: str = DEFAULT_FORMAT):
+    set_stage_cache("hit")
+    content = await app.package["encoder"].transcode(record.png, fmt)
+    return Response(
+        content=content,
+        media_type=media_type(fmt),
+        headers={"X-Tile-Cache": "hit", "X-Tile-Format": fmt},
+    )
 
-        final_image = get_value_at_index(vaedecode_9, 0)[0]
-        final_image = 255.0 * final_image.cpu().numpy()
-        final_image = Image.fromarray(np.clip(final_image, 0, 255).astype(np.uint8))
 
-        img_bytes = BytesIO()
-        final_image.save(img_bytes, format="PNG")
-        img_bytes.seek(0)
-        print("Generated image for ", pos_prompt)
-        tile_prompts[generate_tile_id(0, 0)] = pos_prompt
+def sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
 
-    return StreamingResponse(img_bytes, media_type="image/png")
 
+def tile_event(content: bytes, fmt: str, cache: str, **extra) -> str:
+    return sse_event(
+        "tile",
+        {
+            "cache": cache,
+            "format": fmt,
+            "data": base64.b64encode(content).decode("ascii"),
+            **extra,
+        },
+    )
 
-async def wait_for_file(filepath: str, timeout: int = 10, interval: float = 0.5):
-    """Waits for the file to be available with a timeout."""
-    start_time = asyncio.get_event_loop().time()
-    while not os.path.exists(filepath):
-        await asyncio.sleep(interval)
-        if asyncio.get_event_loop().time() - start_time > timeout:
-            raise FileNotFoundError(
-                f"File {filepath} not found within {timeout} seconds."
-            )
 
+def stream_events(events, cache: str, headers: Optional[dict] = None):
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Tile-Cache": cache, **(headers or {})},
+    )
 
-@app.post("/inpaint")
-def inpaint(
-    image_file: UploadFile = File(...),
-    pos_prompt: str = Form(
-        "A 2D game sprite, natural, Pixel art, 64 bit, top-view, 2d game map, urban, dessert, town, open world, connected, smooth transition, natural"
-    ),
-    neg_prompt: str = Form(
-        "3D, walls, unnatural, rough, unrealistic, closed area, towered, limited, side view, watermark, signature, artist, inappropriate content, objects, game ui, ui, buttons, walled, grid, character, white edges, single portrait, edged, island, bottom ui, bottom blocks, player, creatures, life, uneven roads, human, living, perspective, 3D, depth, shadows, vanishing point, isometric, gradient shading, foreshortening, parallax, skewed angles, distorted, photorealistic, realistic lighting, complex shading, dynamic lighting, occlusion",
-    ),
-    source_x: int = Form(...),
-    source_y: int = Form(...),
-    target_x: int = Form(...),
-    target_y: int = Form(...),
-    extend_direction: str = Form(""),
-):
 
-    if DEBUG:
-        with open("output.png", "rb") as f:
-            return Response(content=f.read(), media_type="image/png")
+async def stream_stored_tile(record, fmt: str = DEFAULT_FORMAT, headers: Optional[dict] = None):
+    set_stage_cache("hit")
+    content = await app.package["encoder"].transcode(record.png, fmt)
+
+    async def events():
+        yield tile_event(content, fmt, "hit")
+
+    return stream_events(events(), "hit", headers)
+
+
+def stream_job(job, preview: PreviewStream, fmt: str = DEFAULT_FORMAT, headers: Optional[dict] = None):
+    """
+    Server-sent events of a job: "queued" with its status, "preview" every few sampler steps with an
+    approximate low-resolution PNG, then "tile" with the tile, or "error". Closing the stream releases the job.
+    """
+    scheduler = app.package["scheduler"]
+    encoder = app.package["encoder"]
+
+    async def events():
+        result = asyncio.ensure_future(scheduler.wait(job))
+        next_preview = asyncio.ensure_future(preview.next())
+        finished = False
+        try:
+            yield sse_event("queued", job_status(job))
+            while not result.done():
+                await asyncio.wait({result, next_preview}, return_when=asyncio.FIRST_COMPLETED)
+                if next_preview.done() and not result.done():
+                    step, total_steps, pixels = next_preview.result()
+                    next_preview = asyncio.ensure_future(preview.next())
+                    png = await asyncio.wrap_future(encoder.submit(encode_preview, pixels))
+                    yield sse_event(
+                        "preview",
+                        {
+                            "step": step,
+                            "total_steps": total_steps,
+                            "width": pixels.shape[1],
+                            "height": pixels.shape[0],
+                            "format": "png",
+                            "data": base64.b64encode(png).decode("ascii"),
+                        },
+                    )
+            finished = True
+            if result.cancelled():
+                yield sse_event("error", {"error": "Job cancelled"})
+                return
+            if result.exception() is not None:
+                yield sse_event("error", {"error": str(result.exception())})
+                return
+            content = await encoder.encode(result.result(), fmt)
+            yield tile_event(
+                content, fmt, "miss", quality=job.payload.quality, timings=job.timings()
+            )
+        finally:
+            next_preview.cancel()
+            result.cancel()
+            if not finished:
+                # The client closed the stream before the tile was ready
+                release_job(job)
+
+    return stream_events(events(), "miss", headers)
+
+
+def store_tile(request: TileRequest, image) -> bytes:
+    """
+    Runs on the encoder pool: encode the canonical PNG of a sampled tile and persist it.
+    """
+    png = encode_image(image, DEFAULT_FORMAT)
+    tile_store = app.package["tile_store"]
+    if request.refines is not None:
+        current = tile_store.get_record(request.world, *request.tile)
+        if current is None or current.digest != request.refines:
+            # Regenerated while the refinement was sampling, the newer tile stays
+            return png
+    tile_store.put(request.world, *request.tile, png, request.pos_prompt, request.seed)
+    with app.package["canvas"].use(request.world) as canvas:
+        canvas.write_tile(*request.tile, np.asarray(image))
+    app.package["refiner"].observe(request.world, *request.tile, request.quality)
+    return png
+
+
+def run_tile_batch(requests: List[TileRequest]) -> List[TileResult]:
+    """
+    Batch handler of the scheduler: samples every request in one KSampler call.
+
+    Encoding is handed to the encoder pool so the sampling worker can start the next batch right away.
+    Tiles cancelled by now are neither encoded nor stored, as their latents are not cached (see
+    TilePipeline.remember_latents): their jobs finish cancelled and nobody reads them.
+    """
+    pipeline = app.package["pipeline"]
+    tile_prompts = app.package["tile_prompts"]
+    encoder = app.package["encoder"]
+
+    images = pipeline.run_batch(requests)
+
+    results = []
+    for request, image in zip(requests, images):
+        if request.cancelled:
+            png = Future()
+            png.cancel()
+            results.append(TileResult(image, png))
+            continue
+        tile_prompts[generate_tile_id(*request.tile)] = request.pos_prompt
+        png = encoder.submit(
+            store_tile,
+            request,
+            image,
+            background=request.background,
+            stage_labels=request.stage_labels,
+        )
+        results.append(TileResult(image, png))
+    print(f"Sampled a batch of {len(requests)} {requests[0].kind} tile(s)")
+    return results
+
+
+async def prepare_gen_request(
+    world: str,
+    pos_prompt: str,
+    neg_prompt: str,
+    tier: QualityTier,
+    preview: Optional[PreviewStream] = None,
+) -> TileRequest:
+    """
+    Prompt stage of a /gen job, runs on the event loop while earlier jobs are sampling.
+    """
+    if USE_LLM:
+        # llm_helper = app.package["llm_helper"]
+        gpt_helper = app.package["gpt_helper"]
+        # pos_prompt = NECESSARY_PROMPTS + llm_helper.chat(pos_prompt)
+        with time_stage("llm"):
+            pos_prompt = NECESSARY_PROMPTS + await gpt_helper.achat(pos_prompt)
+
+    print("Queued gen request for ", pos_prompt)
+    return TileRequest(
+        kind="gen",
+        pos_prompt=pos_prompt,
+        neg_prompt=neg_prompt,
+        world=world,
+        tile=(0, 0),
+        steps=tier.steps,
+        cfg=2.98,
+        sampler_name=tier.sampler_name,
+        scheduler=tier.scheduler,
+        preview=preview,
+        quality=tier.name,
+        scale=tier.scale,
+    )
 
-    if mock is not None:
-        # find 0_0.png in mock/city
-        with open(f"mock/{mock}/tile_prompts.json", "rb") as f:
-            # find 0_0 key in the json file
-            file = json.load(f)
-            print("-------------------")
-            print("Prompt for ", target_x, target_y)
-            prompt = file.get(f"{target_x}_{target_y}")
-            print(prompt)
-        with open(f"mock/{mock}/{target_x}_{target_y}.png", "rb") as f:
-            time.sleep(3)
-            return Response(content=f.read(), media_type="image/png")
+
+async def prepare_inpaint_request(
+    world: str,
+    pixels: torch.Tensor,
+    mask: torch.Tensor,
+    pos_prompt: str,
+    neg_prompt: str,
+    source_x: int,
+    source_y: int,
+    target_x: int,
+    target_y: int,
+    extend_direction: str,
+    tier: QualityTier,
+    preview: Optional[PreviewStream] = None,
+    background: bool = False,
+) -> TileRequest:
+    """
+    Prompt stage of an /inpaint job, runs on the event loop while earlier jobs are sampling.
+
+    :param background: Nobody is waiting for the tile yet, see TileRequest.
+    """
     gpt_helper = app.package["gpt_helper"]
     # llm_helper = app.package["llm_helper"]
     tile_prompts = app.package["tile_prompts"]
+    tile_store = app.package["tile_store"]
 
-    prev_prompt = app.package["tile_prompts"].get(
-        generate_tile_id(source_x, source_y), ""
-    )
-
-    print("Got inpaint request for tile ", target_x, target_y)
+    source = tile_store.get_record(world, source_x, source_y)
+    if source is not None:
+        prev_prompt = source.prompt
+    else:
+        prev_prompt = tile_prompts.get(generate_tile_id(source_x, source_y), "")
 
     if USE_LLM:
         pos_prompt = (
@@ -274,91 +770,951 @@ def inpaint(
         )
 
         # pos_prompt = NECESSARY_PROMPTS + llm_helper.chat(pos_prompt)
-        pos_prompt = NECESSARY_PROMPTS + gpt_helper.chat(pos_prompt)
-
-    # Read the image file
-    contents = image_file.file.read()
-    if not image_file.content_type.startswith("image/"):
-        return JSONResponse(content={"error": "Invalid file type"}, status_code=400)
-
-    # Save to temp file
-    temp_filename = "temp" + str(target_x) + "_" + str(target_y) + ".png"
-    ComfyUI_image_dir = "ComfyUI/input/"
-    temp_filepath = ComfyUI_image_dir + temp_filename
-    with open(temp_filepath, "wb") as f:
-        f.write(contents)
-
-    # Ensure file is available (if needed)
-    if not os.path.exists(temp_filepath):
-        return JSONResponse(
-            content={"error": "File not found after write"}, status_code=500
+        with time_stage("llm"):
+            pos_prompt = NECESSARY_PROMPTS + await gpt_helper.achat(pos_prompt)
+
+    return TileRequest(
+        kind="inpaint",
+        pos_prompt=pos_prompt,
+        neg_prompt=neg_prompt,
+        world=world,
+        tile=(target_x, target_y),
+        steps=tier.steps,
+        cfg=3,
+        sampler_name=tier.sampler_name,
+        scheduler=tier.scheduler,
+        pixels=pixels,
+        mask=mask,
+        preview=preview,
+        quality=tier.name,
+        scale=tier.scale,
+        background=background,
+    )
+
+
+def build_inpaint_source(world: str, target_x: int, target_y: int):
+    """
+    Compose the inpaint source of a tile from its stored orthogonal neighbours, the way MapGenerator.cs does,
+    reading their overlapping halves straight from the world canvas.
+
+    :return: (pixels, mask, source tile, extend direction), or None if the stored neighbours do not allow it.
+    """
+    tile_store = app.package["tile_store"]
+    with app.package["canvas"].use(world) as canvas:
+        neighbours = []
+        for offset in ORTHOGONAL_OFFSETS:
+            source = (target_x - offset[0], target_y - offset[1])
+            if not canvas.has_tile(*source):
+                # Stored before the canvas existed: draw it once
+                record = tile_store.get(world, *source)
+                if record is None:
+                    continue
+                canvas.write_tile(*source, decode_rgba(record.png))
+            neighbours.append(source)
+        if not neighbours:
+            return None
+
+        built = canvas.inpaint_source(target_x, target_y)
+    if built is None:
+        return None
+    rgba, direction = built
+    pixels, mask = rgba_to_inpaint_tensors(rgba)
+    return pixels, mask, neighbours[0], direction
+
+
+async def submit_server_side_inpaint(
+    world: str,
+    target_x: int,
+    target_y: int,
+    priority: int = PRIORITY_PREFETCH,
+    kind: str = "prefetch",
+    pos_prompt: str = DEFAULT_INPAINT_PROMPT,
+    neg_prompt: str = DEFAULT_NEG_PROMPT,
+    preview: Optional[PreviewStream] = None,
+    tier: Optional[QualityTier] = None,
+):
+    """
+    Queue an inpaint job whose source is built from stored tiles instead of a client upload.
+
+    :param tier: Quality tier, DEFAULT_QUALITY when None.
+    :return: The job, or None if no stored neighbour allows building the source.
+    :raises QueueFull: If the job would exceed the admission limits.
+    """
+    built = await asyncio.to_thread(build_inpaint_source, world, target_x, target_y)
+    if built is None:
+        return None
+    pixels, mask, (source_x, source_y), direction = built
+    tier = tier or QUALITY_TIERS[DEFAULT_QUALITY]
+    background = priority >= PRIORITY_PREFETCH
+    if background:
+        # Not sampled for the request that triggered it, its stages count under the job kind
+        STAGE_LABELS.set((kind, "miss"))
+    return app.package["scheduler"].submit_deferred(
+        prepare_inpaint_request(
+            world,
+            pixels,
+            mask,
+            pos_prompt,
+            neg_prompt,
+            source_x,
+            source_y,
+            target_x,
+            target_y,
+            direction,
+            tier,
+            preview,
+            background=background,
+        ),
+        priority=priority,
+        kind=kind,
+        cost=tier.cost,
+    )
+
+
+async def submit_refinement(world: str, x: int, y: int):
+    """
+    Queue the refinement of a stored tile at REFINE_QUALITY: sampled again from the tile itself with
+    REFINE_DENOISE, in the share of the tier's steps that denoise covers.
+
+    :return: The job, or None if the tile is not stored.
+    """
+    record = await asyncio.to_thread(app.package["tile_store"].get, world, x, y)
+    if record is None:
+        return None
+    pixels, _ = await asyncio.to_thread(decode_inpaint_source, record.png)
+    tier = QUALITY_TIERS[REFINE_QUALITY]
+    STAGE_LABELS.set(("refine", "miss"))
+    request = TileRequest(
+        kind="refine",
+        pos_prompt=record.prompt,
+        neg_prompt=DEFAULT_NEG_PROMPT,
+        world=world,
+        tile=(x, y),
+        steps=max(1, round(tier.steps * REFINE_DENOISE)),
+        cfg=3,
+        sampler_name=tier.sampler_name,
+        scheduler=tier.scheduler,
+        denoise=REFINE_DENOISE,
+        seed=record.seed,
+        pixels=pixels,
+        quality=tier.name,
+        refines=record.digest,
+        scale=tier.scale,
+        background=True,
+    )
+    QUALITY_TOTAL.inc(tier=tier.name, choice="refine")
+    return app.package["scheduler"].submit(
+        payload=request,
+        batch_key=request.batch_key,
+        priority=PRIORITY_REFINE,
+        kind="refine",
+        cost=tier.cost * REFINE_DENOISE,
+    )
+
+
+async def read_upload(image_file: UploadFile) -> bytes:
+    """
+    :raises ValueError: If the upload is not an image.
+    """
+    if not (image_file.content_type or "").startswith("image/"):
+        raise ValueError("Invalid file type")
+    return await image_file.read()
+
+
+async def start_inpaint(
+    world: str,
+    read_source: Callable[[], Awaitable[bytes]],
+    pos_prompt: str,
+    neg_prompt: str,
+    source_x: int,
+    source_y: int,
+    target_x: int,
+    target_y: int,
+    extend_direction: str,
+    priority: int,
+    regenerate: bool,
+    preview: Optional[PreviewStream] = None,
+    quality: str = "",
+    deadline: Optional[float] = None,
+):
+    """
+    Serve an inpaint request from the store, join the job another request or the prefetcher has in flight
+    for the tile, or queue a new job.
+
+    :param read_source: Coroutine function returning the uploaded inpaint source (see read_upload), only
+        called when the tile has to be sampled.
+    :param preview: Stream for the previews of a newly queued job. A joined job only streams previews
+        if its prompt stage is already done and nobody streams them yet.
+    :param quality: Quality tier of a new job, see choose_tier.
+    :param deadline: Seconds the client is willing to wait, see choose_tier.
+
+    :return: (stored record, None) or (None, job).
+    :raises ValueError: If the uploaded image or the quality cannot be used.
+    :raises QueueFull: If a new job would exceed the admission limits.
+    """
+    prefetcher = app.package["prefetcher"]
+    tile_jobs = app.package["tile_jobs"]
+    key = (world, target_x, target_y, "inpaint")
+    if not regenerate:
+        record = await asyncio.to_thread(
+            app.package["tile_store"].get, world, target_x, target_y
         )
+        if record is not None:
+            prefetcher.record_hit(world, target_x, target_y)
+            set_stage_cache("hit")
+            return record, None
+
+        # Requested by another client right now: wait for the same job
+        job = tile_jobs.join(key, priority, preview)
+        if job is not None:
+            set_stage_cache("miss")
+            return None, job
+
+        # Being prefetched right now: promote that job instead of sampling the tile twice
+        job = prefetcher.claim(world, target_x, target_y, priority)
+        if job is not None:
+            set_stage_cache("miss")
+            if job.payload is not None:
+                # Somebody waits for its PNG now
+                job.payload.background = False
+                job.payload.stage_labels = STAGE_LABELS.get()
+                if preview is not None:
+                    job.payload.preview = preview
+            tile_jobs.add(key, job)
+            return None, job
+
+    # Turn the request away before decoding anything if it cannot be queued anyway
+    app.package["scheduler"].admit(priority)
+    tier = choose_tier(quality, deadline, priority)
+    set_stage_cache("miss")
+
+    contents = await read_source()
+    try:
+        # Decoded once, in memory, into the tensors VAEEncodeForInpaint expects
+        with time_stage("decode_upload"):
+            pixels, mask = await asyncio.to_thread(decode_inpaint_source, contents)
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Invalid image: {e}")
+
+    # Submitted by another request while this one was decoding
+    job = None if regenerate else tile_jobs.join(key, priority, preview)
+    if job is not None:
+        return None, job
+    job = app.package["scheduler"].submit_deferred(
+        prepare_inpaint_request(
+            world,
+            pixels,
+            mask,
+            pos_prompt,
+            neg_prompt,
+            source_x,
+            source_y,
+            target_x,
+            target_y,
+            extend_direction,
+            tier,
+            preview,
+        ),
+        priority=priority,
+        kind="inpaint",
+        cost=tier.cost,
+    )
+    tile_jobs.add(key, job)
+    return None, job
 
-    # if DEBUG:
-    #     # we will return existing image for efficiency purposes
-    #     with open("output.png", "rb") as f:
-    #         time.sleep(2)
-    #         return Response(content=f.read(), media_type="image/png")
-    with gpu_lock:
-        with torch.inference_mode():
-            checkpoint = app.package["checkpoint"]
-            loraloader = app.package["lora_loader"]
-            # ksampler = app.package["ksampler"]
-            ksampler = NODE_CLASS_MAPPINGS["KSampler"]()
-            vaedecode = NODE_CLASS_MAPPINGS["VAEDecode"]()
-            clip_encode = app.package["clip_encode"]
-            load_image = app.package["load_image"]
-            vae_encode_for_inpaint = app.package["vae_encode_for_inpaint"]
-
-            loadimage_193 = load_image.load_image(image=temp_filename)
-
-            vaeencodeforinpaint_213 = vae_encode_for_inpaint.encode(
-                grow_mask_by=3,
-                pixels=get_value_at_index(loadimage_193, 0),
-                vae=get_value_at_index(checkpoint, 2),
-                mask=get_value_at_index(loadimage_193, 1),
-            )
 
-            positive_encode = clip_encode.encode(
-                text=pos_prompt,
-                clip=get_value_at_index(loraloader, 1),
-            )
+@app.get("/gen")
+async def gen(
+    request: Request,
+    pos_prompt: str = "A 2D game sprite, Pixel art, 64 bit, top down view, 2d game map, urban, desert, town, open world",
+    neg_prompt: str = DEFAULT_NEG_PROMPT,
+    priority: int = PRIORITY_NORMAL,
+    wait: bool = True,
+    world: str = "",
+    regenerate: bool = False,
+    stream: bool = False,
+    quality: str = "",
+    deadline: Optional[float] = None,
+    output_format: str = Query("", alias="format"),
+    accept: str = Header(""),
+):
+    """
+    :param priority: Lower is served first, from PRIORITY_URGENT (0) to PRIORITY_PREFETCH - 1 (99).
+        The same range applies to /inpaint, /inpaint_batch and /session.
+    :param stream: Answer with server-sent events instead: previews while sampling, then the tile (see stream_job).
+    :param quality: Quality tier (lowres, draft, normal or final), or auto to pick the best one the deadline allows.
+    :param deadline: Seconds the client is willing to wait for a tile that has to be sampled. Draft tiles are
+        refined later, fetching the tile again returns the refined one.
+    :param output_format: png (default), png-fast, png-palette, webp or rgba. Without it the Accept header decides.
+    """
+    try:
+        fmt = negotiate(output_format, accept)
+        check_priority(priority)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    world = world or generate_world_id(pos_prompt)
+    pos_prompt = (
+        "Help me create a top down view image prompt based on this: " + pos_prompt
+    )
+    if DEBUG:
+        with open("output.png", "rb") as f:
+            return Response(content=f.read(), media_type="image/png")
 
-            negative_encode = clip_encode.encode(
-                text=neg_prompt,
-                clip=get_value_at_index(loraloader, 1),
+    prefetcher = app.package["prefetcher"]
+    if not regenerate:
+        record = await asyncio.to_thread(app.package["tile_store"].get, world, 0, 0)
+        if record is not None:
+            app.package["tile_prompts"][generate_tile_id(0, 0)] = record.prompt
+            prefetcher.observe(world, 0, 0)
+            if stream:
+                return await stream_stored_tile(record, fmt, {"X-World": world})
+            response = await respond_with_stored_tile(record, fmt)
+            response.headers["X-World"] = world
+            return response
+
+    scheduler = app.package["scheduler"]
+    tile_jobs = app.package["tile_jobs"]
+    key = (world, 0, 0, "gen")
+    preview = PreviewStream(PREVIEW_EVERY) if stream else None
+    # Before the job's prompt stage is created, it takes the labels along
+    set_stage_cache("miss")
+    try:
+        # Requested by another client right now: wait for the same job
+        job = None if regenerate else tile_jobs.join(key, priority, preview)
+        if job is None:
+            tier = choose_tier(quality, deadline, priority)
+            job = scheduler.submit_deferred(
+                prepare_gen_request(world, pos_prompt, neg_prompt, tier, preview),
+                priority=priority,
+                kind="gen",
+                cost=tier.cost,
             )
+            tile_jobs.add(key, job)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except QueueFull as e:
+        response = respond_busy(e)
+        response.headers["X-World"] = world
+        return response
+    if stream:
+        prefetcher.observe(world, 0, 0)
+        return stream_job(job, preview, fmt, {"X-World": world})
+    response = await respond_with_job(job, wait, fmt, request)
+    response.headers["X-World"] = world
+    prefetcher.observe(world, 0, 0)
+    return response
+
+
+@app.post("/inpaint")
+async def inpaint(
+    request: Request,
+    image_file: UploadFile = File(...),
+    pos_prompt: str = Form(DEFAULT_INPAINT_PROMPT),
+    neg_prompt: str = Form(DEFAULT_NEG_PROMPT),
+    source_x: int = Form(...),
+    source_y: int = Form(...),
+    target_x: int = Form(...),
+    target_y: int = Form(...),
+    extend_direction: str = Form(""),
+    priority: int = Form(PRIORITY_NORMAL),
+    wait: bool = Form(True),
+    world: str = Form(""),
+    regenerate: bool = Form(False),
+    stream: bool = Form(False),
+    quality: str = Form(""),
+    deadline: Optional[float] = Form(None),
+    output_format: str = Query("", alias="format"),
+    accept: str = Header(""),
+):
+    """
+    :param world: World of the tile, the one /gen answered with in its X-World header.
+    :param stream: Answer with server-sent events, see /gen.
+    :param quality: See /gen.
+    :param deadline: See /gen.
+    """
+    try:
+        fmt = negotiate(output_format, accept)
+        check_priority(priority)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+
+    if DEBUG:
+        with open("output.png", "rb") as f:
+            return Response(content=f.read(), media_type="image/png")
+
+    if not world:
+        return JSONResponse(content={"error": WORLD_REQUIRED}, status_code=400)
+    print("Got inpaint request for tile ", target_x, target_y)
 
-            ksampler_8 = ksampler.sample(
-                seed=random.randint(1, 2**64),
-                steps=STEPS,
-                cfg=3,
-                sampler_name="ddim",
-                scheduler="karras",
-                denoise=1,
-                model=get_value_at_index(loraloader, 0),
-                positive=get_value_at_index(positive_encode, 0),
-                negative=get_value_at_index(negative_encode, 0),
-                latent_image=get_value_at_index(vaeencodeforinpaint_213, 0),
+    preview = PreviewStream(PREVIEW_EVERY) if stream else None
+    try:
+        record, job = await start_inpaint(
+            world,
+            lambda: read_upload(image_file),
+            pos_prompt,
+            neg_prompt,
+            source_x,
+            source_y,
+            target_x,
+            target_y,
+            extend_direction,
+            priority,
+            regenerate,
+            preview,
+            quality,
+            deadline,
+        )
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    except QueueFull as e:
+        return respond_busy(e)
+
+    prefetcher = app.package["prefetcher"]
+    if stream:
+        prefetcher.observe(world, target_x, target_y, player=(source_x, source_y))
+        if record is not None:
+            return await stream_stored_tile(record, fmt)
+        return stream_job(job, preview, fmt)
+    if record is not None:
+        response = await respond_with_stored_tile(record, fmt)
+    else:
+        response = await respond_with_job(job, wait, fmt, request)
+    prefetcher.observe(world, target_x, target_y, player=(source_x, source_y))
+    return response
+
+
+@app.post("/inpaint_batch")
+async def inpaint_batch(
+    items: str = Form(...),
+    image_files: List[UploadFile] = File(...),
+    priority: int = Form(PRIORITY_NORMAL),
+    world: str = Form(""),
+    regenerate: bool = Form(False),
+    quality: str = Form(""),
+    deadline: Optional[float] = Form(None),
+    output_format: str = Query("", alias="format"),
+):
+    """
+    Inpaint many tiles in one request. Tiles are streamed back as NDJSON, one line per tile in completion order.
+
+    :param items: JSON list of objects with source_x, source_y, target_x, target_y and optionally
+        extend_direction, pos_prompt, neg_prompt and image (index into image_files, defaults to the item index).
+    :param world: World of the tiles, see /inpaint.
+    :param quality: Quality tier of every tile, see /gen.
+    :param deadline: Seconds the client is willing to wait for each tile, see /gen.
+    :param output_format: Encoding of the tiles, see /gen.
+    :return: Lines of {"index", "target_x", "target_y", "cache": "hit" | "miss", "format", "data": base64}
+        or {"index", "target_x", "target_y", "error"} for tiles that could not be generated.
+    """
+    try:
+        fmt = negotiate(output_format, "")
+        check_priority(priority)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    encoder = app.package["encoder"]
+    try:
+        items = json.loads(items)
+        if not isinstance(items, list):
+            raise ValueError("items must be a list")
+        for index, item in enumerate(items):
+            for field in ("source_x", "source_y", "target_x", "target_y"):
+                item[field] = int(item[field])
+            image = int(item.get("image", index))
+            if not 0 <= image < len(image_files):
+                raise ValueError(f"item {index} refers to missing image {image}")
+            item["image"] = image
+    except (KeyError, TypeError, ValueError) as e:
+        return JSONResponse(content={"error": f"Invalid items: {e}"}, status_code=400)
+
+    if not world:
+        return JSONResponse(content={"error": WORLD_REQUIRED}, status_code=400)
+    print(f"Got inpaint batch request for {len(items)} tile(s)")
+
+    # An upload can be shared by several items, but an UploadFile can only be read once: the first item
+    # missing the store reads it, the others await that read
+    uploads: Dict[int, asyncio.Task] = {}
+
+    def upload_reader(image: int) -> Callable[[], Awaitable[bytes]]:
+        async def read() -> bytes:
+            if image not in uploads:
+                uploads[image] = asyncio.ensure_future(read_upload(image_files[image]))
+            # Shared, an item cancelled while it waits must not cancel the read for the others
+            return await asyncio.shield(uploads[image])
+
+        return read
+
+    async def start(index, item):
+        job = None
+        try:
+            record, job = await start_inpaint(
+                world,
+                upload_reader(item["image"]),
+                item.get("pos_prompt", DEFAULT_INPAINT_PROMPT),
+                item.get("neg_prompt", DEFAULT_NEG_PROMPT),
+                item["source_x"],
+                item["source_y"],
+                item["target_x"],
+                item["target_y"],
+                item.get("extend_direction", ""),
+                priority,
+                regenerate,
+                quality=quality,
+                deadline=deadline,
             )
+            if record is not None:
+                return index, await encoder.transcode(record.png, fmt), "hit", None
+            result = await app.package["scheduler"].wait(job)
+            return index, await encoder.encode(result, fmt), "miss", None
+        except asyncio.CancelledError:
+            # The stream was closed, the client is gone
+            if job is not None:
+                release_job(job)
+            return index, None, None, "Cancelled"
+        except QueueFull as e:
+            return index, None, None, f"{e}, retry in {math.ceil(e.retry_after)}s"
+        except Exception as e:
+            return index, None, None, str(e)
+
+    # Everything is submitted up front so the scheduler can sample the tiles together
+    tasks = [
+        asyncio.create_task(start(index, item)) for index, item in enumerate(items)
+    ]
+
+    async def stream():
+        prefetcher = app.package["prefetcher"]
+        try:
+            for task in asyncio.as_completed(tasks):
+                index, content, cache, error = await task
+                item = items[index]
+                line = {
+                    "index": index,
+                    "target_x": item["target_x"],
+                    "target_y": item["target_y"],
+                }
+                if error is not None:
+                    line["error"] = error
+                else:
+                    line["cache"] = cache
+                    line["format"] = fmt
+                    line["data"] = base64.b64encode(content).decode("ascii")
+                yield json.dumps(line) + "\n"
+            last = items[-1] if items else None
+            if last is not None:
+                prefetcher.observe(
+                    world,
+                    last["target_x"],
+                    last["target_y"],
+                    player=(last["source_x"], last["source_y"]),
+                )
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    return StreamingResponse(stream(), media_type="application/x-ndjson")
+
+
+def session_deadline(message: dict) -> Optional[float]:
+    """
+    :raises TypeError, ValueError: If the deadline is not a number.
+    """
+    deadline = message.get("deadline")
+    return float(deadline) if deadline is not None else None
+
+
+class WorldSession:
+    def __init__(self, websocket: WebSocket, world: str, fmt: str):
+        """
+        One client of /session: its world, and the tiles it asked for that are not delivered yet.
+        """
+        self.websocket = websocket
+        self.world = world
+        self.fmt = fmt
+        # request id -> task serving it
+        self.tasks: Dict[Any, asyncio.Task] = {}
+        # tile -> task serving it, so an inpaint waits for the earlier requested neighbours it is built from
+        self.pending_tiles: Dict[Tuple[int, int], asyncio.Task] = {}
+        # A header and its binary frame must not be interleaved with another tile
+        self.send_lock = asyncio.Lock()
+
+    async def send(self, message: dict, data: Optional[bytes] = None):
+        async with self.send_lock:
+            await self.websocket.send_json(message)
+            if data is not None:
+                await self.websocket.send_bytes(data)
+
+    async def send_tile(self, request_id, x: int, y: int, content: bytes, cache: str, **extra):
+        await self.send(
+            {
+                "op": "tile",
+                "id": request_id,
+                "x": x,
+                "y": y,
+                "cache": cache,
+                "format": self.fmt,
+                "size": len(content),
+                **extra,
+            },
+            content,
+        )
 
-            vaedecode_9 = vaedecode.decode(
-                samples=get_value_at_index(ksampler_8, 0),
-                vae=get_value_at_index(checkpoint, 2),
+    async def deliver_job(self, request_id, job, x: int, y: int):
+        await self.send({"op": "queued", "id": request_id, "x": x, "y": y, **job_status(job)})
+        try:
+            result = await app.package["scheduler"].wait(job)
+        except asyncio.CancelledError:
+            if job.status != "cancelled":
+                # this task was cancelled: the client cancelled the request or went away
+                release_job(job)
+                raise
+            await self.send({"op": "error", "id": request_id, "error": "Job cancelled"})
+            return
+        content = await app.package["encoder"].encode(result, self.fmt)
+        # Stored before the tile counts as delivered, later inpaints are built from it
+        await asyncio.wrap_future(result.png)
+        await self.send_tile(request_id, x, y, content, "miss", quality=job.payload.quality)
+
+    async def serve_gen(self, request_id, message: dict):
+        pos_prompt = message.get(
+            "pos_prompt",
+            "A 2D game sprite, Pixel art, 64 bit, top down view, 2d game map, urban, desert, town, open world",
+        )
+        self.world = message.get("world") or self.world or generate_world_id(pos_prompt)
+        await self.send({"op": "world", "id": request_id, "world": self.world})
+        prefetcher = app.package["prefetcher"]
+        if not message.get("regenerate", False):
+            record = await asyncio.to_thread(app.package["tile_store"].get, self.world, 0, 0)
+            if record is not None:
+                prefetcher.observe(self.world, 0, 0)
+                set_stage_cache("hit")
+                content = await app.package["encoder"].transcode(record.png, self.fmt)
+                await self.send_tile(request_id, 0, 0, content, "hit")
+                return
+        priority = int(message.get("priority", PRIORITY_NORMAL))
+        set_stage_cache("miss")
+        tile_jobs = app.package["tile_jobs"]
+        key = (self.world, 0, 0, "gen")
+        # Requested by another client right now: wait for the same job
+        job = None if message.get("regenerate", False) else tile_jobs.join(key, priority)
+        if job is None:
+            tier = choose_tier(message.get("quality", ""), session_deadline(message), priority)
+            job = app.package["scheduler"].submit_deferred(
+                prepare_gen_request(
+                    self.world,
+                    "Help me create a top down view image prompt based on this: " + pos_prompt,
+                    message.get("neg_prompt", DEFAULT_NEG_PROMPT),
+                    tier,
+                ),
+                priority=priority,
+                kind="gen",
+                cost=tier.cost,
             )
+            tile_jobs.add(key, job)
+        prefetcher.observe(self.world, 0, 0)
+        await self.deliver_job(request_id, job, 0, 0)
+
+    async def serve_tile(self, request_id, message: dict, neighbours: List[asyncio.Task]):
+        """
+        :param neighbours: Tasks serving neighbours requested earlier in the session, they have to be stored first.
+        """
+        x, y = int(message["x"]), int(message["y"])
+        if self.world is None:
+            raise ValueError("No world yet, send a gen request first")
+        priority = int(message.get("priority", PRIORITY_NORMAL))
+        player = (int(message["player_x"]), int(message["player_y"])) if "player_x" in message else None
+        prefetcher = app.package["prefetcher"]
+        prefetcher.observe(self.world, x, y, player=player)
+        tile_jobs = app.package["tile_jobs"]
+        key = (self.world, x, y, "inpaint")
+        regenerate = message.get("regenerate", False)
+
+        if not regenerate:
+            record = await asyncio.to_thread(app.package["tile_store"].get, self.world, x, y)
+            if record is not None:
+                prefetcher.record_hit(self.world, x, y)
+                set_stage_cache("hit")
+                content = await app.package["encoder"].transcode(record.png, self.fmt)
+                await self.send_tile(request_id, x, y, content, "hit")
+                return
+            # Requested by another client right now: wait for the same job
+            job = tile_jobs.join(key, priority)
+            if job is not None:
+                set_stage_cache("miss")
+                await self.deliver_job(request_id, job, x, y)
+                return
+            job = prefetcher.claim(self.world, x, y, priority)
+            if job is not None:
+                set_stage_cache("miss")
+                if job.payload is not None:
+                    job.payload.background = False
+                    job.payload.stage_labels = STAGE_LABELS.get()
+                tile_jobs.add(key, job)
+                await self.deliver_job(request_id, job, x, y)
+                return
+
+        app.package["scheduler"].admit(priority)
+        if neighbours:
+            await asyncio.wait(neighbours)
+        set_stage_cache("miss")
+        # Submitted by another request while this one waited for the neighbours
+        job = None if regenerate else tile_jobs.join(key, priority)
+        if job is not None:
+            await self.deliver_job(request_id, job, x, y)
+            return
+        # Picked once the neighbours are in, the wait for them is not part of the estimate
+        tier = choose_tier(message.get("quality", ""), session_deadline(message), priority)
+        job = await submit_server_side_inpaint(
+            self.world,
+            x,
+            y,
+            priority=priority,
+            kind="inpaint",
+            pos_prompt=message.get("pos_prompt", DEFAULT_INPAINT_PROMPT),
+            neg_prompt=message.get("neg_prompt", DEFAULT_NEG_PROMPT),
+            tier=tier,
+        )
+        if job is None:
+            raise ValueError(f"Tile ({x}, {y}) has no generated orthogonal neighbour to extend")
+        tile_jobs.add(key, job)
+        await self.deliver_job(request_id, job, x, y)
+
+    async def serve(self, request_id, message: dict, neighbours: List[asyncio.Task]):
+        try:
+            if message.get("op") == "gen":
+                await self.serve_gen(request_id, message)
+            else:
+                await self.serve_tile(request_id, message, neighbours)
+        except QueueFull as e:
+            await self.send(
+                {
+                    "op": "busy",
+                    "id": request_id,
+                    "error": str(e),
+                    "retry_after": max(1, math.ceil(e.retry_after)),
+                    "queue_position": e.position,
+                    "eta_seconds": round(e.eta, 1),
+                }
+            )
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            await self.send({"op": "error", "id": request_id, "error": str(e)})
+        finally:
+            self.tasks.pop(request_id, None)
+
+    def start(self, message: dict):
+        """
+        :raises KeyError, TypeError, ValueError: If the message is malformed.
+        """
+        request_id = message.get("id")
+        check_priority(int(message.get("priority", PRIORITY_NORMAL)))
+        tile, neighbours = (0, 0), []
+        if message.get("op") == "tile":
+            tile = (int(message["x"]), int(message["y"]))
+            # Only earlier requests: two neighbours requested together must not wait for each other
+            for dx, dy in ORTHOGONAL_OFFSETS:
+                task = self.pending_tiles.get((tile[0] - dx, tile[1] - dy))
+                if task is not None:
+                    neighbours.append(task)
+        task = asyncio.create_task(self.serve(request_id, message, neighbours))
+        self.tasks[request_id] = task
+        self.pending_tiles[tile] = task
+        task.add_done_callback(
+            lambda _: self.pending_tiles.pop(tile, None)
+            if self.pending_tiles.get(tile) is task
+            else None
+        )
+
+    def close(self):
+        for task in list(self.tasks.values()):
+            task.cancel()
 
-            final_image = get_value_at_index(vaedecode_9, 0)[0]
-            final_image = 255.0 * final_image.cpu().numpy()
-            final_image = Image.fromarray(np.clip(final_image, 0, 255).astype(np.uint8))
-            img_bytes = BytesIO()
-            final_image.save(img_bytes, format="PNG")
-            img_bytes.seek(0)
 
-            tile_prompts[generate_tile_id(target_x, target_y)] = pos_prompt
+@app.websocket("/session")
+async def world_session(
+    websocket: WebSocket,
+    world: str = "",
+    output_format: str = Query("", alias="format"),
+):
+    """
+    Session mode: the server composes every inpaint source from the tiles it generated, so the client
+    only sends coordinates instead of uploading a source image per tile.
+
+    Client messages are JSON text frames, "id" is any value the client picks to match the answers:
+        {"op": "gen", "id", "pos_prompt"?, "neg_prompt"?, "world"?, "priority"?, "regenerate"?, "quality"?, "deadline"?}
+        {"op": "tile", "id", "x", "y", "player_x"?, "player_y"?, "pos_prompt"?, "neg_prompt"?, "priority"?,
+         "regenerate"?, "quality"?, "deadline"?}
+        {"op": "cancel", "id"}
+    The server answers each with JSON text frames:
+        {"op": "world", "id", "world"} (gen only)
+        {"op": "queued", "id", "x", "y", "job_id", "queue_position", "eta_seconds", ...} when sampling is needed
+        {"op": "tile", "id", "x", "y", "cache", "format", "size", "quality"?} followed by one binary frame with the tile
+        {"op": "busy", "id", "retry_after", "queue_position", "eta_seconds"} when the server is full
+        {"op": "error", "id", "error"}
+        {"op": "cancelled", "id"} acknowledging a cancel
+    A tile is extended from whichever of its orthogonal neighbours are generated, the extend direction
+    follows from them. Disconnecting cancels everything the session still waits for.
+
+    :param world: World to continue, otherwise the first gen picks it.
+    :param output_format: Encoding of the tiles, see /gen.
+    """
+    # Not seen by the HTTP middleware, every message is served in a task inheriting this
+    STAGE_LABELS.set(("/session", "none"))
+    await websocket.accept()
+    try:
+        fmt = negotiate(output_format, "")
+    except ValueError as e:
+        await websocket.send_json({"op": "error", "id": None, "error": str(e)})
+        await websocket.close(code=1008)
+        return
+
+    session = WorldSession(websocket, world or None, fmt)
+    try:
+        while True:
+            try:
+                message = await websocket.receive_json()
+            except (ValueError, KeyError) as e:
+                await session.send({"op": "error", "id": None, "error": f"Invalid message: {e}"})
+                continue
+            op = message.get("op") if isinstance(message, dict) else None
+            if op == "cancel":
+                task = session.tasks.get(message.get("id"))
+                if task is not None:
+                    task.cancel()
+                    await session.send({"op": "cancelled", "id": message.get("id")})
+            elif op in ("gen", "tile"):
+                try:
+                    session.start(message)
+                except (KeyError, TypeError, ValueError) as e:
+                    await session.send(
+                        {"op": "error", "id": message.get("id"), "error": f"Invalid message: {e}"}
+                    )
+            else:
+                request_id = message.get("id") if isinstance(message, dict) else None
+                await session.send({"op": "error", "id": request_id, "error": f"Unknown op {op}"})
+    except WebSocketDisconnect:
+        pass
+    finally:
+        session.close()
+
+
+@app.get("/minimap")
+async def get_minimap(
+    world: str = "",
+    x: int = 0,
+    y: int = 0,
+    radius: int = 4,
+    scale: int = 8,
+    output_format: str = Query("", alias="format"),
+    accept: str = Header(""),
+):
+    """
+    Downscaled view of the generated world around a tile, undrawn areas black.
+
+    :param world: World to show, see /inpaint.
+    :param x: Tile in the centre.
+    :param radius: Tiles shown on each side of it.
+    :param scale: Keep one pixel in scale along each axis.
+    :param output_format: See /gen.
+    """
+    try:
+        fmt = negotiate(output_format, accept)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    if not world:
+        return JSONResponse(content={"error": WORLD_REQUIRED}, status_code=400)
+    if not 0 <= radius <= 64 or not 1 <= scale <= 64:
+        return JSONResponse(
+            content={"error": "radius must be in [0, 64] and scale in [1, 64]"}, status_code=400
+        )
 
-            print("Inpainting done for ", temp_filename)
-            # save file
-            return StreamingResponse(img_bytes, media_type="image/png")
+    def render() -> bytes:
+        with app.package["canvas"].use(world) as canvas:
+            size = canvas.chunk_size
+            # Tile (x, y) starts at chunk column x and chunk row -y, and spans two chunks
+            extent = (2 * radius + 2) * size
+            pixels = canvas.read_region(
+                (x - radius) * size, (-y - radius) * size, extent, extent, scale
+            )
+        return encode_image(Image.fromarray(pixels, "RGB"), fmt)
+
+    content = await asyncio.wrap_future(app.package["encoder"].submit(render))
+    return Response(content=content, media_type=media_type(fmt))
+
+
+@app.get("/stats")
+def get_stats():
+    pipeline = app.package["pipeline"]
+    llm_cache = app.package["gpt_helper"].cache
+    return {
+        "conditioning_cache": pipeline.conditioning_cache.stats()
+        if pipeline.conditioning_cache is not None
+        else None,
+        "latent_cache": pipeline.latent_cache.stats()
+        if pipeline.latent_cache is not None
+        else None,
+        "llm_cache": llm_cache.stats() if llm_cache is not None else None,
+        "tile_store": app.package["tile_store"].stats(),
+        "canvas": app.package["canvas"].stats(),
+        "prefetch": app.package["prefetcher"].stats(),
+        "tile_jobs": app.package["tile_jobs"].stats(),
+        "refine": app.package["refiner"].stats(),
+        "queue_depth": app.package["scheduler"].queue_depth(),
+        # per sampler process: alive, batches and tiles sampled
+        "sampler_pool": pipeline.stats() if isinstance(pipeline, SamplerPool) else None,
+    }
+
+
+@app.get("/metrics")
+def get_metrics():
+    """
+    Prometheus scrape endpoint.
+    """
+    QUEUE_DEPTH.set(app.package["scheduler"].queue_depth())
+    return Response(
+        content=REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
+
+
+@app.get("/jobs/{job_id}")
+async def get_job_result(
+    job_id: str,
+    output_format: str = Query("", alias="format"),
+    accept: str = Header(""),
+):
+    """
+    Await a job submitted with wait=false and return its tile.
+    """
+    try:
+        fmt = negotiate(output_format, accept)
+    except ValueError as e:
+        return JSONResponse(content={"error": str(e)}, status_code=400)
+    job = app.package["scheduler"].get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+    return await respond_with_job(job, wait=True, fmt=fmt)
+
+
+@app.delete("/jobs/{job_id}")
+def cancel_job(job_id: str):
+    """
+    Cancel a job. A job that is already sampling stops at the next sampler step once nothing else
+    in its batch is wanted either.
+    """
+    scheduler = app.package["scheduler"]
+    job = scheduler.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+    cancelled = scheduler.cancel(job, abort_running=True)
+    return {**job.to_dict(), "cancelled": cancelled}
+
+
+@app.get("/jobs/{job_id}/status")
+def get_job_status(job_id: str):
+    scheduler = app.package["scheduler"]
+    job = scheduler.get(job_id)
+    if job is None:
+        return JSONResponse(content={"error": "Unknown job"}, status_code=404)
+    return job_status(job)
 
 
 def start_server():
@@ -369,7 +1725,8 @@ def start_server():
         host="0.0.0.0",
         port=8765,
         log_level="debug",
-        reload=True,
+        # Every reload loads the models again, opt in with RELOAD=1
+        reload=os.getenv("RELOAD", "0") == "1",
     )
     # webbrowser.open("http://127.0.0.1:8765")
 
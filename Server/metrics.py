@@ -0,0 +1,266 @@
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    type_name = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def render(self) -> List[str]:
+        return [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type_name}",
+        ]
+
+
+class Counter(Metric):
+    type_name = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, value in self._values.items():
+                lines.append(
+                    f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+                )
+        return lines
+
+
+class Gauge(Counter):
+    type_name = "gauge"
+
+    def set(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # per label set: (bucket counts, sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self) -> List[str]:
+        lines = super().render()
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets, counts):
+                    cumulative += count
+                    le = f'le="{format_value(bound)}"'
+                    lines.append(
+                        f"{self.name}_bucket{format_labels(self.labelnames, key, le)} {cumulative}"
+                    )
+                labels = format_labels(self.labelnames, key)
+                lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+                lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        """
+        Collection of metrics rendered in the Prometheus text exposition format.
+        """
+        self._metrics: List[Metric] = []
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+REQUEST_SECONDS = REGISTRY.register(
+    Histogram(
+        "tile_request_seconds",
+        "HTTP request latency by route and tile cache result (hit, miss or none).",
+        ["endpoint", "cache"],
+    )
+)
+REQUESTS_TOTAL = REGISTRY.register(
+    Counter(
+        "tile_requests_total",
+        "HTTP requests by route, tile cache result and status code.",
+        ["endpoint", "cache", "status"],
+    )
+)
+STAGE_SECONDS = REGISTRY.register(
+    Histogram(
+        "tile_stage_seconds",
+        "Duration of one pipeline stage (llm, decode_upload, clip_encode, vae_encode, sample, preview_decode, vae_decode, cache_latents, upscale, to_pil, encode_<format>, encode_preview, decode_png) by route and tile cache result. Stages of a batch count once per tile, prefetch and refine jobs under those names.",
+        ["stage", "endpoint", "cache"],
+    )
+)
+
+# (endpoint, cache) labels of the stages run for the current request. The HTTP middleware sets the endpoint,
+# handlers the cache result once they know it (see set_stage_cache). Work handed to other threads takes
+# them along: TileRequest.stage_labels for the sampling worker, TileEncoder for the encoder pool.
+STAGE_LABELS: ContextVar[Tuple[str, str]] = ContextVar("stage_labels", default=("none", "none"))
+# Labels of every tile a batch stage works for, observed once each (see stage_tiles)
+STAGE_TILES: ContextVar[Optional[List[Tuple[str, str]]]] = ContextVar("stage_tiles", default=None)
+
+
+def set_stage_cache(cache: str):
+    endpoint, _ = STAGE_LABELS.get()
+    STAGE_LABELS.set((endpoint, cache))
+
+
+@contextmanager
+def stage_tiles(labels: List[Tuple[str, str]]):
+    """
+    Stages timed in the block work for the tiles with these (endpoint, cache) labels.
+    """
+    token = STAGE_TILES.set(labels)
+    try:
+        yield
+    finally:
+        STAGE_TILES.reset(token)
+
+
+def observe_stage(seconds: float, stage: str):
+    tiles = STAGE_TILES.get()
+    for endpoint, cache in tiles if tiles is not None else [STAGE_LABELS.get()]:
+        STAGE_SECONDS.observe(seconds, stage=stage, endpoint=endpoint, cache=cache)
+
+
+@contextmanager
+def time_stage(stage: str):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe_stage(time.perf_counter() - start, stage)
+
+
+JOB_SECONDS = REGISTRY.register(
+    Histogram(
+        "tile_job_seconds",
+        "Time a scheduler job spent preparing (prompt stage), waiting in the queue and being served.",
+        ["kind", "phase"],
+    )
+)
+JOBS_TOTAL = REGISTRY.register(
+    Counter("tile_jobs_total", "Finished scheduler jobs by kind and status.", ["kind", "status"])
+)
+BATCH_SIZE = REGISTRY.register(
+    Histogram(
+        "tile_batch_size",
+        "Tiles sampled per sampler call.",
+        buckets=(1, 2, 3, 4, 6, 8, 12, 16),
+    )
+)
+WASTED_SAMPLING_SECONDS = REGISTRY.register(
+    Counter(
+        "tile_wasted_sampling_seconds_total",
+        "Sampler time spent on jobs cancelled while running (their share of the batch).",
+        ["kind"],
+    )
+)
+LATENT_CACHE_TOTAL = REGISTRY.register(
+    Counter(
+        "tile_latent_cache_total",
+        "Inpaint and refinement latents taken from cached tile latents (hit) or VAE encoded from pixels (miss).",
+        ["result"],
+    )
+)
+QUALITY_TOTAL = REGISTRY.register(
+    Counter(
+        "tile_quality_total",
+        "Tiles submitted for sampling by quality tier and how it was picked (requested, deadline, default, refine).",
+        ["tier", "choice"],
+    )
+)
+QUEUE_DEPTH = REGISTRY.register(
+    Gauge("tile_queue_depth", "Jobs waiting for the sampler.")
+)
+
+
+def observe_job(job):
+    """
+    Record the timings of a finished scheduler job.
+    """
+    for phase, seconds in job.timings().items():
+        JOB_SECONDS.observe(seconds, kind=job.kind, phase=phase)
+    JOBS_TOTAL.inc(kind=job.kind, status=job.status)
+    if job.status == "cancelled" and job.started_at is not None:
+        WASTED_SAMPLING_SECONDS.inc(
+            (job.finished_at - job.started_at) / job.batch_size, kind=job.kind
+        )
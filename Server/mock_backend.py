@@ -0,0 +1,208 @@
+import asyncio
+import json
+import math
+import os
+import random
+import re
+import threading
+import time
+import zlib
+from io import BytesIO
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+from metrics import BATCH_SIZE, stage_tiles, time_stage
+from quality import REFERENCE_STEPS
+from scheduler import JobCancelled
+
+TILE_FILE = re.compile(r"^(-?\d+)_(-?\d+)\.png$")
+
+
+class StageLatency:
+    def __init__(self, median: float, sigma: float = 0.0, minimum: float = 0.0):
+        """
+        Log-normal latency of one pipeline stage.
+
+        :param median: Median duration in seconds.
+        :param sigma: Standard deviation of the underlying normal, 0 for a fixed duration.
+            0.25 puts p99 at about 1.8x the median.
+        :param minimum: Lower bound in seconds.
+        """
+        self.median = median
+        self.sigma = sigma
+        self.minimum = minimum
+
+    def sample(self, rng: random.Random) -> float:
+        if self.median <= 0:
+            return 0.0
+        if self.sigma <= 0:
+            return max(self.minimum, self.median)
+        return max(self.minimum, rng.lognormvariate(math.log(self.median), self.sigma))
+
+
+class LatencyModel:
+    def __init__(
+        self,
+        llm: Optional[StageLatency] = None,
+        sample: Optional[StageLatency] = None,
+        batch_cost: float = 0.6,
+        scale: float = 1.0,
+        seed: Optional[int] = None,
+    ):
+        """
+        Simulated stage timings of the real server (gpt-4o-mini prompt, 20 DDIM steps of SDXL at 768x768).
+
+        :param llm: Duration of the prompt stage.
+        :param sample: Duration of sampling (VAE encode and decode included) a single tile in 20 steps.
+            Tiles sampled in fewer or more steps take proportionally less or more.
+        :param batch_cost: Extra sampling time of every additional tile in a batch, as a fraction of one tile.
+        :param scale: Multiplies every duration, 0 disables latency entirely.
+        :param seed: Seed of the random generator, for reproducible runs.
+        """
+        self.llm = llm or StageLatency(1.2, sigma=0.35, minimum=0.3)
+        self.sample = sample or StageLatency(3.0, sigma=0.08, minimum=2.0)
+        self.batch_cost = batch_cost
+        self.scale = scale
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def llm_delay(self) -> float:
+        with self._lock:
+            return self.scale * self.llm.sample(self._rng)
+
+    def sample_delay(self, batch_size: int = 1) -> float:
+        with self._lock:
+            single = self.sample.sample(self._rng)
+        return self.scale * single * (1 + self.batch_cost * (batch_size - 1))
+
+
+class MockWorld:
+    def __init__(self, name: str, root: str = "mock"):
+        """
+        A recorded world (tile PNGs and their prompts) preloaded into memory.
+
+        Tiles outside the recording map onto a recorded one deterministically, so clients can walk arbitrarily far.
+
+        :param name: Folder under root, e.g. "city", "desert" or "japan".
+        """
+        self.name = name
+        folder = os.path.join(root, name)
+        with open(os.path.join(folder, "tile_prompts.json"), "r") as f:
+            self.prompts: Dict[str, str] = json.load(f)
+
+        self.tiles: Dict[Tuple[int, int], bytes] = {}
+        for file_name in os.listdir(folder):
+            match = TILE_FILE.match(file_name)
+            if match is None:
+                continue
+            with open(os.path.join(folder, file_name), "rb") as f:
+                self.tiles[(int(match.group(1)), int(match.group(2)))] = f.read()
+        if not self.tiles:
+            raise ValueError(f"No tiles in {folder}")
+        self._keys = sorted(self.tiles)
+        self._images: Dict[Tuple[int, int], Image.Image] = {}
+        self._lock = threading.Lock()
+        print(
+            f"Loaded mock world {name}: {len(self.tiles)} tiles, "
+            f"{sum(len(png) for png in self.tiles.values()) / 1e6:.1f} MB"
+        )
+
+    def _recorded(self, x: int, y: int) -> Tuple[int, int]:
+        if (x, y) in self.tiles:
+            return (x, y)
+        return self._keys[zlib.crc32(f"{x}_{y}".encode()) % len(self._keys)]
+
+    def tile(self, x: int, y: int) -> bytes:
+        return self.tiles[self._recorded(x, y)]
+
+    def image(self, x: int, y: int) -> Image.Image:
+        """
+        Decoded tile, decoded once on first use.
+        """
+        key = self._recorded(x, y)
+        with self._lock:
+            image = self._images.get(key)
+        if image is None:
+            image = Image.open(BytesIO(self.tiles[key])).convert("RGB")
+            with self._lock:
+                self._images[key] = image
+        return image
+
+    def prompt(self, x: int, y: int) -> str:
+        return self.prompts.get("{}_{}".format(*self._recorded(x, y)), "")
+
+
+class MockChat:
+    def __init__(self, world: MockWorld, latency: LatencyModel):
+        """
+        Stand-in for AsyncGPTAPIHelper: answers after a simulated delay with one of the recorded prompts.
+        """
+        self.world = world
+        self.latency = latency
+        self.cache = None
+
+    async def achat(self, prompt: str, **kwargs) -> str:
+        await asyncio.sleep(self.latency.llm_delay())
+        prompts = list(self.world.prompts.values()) or [""]
+        return prompts[zlib.crc32(prompt.encode("utf-8")) % len(prompts)]
+
+    async def aclose(self):
+        pass
+
+
+class MockPipeline:
+    def __init__(self, world: MockWorld, latency: LatencyModel):
+        """
+        Stand-in for TilePipeline: returns the recorded image of each tile after a simulated sampling delay.
+
+        run_batch runs on the scheduler's worker thread, so sleeping there holds the "GPU" the way sampling
+        does without blocking the event loop.
+        """
+        self.world = world
+        self.latency = latency
+        self.conditioning_cache = None
+        self.latent_cache = None
+        self.batches = 0
+        self.tiles = 0
+
+    def encode_text(self, text: str):
+        return None
+
+    def run_batch(self, requests) -> List[Image.Image]:
+        BATCH_SIZE.observe(len(requests))
+        with stage_tiles([request.stage_labels for request in requests]), time_stage("sample"):
+            # One sleep per sampler step, checking for cancellation in between like TilePipeline
+            steps = max(1, requests[0].steps)
+            # Sampling at 1/scale shrinks the latent area by scale**2
+            delay = (
+                self.latency.sample_delay(len(requests)) / REFERENCE_STEPS / requests[0].scale**2
+            )
+            for step in range(steps):
+                if all(request.cancelled for request in requests):
+                    raise JobCancelled(f"All {len(requests)} tile(s) of the batch were cancelled")
+                self.publish_previews(requests, step, steps)
+                time.sleep(delay)
+        self.batches += 1
+        self.tiles += len(requests)
+        return [self.image(request) for request in requests]
+
+    def image(self, request) -> Image.Image:
+        image = self.world.image(*request.tile)
+        if request.scale == 1:
+            return image
+        # What a tile sampled at 1/scale looks like once upscaled
+        return image.reduce(request.scale).resize(image.size, Image.NEAREST)
+
+    def publish_previews(self, requests, step: int, total_steps: int):
+        # The recorded tile at latent resolution, standing in for the latent-to-RGB approximation
+        for request in requests:
+            if request.preview is None or not request.preview.wants(step):
+                continue
+            image = self.world.image(*request.tile)
+            small = image.resize((image.width // 8, image.height // 8), Image.BILINEAR)
+            request.preview.publish(step, total_steps, np.asarray(small.convert("RGB")))
+
+    def stats(self) -> Dict[str, int]:
+        return {"batches": self.batches, "tiles": self.tiles}
@@ -0,0 +1,93 @@
+"""
+Local stand-in for the OpenAI chat completions API.
+
+Answers POST /v1/chat/completions with a deterministic scene prompt derived from the last user
+message, after a configurable delay. Point the server at it with OPENAI_API_BASE=http://127.0.0.1:8766/v1
+
+    python mock_llm.py --port 8766 --latency 0.8
+"""
+
+import argparse
+import hashlib
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+SCENES = [
+    "dense city blocks, asphalt roads, crosswalks, small parks, rooftops",
+    "sandy desert, dunes, dry riverbed, scattered rocks, cactus",
+    "japanese village, tiled roofs, stone paths, cherry trees, koi pond",
+    "green meadow, dirt path, wooden fences, small farm fields",
+    "harbor town, wooden piers, boats, cobblestone streets, warehouses",
+]
+
+
+def make_reply(messages) -> str:
+    last_user = next(
+        (m["content"] for m in reversed(messages) if m.get("role") == "user"), ""
+    )
+    digest = hashlib.sha256(last_user.encode("utf-8")).digest()
+    return ", " + SCENES[digest[0] % len(SCENES)]
+
+
+class MockLLMHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    jitter = 0.0
+    protocol_version = "HTTP/1.1"
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        request = json.loads(body or b"{}")
+
+        delay = self.latency + random.uniform(0, self.jitter)
+        if delay > 0:
+            time.sleep(delay)
+
+        content = make_reply(request.get("messages", []))
+        response = json.dumps(
+            {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": content},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            }
+        ).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8766)
+    parser.add_argument("--latency", type=float, default=0.8, help="seconds per reply")
+    parser.add_argument("--jitter", type=float, default=0.2, help="extra random seconds")
+    args = parser.parse_args()
+
+    MockLLMHandler.latency = args.latency
+    MockLLMHandler.jitter = args.jitter
+    server = ThreadingHTTPServer((args.host, args.port), MockLLMHandler)
+    print(f"Mock LLM listening on http://{args.host}:{args.port}/v1")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,591 @@
+import math
+import random
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional, Tuple
+
+import torch
+from PIL import Image
+
+from conditioning_cache import ConditioningCache
+from fused_checkpoint import load_fused_models
+from inpaint_source import ORTHOGONAL_OFFSETS, fill_in_pixels
+from latent_cache import LatentCache
+from metrics import BATCH_SIZE, LATENT_CACHE_TOTAL, STAGE_LABELS, observe_stage, stage_tiles
+from postprocess import ImagePostprocessor
+from previews import SDXL_LATENT_RGB_BIAS, SDXL_LATENT_RGB_FACTORS, latent_to_rgb
+from scheduler import JobCancelled
+
+# Largest difference (in [0, 1] per channel, averaged over a latent pixel) between an inpaint source and the
+# cached tile it is supposed to show. A PNG round trip stays well below it, any actual edit does not.
+LATENT_FINGERPRINT_TOLERANCE = 4 / 255
+
+
+class TileRequest:
+    def __init__(
+        self,
+        kind: str,
+        pos_prompt: str,
+        neg_prompt: str,
+        world: str = "default",
+        tile: Tuple[int, int] = (0, 0),
+        steps: int = 20,
+        cfg: float = 2.98,
+        sampler_name: str = "ddim",
+        scheduler: str = "karras",
+        denoise: float = 1,
+        seed: Optional[int] = None,
+        pixels: Optional[torch.Tensor] = None,
+        mask: Optional[torch.Tensor] = None,
+        preview: Optional[Any] = None,
+        quality: str = "normal",
+        refines: Optional[str] = None,
+        scale: int = 1,
+        background: bool = False,
+    ):
+        """
+        Everything the sampling worker needs to produce one tile.
+
+        :param kind: "gen" for a text-to-image tile, "inpaint" for a tile extended from its neighbours,
+            "refine" for a stored tile sampled again from its own latent with denoise < 1.
+        :param pos_prompt: Final positive prompt (after the LLM step).
+        :param neg_prompt: Negative prompt.
+        :param world: World the tile belongs to.
+        :param tile: (x, y) index of the tile being generated.
+        :param seed: Sampling seed, drawn at random when None.
+        :param pixels: (1, H, W, 3) source image with the known neighbour pixels (inpaint), or the tile to refine.
+        :param mask: (1, H, W) mask, 1 where the tile has to be generated (inpaint only).
+        :param preview: Receives low-resolution previews while sampling, for streaming requests (see previews.PreviewStream).
+        :param quality: Name of the quality tier steps, sampler_name and scheduler come from.
+        :param refines: Digest of the stored tile a refinement starts from. The result is only stored if the
+            tile was not replaced in the meantime.
+        :param scale: Sample at 1/scale of the tile resolution, then repeat every pixel scale x scale times.
+            The tile's latent width and height must be multiples of it.
+        :param background: Nobody is waiting for the tile (prefetch, refinement), its PNG is stored after
+            the encodes clients wait for (see TileEncoder).
+        """
+        self.kind = kind
+        self.pos_prompt = pos_prompt
+        self.neg_prompt = neg_prompt
+        self.world = world
+        self.tile = tile
+        self.steps = steps
+        self.cfg = cfg
+        self.sampler_name = sampler_name
+        self.scheduler = scheduler
+        self.denoise = denoise
+        self.seed = seed if seed is not None else random.randint(1, 2**64)
+        self.pixels = pixels
+        self.mask = mask
+        # Set by the scheduler (see Job.bind_payload), the tile is no longer wanted once it is set
+        self.cancel_event: Optional[threading.Event] = None
+        self.preview = preview
+        self.quality = quality
+        self.refines = refines
+        self.scale = scale
+        self.background = background
+        # (endpoint, cache) of the request the tile is sampled for, its stage timings are recorded under them
+        self.stage_labels = STAGE_LABELS.get()
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    @property
+    def batch_key(self):
+        """
+        Requests with the same key share every sampler argument except conditioning and seed.
+        """
+        return (
+            self.kind,
+            self.steps,
+            self.cfg,
+            self.sampler_name,
+            self.scheduler,
+            self.denoise,
+            self.scale,
+        )
+
+
+def batch_conditioning(conditionings: List[List[Any]]) -> List[Any]:
+    """
+    Stack per-request conditionings into one conditioning with a batch dimension.
+
+    Token lengths are brought to their least common multiple by repeating the sequence,
+    the same way ComfyUI merges conds internally; repeated keys do not change cross attention.
+    """
+    tensors = [conditioning[0][0] for conditioning in conditionings]
+    target_length = math.lcm(*[tensor.shape[1] for tensor in tensors])
+    tensors = [
+        tensor.repeat(1, target_length // tensor.shape[1], 1) for tensor in tensors
+    ]
+
+    extras = {}
+    for key, value in conditionings[0][0][1].items():
+        values = [conditioning[0][1].get(key) for conditioning in conditionings]
+        if all(isinstance(v, torch.Tensor) for v in values):
+            extras[key] = torch.cat(values)
+        else:
+            extras[key] = value
+    return [[torch.cat(tensors), extras]]
+
+
+def check_cancelled(requests: List[TileRequest]):
+    """
+    :raises JobCancelled: If no request of the batch is wanted anymore.
+    """
+    if all(request.cancelled for request in requests):
+        raise JobCancelled(f"All {len(requests)} tile(s) of the batch were cancelled")
+
+
+@contextmanager
+def timed_stage(stage: str):
+    """
+    Record the duration of a pipeline stage. CUDA work is asynchronous, so the GPU is synchronized
+    before reading the clock, otherwise the time would be charged to whichever stage syncs next.
+    """
+    start = time.perf_counter()
+    yield
+    if torch.cuda.is_available():
+        torch.cuda.synchronize()
+    observe_stage(time.perf_counter() - start, stage)
+
+
+class TilePipeline:
+    def __init__(
+        self,
+        package: Dict[str, Any],
+        conditioning_cache: Optional[ConditioningCache] = None,
+        latent_cache: Optional[LatentCache] = None,
+    ):
+        """
+        :param package: The loaded ComfyUI nodes and models (see lifespan in main.py).
+        :param conditioning_cache: Cache in front of CLIPTextEncode, a default sized one is created when None.
+        :param latent_cache: Sampled latents of generated tiles, which inpaint latents are assembled from
+            instead of VAE encoding the source pixels. A default sized one is created when None.
+        """
+        self.package = package
+        self.conditioning_cache = conditioning_cache or ConditioningCache()
+        self.latent_cache = latent_cache or LatentCache()
+        self._blank_latents: Dict[Tuple[int, int], torch.Tensor] = {}
+        self._empty_latents: Dict[int, Dict[str, torch.Tensor]] = {}
+        from image_gen import NODE_CLASS_MAPPINGS
+
+        self.vaedecode = NODE_CLASS_MAPPINGS["VAEDecode"]()
+        self.postprocessor = ImagePostprocessor()
+
+    @property
+    def model(self):
+        from image_gen import get_value_at_index
+
+        return get_value_at_index(self.package["lora_loader"], 0)
+
+    @property
+    def clip(self):
+        from image_gen import get_value_at_index
+
+        return get_value_at_index(self.package["lora_loader"], 1)
+
+    @property
+    def vae(self):
+        from image_gen import get_value_at_index
+
+        return get_value_at_index(self.package["checkpoint"], 2)
+
+    def encode_text(self, text: str) -> List[Any]:
+        from image_gen import get_value_at_index
+
+        clip = self.clip
+        clip_encode = self.package["clip_encode"]
+
+        def encode():
+            with timed_stage("clip_encode"):
+                return get_value_at_index(clip_encode.encode(text=text, clip=clip), 0)
+
+        return self.conditioning_cache.get_or_encode(text, clip, encode)
+
+    @property
+    def downscale_ratio(self) -> int:
+        return getattr(self.vae, "downscale_ratio", 8)
+
+    def blank_latent(self, height: int, width: int) -> torch.Tensor:
+        """
+        (1, C, h, w) latent of a uniformly gray image, what VAEEncodeForInpaint puts under the mask.
+        Encoded once per size.
+        """
+        latent = self._blank_latents.get((height, width))
+        if latent is None:
+            with timed_stage("vae_encode"):
+                latent = self.vae.encode(torch.full((1, height, width, 3), 0.5))
+            self._blank_latents[(height, width)] = latent
+        return latent
+
+    def latent_from_neighbours(
+        self, request: TileRequest, pixels: torch.Tensor, mask: torch.Tensor
+    ) -> Optional[Dict[str, torch.Tensor]]:
+        """
+        The inpaint latent of a request assembled from the cached latents of its orthogonal neighbours,
+        instead of VAE encoding its pixels. pixels and mask are at sampling resolution (see sampling_inputs),
+        so only neighbours sampled at the same scale match.
+
+        Tiles overlap by half a tile, a whole number of latent pixels, so each neighbour's latent is copied
+        into the half it shares with the target the way fill_in_pixels copies pixels, wherever the source
+        shows that neighbour. Where two neighbours overlap (the corner of a diagonal extension) the source
+        decides which one it is, by the closest fingerprint. The rest is the latent of a gray image. The noise mask is at latent
+        resolution, 1 where any pixel of a latent pixel is masked.
+
+        :return: None when the known part of pixels is not made of cached neighbours (tiles this
+            server did not sample, regenerated since, or edited by the client), the caller encodes it then.
+        """
+        ratio = self.downscale_ratio
+        _, height, width, _ = pixels.shape
+        if height % ratio or width % ratio:
+            return None
+        noise_mask = torch.nn.functional.max_pool2d(mask.reshape(1, 1, height, width), ratio)
+        known = noise_mask[0, 0] == 0
+        if not known.any():
+            return None
+
+        # Everything (h, w, C), the layout fill_in_pixels works on
+        fingerprint = torch.nn.functional.avg_pool2d(pixels.movedim(-1, 1), ratio)[0]
+        fingerprint = fingerprint.permute(1, 2, 0)
+        samples = self.blank_latent(height, width).clone()
+        target = samples[0].permute(1, 2, 0)
+        # Distance of the source to the neighbour each latent pixel was taken from, inf where none matches
+        closest = torch.full(known.shape, math.inf)
+        x, y = request.tile
+        for offset in ORTHOGONAL_OFFSETS:
+            entry = self.latent_cache.get(request.world, x - offset[0], y - offset[1])
+            if entry is None or entry.latent.shape != samples.shape[1:]:
+                continue
+            latent = torch.zeros_like(target)
+            fill_in_pixels(latent, entry.latent.permute(1, 2, 0), offset)
+            expected = torch.full_like(fingerprint, -1.0)
+            fill_in_pixels(expected, entry.fingerprint.permute(1, 2, 0).float(), offset)
+            distance = (fingerprint - expected).abs().amax(dim=-1)
+            shown = (distance <= LATENT_FINGERPRINT_TOLERANCE) & (distance < closest)
+            target[shown] = latent[shown]
+            closest[shown] = distance[shown]
+        if not closest[known].isfinite().all():
+            return None
+        return {"samples": samples, "noise_mask": noise_mask}
+
+    def latent_of_tile(self, request: TileRequest, pixels: torch.Tensor) -> Dict[str, torch.Tensor]:
+        """
+        Latent of the tile a refinement starts from: the cached one if it still shows pixels (at sampling
+        resolution), otherwise VAE encoded.
+        """
+        entry = self.latent_cache.get(request.world, *request.tile)
+        if entry is not None:
+            fingerprint = torch.nn.functional.avg_pool2d(
+                pixels.movedim(-1, 1), self.downscale_ratio
+            )[0]
+            if (
+                entry.fingerprint.shape == fingerprint.shape
+                and (fingerprint - entry.fingerprint.float()).abs().max()
+                <= LATENT_FINGERPRINT_TOLERANCE
+            ):
+                LATENT_CACHE_TOTAL.inc(result="hit")
+                return {"samples": entry.latent.unsqueeze(0)}
+        LATENT_CACHE_TOTAL.inc(result="miss")
+        with timed_stage("vae_encode"):
+            return {"samples": self.vae.encode(pixels)}
+
+    def empty_latent(self, scale: int) -> Dict[str, torch.Tensor]:
+        from image_gen import get_value_at_index
+
+        full = get_value_at_index(self.package["empty_latent_image"], 0)
+        if scale == 1:
+            return full
+        latent = self._empty_latents.get(scale)
+        if latent is None:
+            batch, channels, height, width = full["samples"].shape
+            if height % scale or width % scale:
+                raise ValueError(f"A {width}x{height} latent cannot be sampled at 1/{scale}")
+            # EmptyLatentImage is all zeros too
+            latent = {"samples": torch.zeros((batch, channels, height // scale, width // scale))}
+            self._empty_latents[scale] = latent
+        return latent
+
+    @staticmethod
+    def sampling_inputs(
+        request: TileRequest,
+    ) -> Tuple[Optional[torch.Tensor], Optional[torch.Tensor]]:
+        """
+        request.pixels and request.mask at sampling resolution: pixels averaged over scale x scale blocks, which
+        gives back exactly the pixels of tiles upscaled by the same factor, and masked wherever any pixel of a
+        block is, so everything that has to be generated still is.
+        """
+        scale = request.scale
+        if scale == 1 or request.pixels is None:
+            return request.pixels, request.mask
+        _, height, width, _ = request.pixels.shape
+        if height % scale or width % scale:
+            raise ValueError(f"A {width}x{height} tile cannot be sampled at 1/{scale}")
+        pixels = torch.nn.functional.avg_pool2d(request.pixels.movedim(-1, 1), scale).movedim(1, -1)
+        mask = request.mask
+        if mask is not None:
+            mask = torch.nn.functional.max_pool2d(mask.reshape(-1, 1, height, width), scale)[:, 0]
+        return pixels, mask
+
+    def prepare_latent(self, request: TileRequest) -> Dict[str, torch.Tensor]:
+        if request.kind == "gen":
+            return self.empty_latent(request.scale)
+        pixels, mask = self.sampling_inputs(request)
+        if request.kind == "refine":
+            return self.latent_of_tile(request, pixels)
+
+        latent = self.latent_from_neighbours(request, pixels, mask)
+        LATENT_CACHE_TOTAL.inc(result="miss" if latent is None else "hit")
+        if latent is not None:
+            return latent
+        with timed_stage("vae_encode"):
+            vaeencodeforinpaint_213 = self.package["vae_encode_for_inpaint"].encode(
+                grow_mask_by=3,
+                pixels=pixels,
+                vae=self.vae,
+                mask=mask,
+            )
+        from image_gen import get_value_at_index
+
+        return get_value_at_index(vaeencodeforinpaint_213, 0)
+
+    def sample(
+        self, requests: List[TileRequest], latents: List[Dict[str, torch.Tensor]]
+    ) -> torch.Tensor:
+        """
+        One sampler call for the whole batch, with per-sample conditioning and per-sample seeds.
+        All requests must share the same batch_key.
+        """
+        import comfy.sample
+
+        first = requests[0]
+        model = self.model
+
+        latent_image = torch.cat([latent["samples"] for latent in latents])
+        fix_channels = getattr(comfy.sample, "fix_empty_latent_channels", None)
+        if fix_channels is not None:
+            latent_image = fix_channels(model, latent_image)
+
+        # Per-sample noise so a tile looks the same whether or not it was batched
+        noise = torch.cat(
+            [
+                comfy.sample.prepare_noise(latent_image[i : i + 1], request.seed)
+                for i, request in enumerate(requests)
+            ]
+        )
+
+        noise_mask = None
+        if "noise_mask" in latents[0]:
+            # Encoded latents carry a pixel resolution mask, assembled ones a latent resolution one. Brought to
+            # latent resolution the way the sampler would do it anyway, so both can share a batch.
+            noise_mask = torch.cat(
+                [
+                    torch.nn.functional.interpolate(
+                        latent["noise_mask"].reshape(-1, 1, *latent["noise_mask"].shape[-2:]),
+                        size=latent_image.shape[-2:],
+                        mode="bilinear",
+                    )
+                    for latent in latents
+                ]
+            )
+
+        positive, negative = [], []
+        for request in requests:
+            with stage_tiles([request.stage_labels]):
+                positive.append(self.encode_text(request.pos_prompt))
+                negative.append(self.encode_text(request.neg_prompt))
+        positive, negative = batch_conditioning(positive), batch_conditioning(negative)
+
+        def on_step(step, x0, x, total_steps):
+            # Step boundary: give the sampler up as soon as nobody wants the batch
+            check_cancelled(requests)
+            self.publish_previews(requests, step, x0, total_steps)
+
+        BATCH_SIZE.observe(len(requests))
+        with timed_stage("sample"):
+            return comfy.sample.sample(
+                model,
+                noise,
+                first.steps,
+                first.cfg,
+                first.sampler_name,
+                first.scheduler,
+                positive,
+                negative,
+                latent_image,
+                denoise=first.denoise,
+                noise_mask=noise_mask,
+                callback=on_step,
+                disable_pbar=True,
+                seed=first.seed,
+            )
+
+    def publish_previews(
+        self, requests: List[TileRequest], step: int, x0: torch.Tensor, total_steps: int
+    ):
+        """
+        Approximate RGB of the current denoised estimate, for the requests that stream previews at this step.
+        """
+        indices = [
+            i
+            for i, request in enumerate(requests)
+            if request.preview is not None
+            and not request.cancelled
+            and request.preview.wants(step)
+        ]
+        if not indices:
+            return
+        latent_format = getattr(self.model.model, "latent_format", None)
+        with timed_stage("preview_decode"):
+            pixels = latent_to_rgb(
+                x0[indices],
+                getattr(latent_format, "latent_rgb_factors", None) or SDXL_LATENT_RGB_FACTORS,
+                getattr(latent_format, "latent_rgb_factors_bias", SDXL_LATENT_RGB_BIAS),
+            )
+        for i, preview in zip(indices, pixels):
+            requests[i].preview.publish(step, total_steps, preview)
+
+    def decode(self, samples: torch.Tensor) -> torch.Tensor:
+        from image_gen import get_value_at_index
+
+        with timed_stage("vae_decode"):
+            vaedecode_9 = self.vaedecode.decode(samples={"samples": samples}, vae=self.vae)
+            return get_value_at_index(vaedecode_9, 0)
+
+    def remember_latents(
+        self, requests: List[TileRequest], samples: torch.Tensor, images: torch.Tensor
+    ):
+        """
+        Cache the sampled latent of every tile still wanted, with the fingerprint of its decoded pixels.
+        """
+        with timed_stage("cache_latents"):
+            fingerprints = torch.nn.functional.avg_pool2d(
+                images.movedim(-1, 1), self.downscale_ratio
+            )
+            for request, latent, fingerprint in zip(requests, samples, fingerprints):
+                if not request.cancelled:
+                    self.latent_cache.put(request.world, *request.tile, latent, fingerprint)
+
+    @staticmethod
+    def upscale(images: torch.Tensor, scale: int) -> torch.Tensor:
+        """
+        (B, h, w, 3) images sampled at 1/scale to tile resolution, repeating every pixel scale x scale times.
+        Pixel exact: no colour that was not sampled appears, so pixel art keeps its palette and hard edges.
+        """
+        if scale == 1:
+            return images
+        with timed_stage("upscale"):
+            return images.repeat_interleave(scale, dim=1).repeat_interleave(scale, dim=2)
+
+    def run_batch(self, requests: List[TileRequest]) -> List[Image.Image]:
+        with torch.inference_mode(), stage_tiles([r.stage_labels for r in requests]):
+            check_cancelled(requests)
+            latents = []
+            for request in requests:
+                with stage_tiles([request.stage_labels]):
+                    latents.append(self.prepare_latent(request))
+            samples = self.sample(requests, latents)
+            check_cancelled(requests)
+            images = self.decode(samples)
+            # Before to_pil, which scales images in place, and at sampling resolution like the latents
+            self.remember_latents(requests, samples, images)
+            images = self.upscale(images, requests[0].scale)
+            with timed_stage("to_pil"):
+                return self.postprocessor.to_pil(images)
+
+
+def load_models(
+    ckpt_name: str,
+    lora_name: str,
+    fuse_lora: bool = True,
+    fused_model_dir: str = "fused_models",
+    share_weights: bool = False,
+) -> Dict[str, Any]:
+    """
+    The ComfyUI nodes and models TilePipeline reads from its package. import_custom_nodes must have run.
+
+    :param fuse_lora: Load the checkpoint with the LoRA fused in (see fused_checkpoint.py) instead of patching it at load.
+    :param share_weights: Keep the fused diffusion model weights in the memory map, so processes loading the
+        same artifact share one copy of them (see SamplerPool). Only applies with fuse_lora.
+    """
+    from image_gen import NODE_CLASS_MAPPINGS, get_value_at_index
+
+    start = time.perf_counter()
+    with torch.inference_mode():
+        if fuse_lora:
+            model, clip, vae = load_fused_models(
+                ckpt_name,
+                lora_name,
+                strength_model=1,
+                strength_clip=1,
+                cache_dir=fused_model_dir,
+                share_weights=share_weights,
+            )
+            # Same shapes as the node outputs the pipeline reads them from
+            checkpointloadersimple_1 = (model, clip, vae)
+            loraloader_6 = (model, clip)
+        else:
+            checkpointloadersimple = NODE_CLASS_MAPPINGS["CheckpointLoaderSimple"]()
+            checkpointloadersimple_1 = checkpointloadersimple.load_checkpoint(
+                ckpt_name=ckpt_name
+            )
+            loraloader = NODE_CLASS_MAPPINGS["LoraLoader"]()
+            loraloader_6 = loraloader.load_lora(
+                lora_name=lora_name,
+                strength_model=1,
+                strength_clip=1,
+                model=get_value_at_index(checkpointloadersimple_1, 0),
+                clip=get_value_at_index(checkpointloadersimple_1, 1),
+            )
+        print(
+            f"Loaded models in {time.perf_counter() - start:.1f}s, "
+            f"peak RSS {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB"
+        )
+
+        emptylatentimage = NODE_CLASS_MAPPINGS["EmptyLatentImage"]()
+        emptylatentimage_2 = emptylatentimage.generate(width=768, height=768, batch_size=1)
+
+    return {
+        "checkpoint": checkpointloadersimple_1,
+        "clip_encode": NODE_CLASS_MAPPINGS["CLIPTextEncode"](),
+        "empty_latent_image": emptylatentimage_2,
+        "lora_loader": loraloader_6,
+        "ksampler": NODE_CLASS_MAPPINGS["KSampler (Efficient)"](),
+        "vae_encode_for_inpaint": NODE_CLASS_MAPPINGS["VAEEncodeForInpaint"](),
+    }
+
+
+def build_worker_pipeline(
+    ckpt_name: str,
+    lora_name: str,
+    fused_model_dir: str = "fused_models",
+    conditioning_cache_bytes: int = 256 * 1024 * 1024,
+    latent_cache_dir: str = "latents",
+    latent_cache_bytes: int = 256 * 1024 * 1024,
+    latent_cache_disk_bytes: int = 4 * 1024 * 1024 * 1024,
+    warm_prompts: Optional[List[str]] = None,
+) -> TilePipeline:
+    """
+    SamplerPool factory: a TilePipeline in a sampler process, on the shared memory-mapped weights.
+    Latent caches share latent_cache_dir, so a worker finds the latents of tiles another one sampled.
+    """
+    from image_gen import import_custom_nodes
+
+    import_custom_nodes()
+    package = load_models(
+        ckpt_name, lora_name, fuse_lora=True, fused_model_dir=fused_model_dir, share_weights=True
+    )
+    pipeline = TilePipeline(
+        package,
+        conditioning_cache=ConditioningCache(max_bytes=conditioning_cache_bytes),
+        latent_cache=LatentCache(
+            latent_cache_dir, max_bytes=latent_cache_bytes, max_disk_bytes=latent_cache_disk_bytes
+        ),
+    )
+    with torch.inference_mode():
+        for prompt in warm_prompts or []:
+            pipeline.encode_text(prompt)
+    return pipeline
@@ -0,0 +1,91 @@
+import threading
+from typing import List, Optional, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+class ImagePostprocessor:
+    def __init__(self, pin_memory: Optional[bool] = None):
+        """
+        Turns decoded VAE output into PIL images with as few host copies as possible.
+
+        Scaling, clamping and the uint8 conversion happen in place on the tensor's device, so on a GPU only
+        a quarter of the float32 bytes cross to the host. There the alpha channel is filled in on the device
+        too, since RGBA is a layout PIL can wrap without copying and RGB is not. The device scratch tensor
+        and the (pinned) staging buffer are allocated once per batch shape and reused. Each batch then gets
+        its own uint8 array, because the images outlive it (they are encoded on another thread and kept
+        for /jobs).
+
+        :param pin_memory: Stage GPU results in page-locked memory. Defaults to torch.cuda.is_available().
+        """
+        self.pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        self._device_buffer: Optional[torch.Tensor] = None
+        self._staging: Optional[torch.Tensor] = None
+        # Runs on the sampling worker only, the lock just keeps it safe if that ever changes
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _fits(buffer: Optional[torch.Tensor], shape: Tuple[int, ...], device) -> bool:
+        return (
+            buffer is not None
+            and buffer.device == device
+            and buffer.shape[1:] == shape[1:]
+            and buffer.shape[0] >= shape[0]
+        )
+
+    def to_uint8(self, images: torch.Tensor) -> np.ndarray:
+        """
+        (B, H, W, 3) float images in [0, 1] to uint8, overwriting images.
+
+        :return: (B, H, W, 3) RGB for CPU tensors, (B, H, W, 4) RGBA with opaque alpha for GPU tensors.
+        """
+        batch, height, width, _ = images.shape
+        if images.device.type == "cpu":
+            # Single pass numpy ufuncs in place: faster than torch's strided kernels here,
+            # and a strided cast into an RGBA layout costs more than the copy PIL makes of RGB
+            pixels = images.numpy()
+            np.multiply(pixels, 255.0, out=pixels)
+            np.clip(pixels, 0.0, 255.0, out=pixels)
+            output = np.empty((batch, height, width, 3), dtype=np.uint8)
+            # Same rounding as the former astype(np.uint8): truncation
+            np.copyto(output, pixels, casting="unsafe")
+            return output
+
+        shape = (batch, height, width, 4)
+        output = np.empty(shape, dtype=np.uint8)
+        with self._lock:
+            images.mul_(255.0).clamp_(0.0, 255.0)
+            if not self._fits(self._device_buffer, shape, images.device):
+                self._device_buffer = torch.empty(
+                    shape, dtype=torch.uint8, device=images.device
+                )
+            device_buffer = self._device_buffer[:batch]
+            device_buffer[..., :3].copy_(images)
+            device_buffer[..., 3] = 255
+            if not self.pin_memory:
+                torch.from_numpy(output).copy_(device_buffer)
+                return output
+
+            if not self._fits(self._staging, shape, torch.device("cpu")):
+                self._staging = torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+            staging = self._staging[:batch]
+            staging.copy_(device_buffer, non_blocking=True)
+            torch.cuda.current_stream(images.device).synchronize()
+            output[...] = staging.numpy()
+            return output
+
+    @staticmethod
+    def wrap(pixels: np.ndarray) -> Image.Image:
+        """
+        PIL image of an (H, W, 3|4) uint8 array. RGBA is wrapped without copying (the array must not be
+        modified afterwards), PIL has no zero-copy layout for RGB and makes one copy.
+        """
+        if pixels.shape[2] == 3:
+            return Image.fromarray(pixels, "RGB")
+        height, width = pixels.shape[:2]
+        return Image.frombuffer("RGBA", (width, height), pixels, "raw", "RGBA", 0, 1)
+
+    def to_pil(self, images: torch.Tensor) -> List[Image.Image]:
+        return [self.wrap(pixels) for pixels in self.to_uint8(images)]
@@ -0,0 +1,213 @@
+import asyncio
+import math
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+from scheduler import Job, JobScheduler, PRIORITY_PREFETCH
+from tile_store import TileKey, TileStore
+
+
+class Prefetcher:
+    def __init__(
+        self,
+        scheduler: JobScheduler,
+        tile_store: TileStore,
+        submit: Callable[[str, int, int], Awaitable[Optional[Job]]],
+        ring_radius: int = 1,
+        max_inflight: int = 2,
+        max_per_request: int = 4,
+        enabled: bool = True,
+    ):
+        """
+        Speculatively generates the tiles around the last requested one while the sampler is idle.
+
+        Candidates are ranked by how well they line up with the player's recent movement. Prefetch jobs run
+        at PRIORITY_PREFETCH, are only issued when no real request is waiting, and queued ones that fall out of
+        the candidate ring are cancelled. Results land in the tile store like any other tile.
+
+        :param submit: Coroutine queuing a server-side inpaint job for (world, x, y) at prefetch priority,
+            returning None when the tile cannot be built from stored neighbours yet.
+        :param ring_radius: Chebyshev radius around the last requested tile to prefetch.
+        :param max_inflight: Upper bound on prefetch jobs queued or sampling at once.
+        :param max_per_request: Upper bound on prefetch jobs issued per observed request.
+        """
+        self.scheduler = scheduler
+        self.tile_store = tile_store
+        self.submit = submit
+        self.ring_radius = ring_radius
+        self.max_inflight = max_inflight
+        self.max_per_request = max_per_request
+        self.enabled = enabled
+
+        self._inflight: Dict[TileKey, Job] = {}
+        # prefetched tiles nobody asked for yet, oldest first
+        self._unclaimed: "OrderedDict[TileKey, None]" = OrderedDict()
+        self._claimed = set()
+        self._position: Dict[str, Tuple[int, int]] = {}
+        self._heading: Dict[str, Tuple[float, float]] = {}
+        self._fill_task: Optional[asyncio.Task] = None
+        self._last_request: Optional[TileKey] = None
+
+        self.issued = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.hits = 0
+        self.joined = 0
+
+    def observe(self, world: str, x: int, y: int, player: Tuple[int, int] = None):
+        """
+        Called for every real tile request. Updates the movement estimate and tops up the prefetch queue.
+
+        :param player: Tile the player stands on, used for the heading. Defaults to (x, y).
+        """
+        if not self.enabled:
+            return
+        self._update_heading(world, player or (x, y))
+        self._last_request = (world, x, y)
+        candidates = self.rank_candidates(world, x, y)
+
+        # Drop queued speculation the player moved away from
+        wanted = {(world, cx, cy) for cx, cy in candidates}
+        for key, job in list(self._inflight.items()):
+            if key not in wanted and self.scheduler.cancel(job):
+                self._inflight.pop(key, None)
+                self.cancelled += 1
+
+        self._schedule_fill(world, candidates)
+
+    def rank_candidates(self, world: str, x: int, y: int) -> List[Tuple[int, int]]:
+        hx, hy = self._heading.get(world, (0.0, 0.0))
+        candidates = []
+        for dx in range(-self.ring_radius, self.ring_radius + 1):
+            for dy in range(-self.ring_radius, self.ring_radius + 1):
+                if dx == 0 and dy == 0:
+                    continue
+                alignment = (dx * hx + dy * hy) / math.hypot(dx, dy)
+                distance = max(abs(dx), abs(dy))
+                candidates.append((distance - 2 * alignment, (x + dx, y + dy)))
+        candidates.sort()
+        return [tile for _, tile in candidates]
+
+    def claim(self, world: str, x: int, y: int, priority: int) -> Optional[Job]:
+        """
+        A real request for a tile that is being prefetched: promote the prefetch job and let the caller await it.
+        """
+        key = (world, x, y)
+        job = self._inflight.get(key)
+        if job is None or job.future.cancelled():
+            return None
+        if job.future.done() and job.future.exception() is not None:
+            return None
+        # No longer speculative: never cancel it, and do not count it as an unclaimed prefetch
+        del self._inflight[key]
+        self._claimed.add(key)
+        self.scheduler.reprioritize(job, priority)
+        self.joined += 1
+        return job
+
+    def record_hit(self, world: str, x: int, y: int):
+        """
+        Called when a tile is served from the store, counts it if it was prefetched.
+        """
+        key = (world, x, y)
+        if key in self._unclaimed:
+            del self._unclaimed[key]
+            self.hits += 1
+
+    def cancel_all(self):
+        for key, job in list(self._inflight.items()):
+            if self.scheduler.cancel(job):
+                self.cancelled += 1
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, float]:
+        return {
+            "issued": self.issued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "joined": self.joined,
+            "hit_rate": (self.hits + self.joined) / max(1, self.completed + self.joined),
+        }
+
+    def _update_heading(self, world: str, position: Tuple[int, int]):
+        previous = self._position.get(world)
+        self._position[world] = position
+        if previous is None or previous == position:
+            return
+        dx, dy = position[0] - previous[0], position[1] - previous[1]
+        norm = math.hypot(dx, dy)
+        hx, hy = self._heading.get(world, (0.0, 0.0))
+        self._heading[world] = (0.5 * hx + 0.5 * dx / norm, 0.5 * hy + 0.5 * dy / norm)
+
+    def _schedule_fill(self, world: str, candidates: List[Tuple[int, int]]):
+        if self._fill_task is None or self._fill_task.done():
+            self._fill_task = asyncio.get_running_loop().create_task(
+                self._fill(world, candidates)
+            )
+
+    def _has_capacity(self) -> bool:
+        # Only speculate when no real request is waiting for the sampler
+        return (
+            len(self._inflight) < self.max_inflight
+            and self.scheduler.queue_depth(below_priority=PRIORITY_PREFETCH) == 0
+        )
+
+    async def _fill(self, world: str, candidates: List[Tuple[int, int]]):
+        issued = 0
+        for x, y in candidates:
+            if issued >= self.max_per_request or not self._has_capacity():
+                return
+            key = (world, x, y)
+            if key in self._inflight:
+                continue
+            if await asyncio.to_thread(self.tile_store.get_record, world, x, y):
+                continue
+            job = await self.submit(world, x, y)
+            if job is None:
+                continue
+            self._inflight[key] = job
+            self.issued += 1
+            issued += 1
+            loop = asyncio.get_running_loop()
+            job.future.add_done_callback(
+                lambda future, key=key: loop.call_soon_threadsafe(
+                    self._on_done, key, future
+                )
+            )
+
+    def _on_done(self, key: TileKey, future):
+        # The tile only counts as stored once its PNG is written (see TileResult), until then
+        # it stays in flight so _fill does not queue it again
+        if not future.cancelled() and future.exception() is None:
+            png = getattr(future.result(), "png", None)
+            if png is not None and not png.done():
+                loop = asyncio.get_running_loop()
+                png.add_done_callback(
+                    lambda _, key=key: loop.call_soon_threadsafe(self._on_done, key, future)
+                )
+                return
+        self._inflight.pop(key, None)
+        claimed = key in self._claimed
+        self._claimed.discard(key)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.failed += 1
+            return
+        png = getattr(future.result(), "png", None)
+        if png is not None and png.exception() is not None:
+            self.failed += 1
+            return
+        self.completed += 1
+        if not claimed:
+            self._unclaimed[key] = None
+        while len(self._unclaimed) > 4096:
+            self._unclaimed.popitem(last=False)
+        # A slot freed up, keep speculating around the latest request
+        if self.enabled and self._last_request is not None:
+            world, x, y = self._last_request
+            self._schedule_fill(world, self.rank_candidates(world, x, y))
@@ -0,0 +1,87 @@
+import asyncio
+import threading
+from io import BytesIO
+from typing import Optional, Sequence, Tuple
+
+import numpy as np
+import torch
+from PIL import Image
+
+from metrics import time_stage
+
+# Linear map from the 4 SDXL latent channels to RGB (ComfyUI's latent_formats.SDXL),
+# used when the model does not carry its own
+SDXL_LATENT_RGB_FACTORS = (
+    (0.3651, 0.4232, 0.4341),
+    (-0.2533, -0.0042, 0.1068),
+    (0.1076, 0.1111, -0.0362),
+    (-0.3165, -0.2492, -0.2188),
+)
+SDXL_LATENT_RGB_BIAS = (0.1084, -0.0175, -0.0011)
+
+
+def latent_to_rgb(
+    latents: torch.Tensor,
+    factors: Sequence[Sequence[float]] = SDXL_LATENT_RGB_FACTORS,
+    bias: Optional[Sequence[float]] = SDXL_LATENT_RGB_BIAS,
+) -> np.ndarray:
+    """
+    Cheap stand-in for VAEDecode: one matrix product per latent pixel, so a 768x768 tile previews at 96x96.
+
+    :param latents: (B, C, h, w) denoised latents, as the sampler callback gets them.
+    :return: (B, h, w, 3) uint8 RGB.
+    """
+    factors = torch.tensor(factors, dtype=latents.dtype, device=latents.device)
+    rgb = torch.einsum("bchw,cr->bhwr", latents, factors)
+    if bias is not None:
+        rgb += torch.tensor(bias, dtype=latents.dtype, device=latents.device)
+    rgb = ((rgb + 1.0) / 2.0).clamp_(0.0, 1.0).mul_(255.0)
+    return rgb.to(torch.uint8).cpu().numpy()
+
+
+def encode_preview(pixels: np.ndarray) -> bytes:
+    with time_stage("encode_preview"):
+        buffer = BytesIO()
+        Image.fromarray(pixels, "RGB").save(buffer, format="PNG", compress_level=1)
+        return buffer.getvalue()
+
+
+class PreviewStream:
+    def __init__(self, every: int = 4):
+        """
+        Previews of one tile, handed from the sampling thread to the request streaming them.
+
+        Only the latest preview is kept: a slow client skips intermediate ones instead of delaying anything.
+        Must be created on the event loop.
+
+        :param every: Publish a preview every this many sampler steps.
+        """
+        self.every = every
+        self._loop = asyncio.get_running_loop()
+        self._updated = asyncio.Event()
+        self._lock = threading.Lock()
+        self._latest: Optional[Tuple[int, int, np.ndarray]] = None
+
+    def wants(self, step: int) -> bool:
+        return step % self.every == 0
+
+    def publish(self, step: int, total_steps: int, pixels: np.ndarray):
+        """
+        Called from the sampling thread with (h, w, 3) uint8 pixels.
+        """
+        with self._lock:
+            self._latest = (step, total_steps, pixels)
+        self._loop.call_soon_threadsafe(self._updated.set)
+
+    async def next(self) -> Tuple[int, int, np.ndarray]:
+        """
+        Wait for a preview newer than the last one returned: (step, total steps, pixels).
+        """
+        while True:
+            await self._updated.wait()
+            self._updated.clear()
+            with self._lock:
+                latest, self._latest = self._latest, None
+            # None when a wake-up arrives for a preview an earlier call already took
+            if latest is not None:
+                return latest
@@ -0,0 +1,103 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, List, Optional
+
+
+def normalize_text(text: str) -> str:
+    return " ".join(text.split())
+
+
+def make_cache_key(messages: List[Dict[str, str]], **params: Any) -> str:
+    """
+    Hash of the whitespace-normalized messages and the sampling parameters.
+    """
+    normalized = [
+        {"role": message["role"], "content": normalize_text(message["content"])}
+        for message in messages
+    ]
+    payload = json.dumps(
+        {"messages": normalized, "params": params}, sort_keys=True, ensure_ascii=False
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class PromptCache:
+    def __init__(self, path: str = "llm_cache.sqlite3", max_entries: int = 10000):
+        """
+        Disk-backed LLM response cache, evicting the least recently used entries beyond max_entries.
+
+        :param path: SQLite database file, ":memory:" keeps the cache in RAM only.
+        :param max_entries: Upper bound on the number of cached responses.
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY,"
+                " response TEXT NOT NULL,"
+                " created_at REAL NOT NULL,"
+                " last_used REAL NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+            )
+        self._count = self._conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def get(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with self._conn:
+                self._conn.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+            self.hits += 1
+            return row[0]
+
+    def put(self, key: str, response: str):
+        now = time.time()
+        with self._lock, self._conn:
+            inserted = self._conn.execute(
+                "INSERT OR IGNORE INTO responses (key, response, created_at, last_used)"
+                " VALUES (?, ?, ?, ?)",
+                (key, response, now, now),
+            ).rowcount
+            if not inserted:
+                self._conn.execute(
+                    "UPDATE responses SET response = ?, last_used = ? WHERE key = ?",
+                    (response, now, key),
+                )
+                return
+            self._count += 1
+            if self._count > self.max_entries:
+                overflow = self._count - self.max_entries
+                self._conn.execute(
+                    "DELETE FROM responses WHERE key IN"
+                    " (SELECT key FROM responses ORDER BY last_used ASC LIMIT ?)",
+                    (overflow,),
+                )
+                self._count -= overflow
+
+    def __len__(self) -> int:
+        return self._count
+
+    def stats(self) -> Dict[str, int]:
+        return {"entries": self._count, "hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,54 @@
+from typing import Callable, Sequence
+
+# Samplers that evaluate the model twice per step (ComfyUI sampler names)
+TWO_CALL_SAMPLERS = {"heun", "dpm_2", "dpm_2_ancestral", "dpmpp_2s_ancestral", "dpmpp_sde"}
+
+# Sampler steps of the tier everything else is measured against
+REFERENCE_STEPS = 20
+
+
+class QualityTier:
+    def __init__(
+        self, name: str, steps: int, sampler_name: str, scheduler: str, scale: int = 1
+    ):
+        """
+        Sampler settings of one point on the quality/latency trade-off.
+
+        :param name: Name clients ask for it by, e.g. "draft".
+        :param steps: Sampler steps.
+        :param sampler_name: ComfyUI sampler, e.g. "dpmpp_2m".
+        :param scheduler: ComfyUI noise schedule, e.g. "karras".
+        :param scale: Sample at 1/scale of the tile resolution and upscale by repeating pixels (see TileRequest).
+        """
+        self.name = name
+        self.steps = steps
+        self.sampler_name = sampler_name
+        self.scheduler = scheduler
+        self.scale = scale
+
+    @property
+    def cost(self) -> float:
+        """
+        Sampling time relative to a full resolution tile sampled in REFERENCE_STEPS single-call steps, the job
+        cost the scheduler expects. The UNet's work grows at least with the latent area.
+        """
+        calls = 2 if self.sampler_name in TWO_CALL_SAMPLERS else 1
+        return self.steps * calls / REFERENCE_STEPS / self.scale**2
+
+
+def select_tier(
+    tiers: Sequence[QualityTier],
+    deadline: float,
+    estimate: Callable[[QualityTier], float],
+) -> QualityTier:
+    """
+    The best tier expected to be done within the deadline, the cheapest one when none is.
+
+    :param tiers: Candidates, best first.
+    :param deadline: Seconds the client is willing to wait.
+    :param estimate: Expected seconds until a tile of the given tier is done (see JobScheduler.estimate_completion).
+    """
+    for tier in tiers:
+        if estimate(tier) <= deadline:
+            return tier
+    return min(tiers, key=lambda tier: tier.cost)
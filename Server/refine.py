@@ -0,0 +1,130 @@
+import asyncio
+import threading
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Sequence
+
+from scheduler import Job, JobScheduler
+from tile_store import TileKey
+
+
+class Refiner:
+    def __init__(
+        self,
+        scheduler: JobScheduler,
+        submit: Callable[[str, int, int], Awaitable[Optional[Job]]],
+        refine_from: Sequence[str] = ("draft",),
+        max_inflight: int = 1,
+        max_pending: int = 4096,
+        interval: float = 1.0,
+        enabled: bool = True,
+    ):
+        """
+        Upgrades tiles sampled at a cheap quality tier once the sampler has nothing else to do.
+
+        Every stored tile is reported through observe. Those of a tier in refine_from are remembered (in memory
+        only), every interval seconds the most recent ones are submitted while the queue is empty, newest first
+        since they are closest to the player. A tile sampled again at another tier, refined or regenerated, is
+        forgotten.
+
+        :param submit: Coroutine queuing the refinement job of (world, x, y) at PRIORITY_REFINE, returning None
+            when the tile cannot be refined (e.g. it is no longer stored).
+        :param refine_from: Quality tiers to refine.
+        :param max_inflight: Upper bound on refinement jobs queued or sampling at once.
+        :param max_pending: Upper bound on remembered tiles, the oldest are dropped.
+        :param interval: Seconds between checks for an idle sampler.
+        """
+        self.scheduler = scheduler
+        self.submit = submit
+        self.refine_from = set(refine_from)
+        self.max_inflight = max_inflight
+        self.max_pending = max_pending
+        self.interval = interval
+        self.enabled = enabled
+
+        # observe runs on the encoder threads
+        self._lock = threading.Lock()
+        self._pending: "OrderedDict[TileKey, None]" = OrderedDict()
+        self._inflight: Dict[TileKey, Job] = {}
+        self._task: Optional[asyncio.Task] = None
+
+        self.issued = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+
+    def observe(self, world: str, x: int, y: int, quality: str):
+        """
+        Called for every stored tile, from any thread.
+        """
+        key = (world, x, y)
+        with self._lock:
+            if self.enabled and quality in self.refine_from:
+                self._pending[key] = None
+                self._pending.move_to_end(key)
+                while len(self._pending) > self.max_pending:
+                    self._pending.popitem(last=False)
+            else:
+                self._pending.pop(key, None)
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for key, job in list(self._inflight.items()):
+            if self.scheduler.cancel(job):
+                self.cancelled += 1
+            self._inflight.pop(key, None)
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            "pending": pending,
+            "inflight": len(self._inflight),
+            "issued": self.issued,
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+        }
+
+    def _idle(self) -> bool:
+        # Nothing queued at all, prefetching included
+        return len(self._inflight) < self.max_inflight and self.scheduler.queue_depth() == 0
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            await asyncio.sleep(self.interval)
+            while self._idle():
+                with self._lock:
+                    if not self._pending:
+                        break
+                    key, _ = self._pending.popitem(last=True)
+                try:
+                    job = await self.submit(*key)
+                except Exception as e:
+                    print(f"Could not refine tile {key}: {e}")
+                    self.failed += 1
+                    continue
+                if job is None:
+                    continue
+                self._inflight[key] = job
+                self.issued += 1
+                job.future.add_done_callback(
+                    lambda future, key=key: loop.call_soon_threadsafe(
+                        self._on_done, key, future
+                    )
+                )
+
+    def _on_done(self, key: TileKey, future):
+        self._inflight.pop(key, None)
+        if future.cancelled():
+            return
+        if future.exception() is not None:
+            self.failed += 1
+            return
+        self.completed += 1
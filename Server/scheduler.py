@@ -0,0 +1,532 @@
+import asyncio
+import heapq
+import itertools
+import math
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError
+from typing import Any, Awaitable, Callable, Dict, Hashable, List, Optional
+
+# Lower value = served first. The tile the player is about to walk into should
+# use PRIORITY_URGENT, background work PRIORITY_PREFETCH (speculation) or PRIORITY_REFINE
+# (upgrading draft tiles, after everything else).
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 10
+PRIORITY_PREFETCH = 100
+PRIORITY_REFINE = 110
+
+
+class QueueFull(Exception):
+    def __init__(self, message: str, position: int, eta: float, retry_after: float):
+        """
+        Raised instead of queueing a foreground job when the scheduler is at capacity.
+
+        :param position: Queue position the job would have had.
+        :param eta: Estimated seconds until it would have started sampling.
+        :param retry_after: Estimated seconds until a slot frees up.
+        """
+        super().__init__(message)
+        self.position = position
+        self.eta = eta
+        self.retry_after = retry_after
+
+
+class JobCancelled(Exception):
+    """
+    Raised by a batch handler that stopped early because every job of its batch was cancelled.
+    """
+
+
+class Job:
+    def __init__(
+        self,
+        fn: Optional[Callable[[], Any]] = None,
+        priority: int = PRIORITY_NORMAL,
+        kind: str = "gen",
+        payload: Any = None,
+        batch_key: Optional[Hashable] = None,
+        cost: float = 1.0,
+    ):
+        """
+        :param fn: Callable executed on the sampling worker thread. Its return value is the job result.
+        :param priority: Scheduling priority, lower values are served first.
+        :param kind: Free-form label of the job ("gen", "inpaint", ...).
+        :param payload: Input handed to the scheduler's batch handler when fn is None.
+        :param batch_key: Jobs sharing a batch key may be run together in one batch handler call.
+        :param cost: Sampling time relative to other jobs, e.g. 0.4 for a tile sampled in 8 steps instead of 20.
+        """
+        self.id = uuid.uuid4().hex
+        self.fn = fn
+        self.priority = priority
+        self.kind = kind
+        self.payload = payload
+        self.batch_key = batch_key
+        self.cost = cost
+        self.status = "queued"
+        self.seq = 0
+        self.submitted_at = time.monotonic()
+        # set when the job enters the queue, after its prepare stage if it has one
+        self.queued_at: Optional[float] = None
+        self.started_at: Optional[float] = None
+        self.prepare_task: Optional[asyncio.Task] = None
+        self.finished_at: Optional[float] = None
+        # jobs sampled in the same batch handler call, including this one
+        self.batch_size = 1
+        # set to stop a running job at the next point the batch handler checks it
+        self.cancel_event = threading.Event()
+        self.future: Future = Future()
+
+    def bind_payload(self, payload: Any):
+        """
+        Payloads with a cancel_event attribute share the job's, so the batch handler can see cancellations.
+        """
+        self.payload = payload
+        if hasattr(payload, "cancel_event"):
+            payload.cancel_event = self.cancel_event
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "job_id": self.id,
+            "kind": self.kind,
+            "priority": self.priority,
+            "status": self.status,
+        }
+
+    def timings(self) -> Dict[str, float]:
+        """
+        Seconds spent in each stage the job went through: prepare (e.g. the LLM prompt), queue and service.
+        """
+        timings = {}
+        if self.queued_at is not None:
+            timings["prepare"] = self.queued_at - self.submitted_at
+            if self.started_at is not None:
+                timings["queue"] = self.started_at - self.queued_at
+                if self.finished_at is not None:
+                    timings["service"] = self.finished_at - self.started_at
+        return timings
+
+
+class JobScheduler:
+    def __init__(
+        self,
+        batch_handler: Optional[Callable[[List[Any]], List[Any]]] = None,
+        batch_window: float = 0.05,
+        max_batch_size: int = 4,
+        max_finished_jobs: int = 256,
+        on_finish: Optional[Callable[[Job], None]] = None,
+        num_workers: int = 1,
+        max_active_jobs: Optional[int] = None,
+        max_queue_depth: Optional[int] = None,
+        initial_service_seconds: float = 5.0,
+        initial_prepare_seconds: float = 1.0,
+    ):
+        """
+        In-process priority queue drained by dedicated sampling threads (one per sampler, see num_workers).
+
+        Jobs submitted with a batch key are coalesced: once the worker picks one up it waits at most
+        batch_window seconds for more jobs with the same key and runs them all in one batch_handler call.
+
+        :param batch_handler: Called with the payloads of a batch, returns one result per payload.
+            A result that is an Exception instance fails only its own job.
+        :param batch_window: Seconds to wait for more jobs with the same batch key.
+        :param max_batch_size: Upper bound on payloads per batch_handler call.
+        :param max_finished_jobs: How many finished jobs are kept around so clients can still fetch their result.
+        :param on_finish: Called with every job that is done, failed or cancelled, e.g. to record metrics.
+        :param num_workers: Threads draining the queue. Only useful when the batch handler can run
+            concurrently, e.g. when it dispatches to a SamplerPool of worker processes.
+        :param max_active_jobs: Foreground jobs (more urgent than PRIORITY_PREFETCH) allowed in the system at
+            once, preparing, queued or sampling. Further submissions raise QueueFull. None for no limit.
+        :param max_queue_depth: Foreground jobs allowed to wait for the sampler, preparing or queued, same behaviour.
+        :param initial_service_seconds: Sampling time per unit of job cost assumed for wait estimates until one
+            has been measured.
+        :param initial_prepare_seconds: Duration of the prepare stage of deferred jobs assumed until one has been measured.
+        """
+        self.batch_handler = batch_handler
+        self.batch_window = batch_window
+        self.max_batch_size = max_batch_size
+        self.max_finished_jobs = max_finished_jobs
+        self.on_finish = on_finish
+        self.num_workers = num_workers
+        self.max_active_jobs = max_active_jobs
+        self.max_queue_depth = max_queue_depth
+        # Moving averages of the sampler time per unit of job cost and of the prepare stage, for wait estimates
+        self.service_seconds = initial_service_seconds
+        self.prepare_seconds = initial_prepare_seconds
+        self._heap = []
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._jobs: Dict[str, Job] = {}
+        self._finished: "OrderedDict[str, None]" = OrderedDict()
+        self._threads: List[threading.Thread] = []
+        self._running = False
+
+    def start(self):
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._threads = [
+            threading.Thread(
+                target=self._worker_loop, name=f"sampling-worker-{i}", daemon=True
+            )
+            for i in range(self.num_workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout: float = None):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+        # Nobody will drain the queue anymore, release anyone awaiting it
+        with self._cond:
+            for job in self._jobs.values():
+                if job.status == "preparing" and job.prepare_task is not None:
+                    job.prepare_task.cancel()
+                    job.status = "cancelled"
+                    job.future.cancel()
+            for _, _, job in self._heap:
+                job.status = "cancelled"
+                job.future.cancel()
+            self._heap.clear()
+
+    def submit(
+        self,
+        fn: Optional[Callable[[], Any]] = None,
+        priority: int = PRIORITY_NORMAL,
+        kind: str = "gen",
+        payload: Any = None,
+        batch_key: Optional[Hashable] = None,
+        cost: float = 1.0,
+    ) -> Job:
+        if fn is None and (batch_key is None or self.batch_handler is None):
+            raise ValueError("Batch jobs need a batch key and a scheduler with a batch_handler")
+        job = Job(fn, priority=priority, kind=kind, batch_key=batch_key, cost=cost)
+        job.bind_payload(payload)
+        with self._cond:
+            self._admit(priority)
+            self._jobs[job.id] = job
+        self._enqueue(job)
+        return job
+
+    def submit_deferred(
+        self,
+        prepare: Awaitable[Any],
+        priority: int = PRIORITY_NORMAL,
+        kind: str = "gen",
+        cost: float = 1.0,
+    ) -> Job:
+        """
+        Register a batch job whose payload is still being produced, e.g. by the LLM prompt stage.
+
+        The job gets an id right away and enters the sampling queue as soon as prepare resolves,
+        so the prompt of the next tile is generated while the current one is sampling.
+        Must be called from the event loop. The payload has to expose a batch_key attribute.
+
+        :raises QueueFull: If the scheduler is at capacity (foreground priorities only).
+        """
+        if self.batch_handler is None:
+            raise ValueError("Deferred jobs need a scheduler with a batch_handler")
+        job = Job(priority=priority, kind=kind, cost=cost)
+        job.status = "preparing"
+        with self._cond:
+            try:
+                self._admit(priority)
+            except QueueFull:
+                # Never awaited: close it so it does not warn
+                if hasattr(prepare, "close"):
+                    prepare.close()
+                raise
+            self._jobs[job.id] = job
+
+        async def prepare_and_enqueue():
+            try:
+                job.bind_payload(await prepare)
+            except asyncio.CancelledError:
+                return
+            except BaseException as e:
+                self._finish(job, error=e)
+                return
+            if job.status == "cancelled":
+                return
+            self._observe_prepare(time.monotonic() - job.submitted_at)
+            job.batch_key = job.payload.batch_key
+            job.status = "queued"
+            self._enqueue(job)
+
+        job.prepare_task = asyncio.get_running_loop().create_task(prepare_and_enqueue())
+        return job
+
+    def cancel(self, job: Job, abort_running: bool = False) -> bool:
+        """
+        Drop a job that has not started sampling yet. Returns False if it is already running or finished.
+
+        :param abort_running: Also stop a running job. Its batch handler call is abandoned at the next step
+            boundary once every job of the batch is cancelled (see JobCancelled), otherwise the job
+            finishes with its batch and is then reported as cancelled.
+        """
+        with self._cond:
+            if job.status == "preparing" and job.prepare_task is not None:
+                job.prepare_task.cancel()
+            elif job.status == "queued":
+                self._heap = [entry for entry in self._heap if entry[2] is not job]
+                heapq.heapify(self._heap)
+            elif job.status == "running" and abort_running:
+                job.cancel_event.set()
+                return True
+            else:
+                return False
+            job.status = "cancelled"
+            job.future.cancel()
+        self._retire(job)
+        return True
+
+    def reprioritize(self, job: Job, priority: int):
+        """
+        Change the priority of a job that has not started sampling yet, e.g. when a prefetched tile is requested for real.
+        """
+        with self._cond:
+            if job.status == "queued":
+                self._heap = [entry for entry in self._heap if entry[2] is not job]
+                job.priority = priority
+                self._heap.append((job.priority, job.seq, job))
+                heapq.heapify(self._heap)
+                self._cond.notify()
+            elif job.status == "preparing":
+                job.priority = priority
+
+    def admit(self, priority: int = PRIORITY_NORMAL):
+        """
+        Check that a job of this priority would be accepted right now, e.g. before doing work to build it.
+
+        :raises QueueFull: If it would not.
+        """
+        with self._cond:
+            self._admit(priority)
+
+    def _admit(self, priority: int):
+        # Caller holds the lock. Background work is bounded by whoever submits it (see Prefetcher).
+        if priority >= PRIORITY_PREFETCH:
+            return
+        # Jobs still in their prepare stage join the queue shortly, they count as waiting already
+        queued = sum(1 for entry in self._heap if entry[0] < PRIORITY_PREFETCH) + sum(
+            1
+            for job in self._jobs.values()
+            if job.priority < PRIORITY_PREFETCH and job.status == "preparing"
+        )
+        if self.max_queue_depth is not None and queued >= self.max_queue_depth:
+            reason = f"{queued} jobs are waiting for the sampler"
+        elif self.max_active_jobs is not None:
+            active = sum(
+                1
+                for job in self._jobs.values()
+                if job.priority < PRIORITY_PREFETCH
+                and job.status in ("preparing", "queued", "running")
+            )
+            if active < self.max_active_jobs:
+                return
+            reason = f"{active} jobs are in progress"
+        else:
+            return
+        raise QueueFull(
+            f"Server busy: {reason}",
+            position=queued,
+            eta=self.estimate_wait(queued),
+            retry_after=self.service_seconds / self.num_workers,
+        )
+
+    def estimate_wait(self, position: int) -> float:
+        """
+        Seconds until the job at this 0-based queue position starts sampling, from the measured time per job.
+        """
+        return (position + 1) * self.service_seconds / self.num_workers
+
+    def estimate_completion(
+        self, priority: int = PRIORITY_NORMAL, cost: float = 1.0, deferred: bool = True
+    ) -> float:
+        """
+        Seconds until a job submitted now would be done, e.g. to pick how much sampling a deadline allows.
+
+        It waits for the jobs ahead of it: those preparing or queued at the same or a more urgent priority,
+        and half of what is sampling. A deferred job's prepare stage runs during that wait.
+        """
+        with self._cond:
+            ahead = 0.0
+            for job in self._jobs.values():
+                if job.status == "running":
+                    ahead += job.cost / 2
+                elif job.status in ("preparing", "queued") and job.priority <= priority:
+                    ahead += job.cost
+            wait = ahead * self.service_seconds / self.num_workers
+            prepare = self.prepare_seconds if deferred else 0.0
+            return max(prepare, wait) + cost * self.service_seconds
+
+    def _observe_service(self, jobs: List[Job], seconds: float):
+        cost = sum(job.cost for job in jobs) or 1.0
+        with self._cond:
+            self.service_seconds += 0.2 * (seconds / cost - self.service_seconds)
+
+    def _observe_prepare(self, seconds: float):
+        with self._cond:
+            self.prepare_seconds += 0.2 * (seconds - self.prepare_seconds)
+
+    def _enqueue(self, job: Job):
+        with self._cond:
+            job.seq = next(self._counter)
+            job.queued_at = time.monotonic()
+            heapq.heappush(self._heap, (job.priority, job.seq, job))
+            self._cond.notify()
+
+    def get(self, job_id: str) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    async def wait(self, job: Job) -> Any:
+        """
+        Await the result of a job without blocking the event loop or a threadpool thread.
+
+        Cancelling the awaiting task only stops this waiter: the job's future is shared with the
+        scheduler and any other waiter, use cancel to drop the job itself.
+        """
+        return await asyncio.shield(asyncio.wrap_future(job.future))
+
+    def queue_depth(self, below_priority: int = None) -> int:
+        """
+        Number of queued jobs, optionally only those more urgent than below_priority.
+        """
+        with self._cond:
+            if below_priority is None:
+                return len(self._heap)
+            return sum(1 for priority, _, _ in self._heap if priority < below_priority)
+
+    def queue_position(self, job: Job) -> int:
+        """
+        0-based position of a queued job, -1 if it is not in the queue (still preparing or already running).
+        """
+        with self._cond:
+            if job.status != "queued":
+                return -1
+            key = (job.priority, job.seq)
+            return sum(1 for priority, seq, _ in self._heap if (priority, seq) < key)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                while self._running and not self._heap:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                _, _, job = heapq.heappop(self._heap)
+                # Off the heap now, so cancel must not treat it as queued anymore
+                job.status = "running"
+            if job.fn is not None:
+                self._run_job(job)
+            else:
+                self._run_batch(self._collect_batch(job))
+
+    def _take_matching(self, first: Job, limit: int) -> List[Job]:
+        """
+        Remove up to limit queued jobs that can share a batch with first, best priority first. Caller holds the lock.
+
+        Background jobs (PRIORITY_PREFETCH and below) never ride along with foreground ones, so speculation
+        does not slow down a request somebody is waiting for.
+        """
+        background = first.priority >= PRIORITY_PREFETCH
+        matching = sorted(
+            entry
+            for entry in self._heap
+            if entry[2].batch_key == first.batch_key
+            and (entry[0] >= PRIORITY_PREFETCH) == background
+        )[:limit]
+        if matching:
+            taken = {id(entry[2]) for entry in matching}
+            self._heap = [entry for entry in self._heap if id(entry[2]) not in taken]
+            heapq.heapify(self._heap)
+            for entry in matching:
+                entry[2].status = "running"
+        return [entry[2] for entry in matching]
+
+    def _collect_batch(self, first: Job) -> List[Job]:
+        batch = [first]
+        deadline = time.monotonic() + self.batch_window
+        with self._cond:
+            while self._running and len(batch) < self.max_batch_size:
+                batch.extend(
+                    self._take_matching(first, self.max_batch_size - len(batch))
+                )
+                remaining = deadline - time.monotonic()
+                if len(batch) >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+        return batch
+
+    def _run_job(self, job: Job):
+        self._mark_started([job])
+        try:
+            result = job.fn()
+        except BaseException as e:
+            self._finish(job, error=e)
+        else:
+            self._observe_service([job], time.monotonic() - job.started_at)
+            self._finish(job, result=result)
+
+    def _run_batch(self, batch: List[Job]):
+        self._mark_started(batch)
+        try:
+            results = self.batch_handler([job.payload for job in batch])
+            if len(results) != len(batch):
+                raise RuntimeError(
+                    f"Batch handler returned {len(results)} results for {len(batch)} jobs"
+                )
+        except BaseException as e:
+            for job in batch:
+                self._finish(job, error=e)
+            return
+        self._observe_service(batch, time.monotonic() - batch[0].started_at)
+        for job, result in zip(batch, results):
+            if isinstance(result, BaseException):
+                self._finish(job, error=result)
+            else:
+                self._finish(job, result=result)
+
+    def _mark_started(self, jobs: List[Job]):
+        now = time.monotonic()
+        for job in jobs:
+            job.status = "running"
+            job.started_at = now
+            job.batch_size = len(jobs)
+
+    def _finish(self, job: Job, result: Any = None, error: BaseException = None):
+        job.finished_at = time.monotonic()
+        try:
+            if job.cancel_event.is_set() or job.future.cancelled():
+                # Nobody is waiting for it anymore, whether or not the handler got to stop early
+                job.status = "cancelled"
+                job.future.cancel()
+            elif error is not None:
+                job.status = "failed"
+                print(f"Job {job.id} ({job.kind}) failed: {error}")
+                job.future.set_exception(error)
+            else:
+                job.status = "done"
+                job.future.set_result(result)
+        except InvalidStateError:
+            # Cancelled from another thread in the meantime, the sampling worker must survive it
+            job.status = "cancelled"
+        self._retire(job)
+
+    def _retire(self, job: Job):
+        if self.on_finish is not None:
+            try:
+                self.on_finish(job)
+            except Exception as e:
+                print(f"on_finish failed for job {job.id}: {e}")
+        with self._cond:
+            self._finished[job.id] = None
+            while len(self._finished) > self.max_finished_jobs:
+                old_id, _ = self._finished.popitem(last=False)
+                self._jobs.pop(old_id, None)
@@ -0,0 +1,85 @@
+import asyncio
+import json
+
+import httpx
+
+from GPTHelper import AsyncGPTAPIHelper
+from prompt_cache import PromptCache
+
+
+def make_helper(handler, **kwargs) -> AsyncGPTAPIHelper:
+    """
+    AsyncGPTAPIHelper answering from handler(messages) -> str instead of the API, recording every request.
+    """
+    helper = AsyncGPTAPIHelper(api_key="test", api_base="http://llm.test/v1", **kwargs)
+    helper.requests = []
+
+    async def respond(request: httpx.Request) -> httpx.Response:
+        messages = json.loads(request.content)["messages"]
+        helper.requests.append(messages)
+        content = await handler(messages)
+        return httpx.Response(200, json={"choices": [{"message": {"content": content}}]})
+
+    helper._client = httpx.AsyncClient(
+        base_url=helper.api_base, transport=httpx.MockTransport(respond)
+    )
+    return helper
+
+
+async def answer_last_turn(messages):
+    user_message = messages[-1]["content"]
+    # Later tiles answer first, so completion order differs from call order
+    await asyncio.sleep(0.05 * (4 - int(user_message.split()[-1])))
+    return "answer to " + user_message
+
+
+def test_concurrent_calls_do_not_see_each_others_unanswered_turns():
+    helper = make_helper(answer_last_turn)
+
+    async def run():
+        await helper.achat("tile 0")
+        answers = await asyncio.gather(*(helper.achat(f"tile {i}") for i in (1, 2, 3)))
+        await helper.aclose()
+        return answers
+
+    answers = asyncio.run(run())
+
+    assert answers == ["answer to tile 1", "answer to tile 2", "answer to tile 3"]
+    for i, messages in zip((1, 2, 3), helper.requests[1:]):
+        assert [(m["role"], m["content"]) for m in messages[1:]] == [
+            ("user", "tile 0"),
+            ("assistant", "answer to tile 0"),
+            ("user", f"tile {i}"),
+        ]
+    # Every question is directly followed by its own answer, in completion order
+    history = [(m["role"], m["content"]) for m in helper.history.messages()]
+    assert history[:2] == [("user", "tile 0"), ("assistant", "answer to tile 0")]
+    pairs = list(zip(history[2::2], history[3::2]))
+    assert len(pairs) == 3
+    for (user_role, question), (assistant_role, answer) in pairs:
+        assert (user_role, assistant_role) == ("user", "assistant")
+        assert answer == "answer to " + question
+    assert [question for (_, question), _ in pairs] == ["tile 3", "tile 2", "tile 1"]
+
+
+def test_repeated_prompt_hits_the_cache_after_unrelated_turns():
+    async def answer(messages):
+        return "answer to " + messages[-1]["content"]
+
+    helper = make_helper(answer, cache=PromptCache(":memory:"), reuse_cached=True)
+
+    async def run():
+        first = await helper.achat("extend the forest  towards the north")
+        for i in range(5):
+            await helper.achat(f"unrelated tile {i}")
+        again = await helper.achat("extend the forest towards the north")
+        other_params = await helper.achat("extend the forest towards the north", temperature=0.1)
+        await helper.aclose()
+        return first, again, other_params
+
+    first, again, _ = asyncio.run(run())
+
+    assert again == first
+    # The repeat was answered from the cache; other sampling parameters are another request
+    assert len(helper.requests) == 1 + 5 + 1
+    assert helper.cache.stats()["hits"] == 1
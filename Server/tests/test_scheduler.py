@@ -0,0 +1,27 @@
+import asyncio
+
+import pytest
+
+from scheduler import JobScheduler, QueueFull
+
+
+def test_preparing_jobs_count_toward_the_queue_depth():
+    async def run():
+        scheduler = JobScheduler(batch_handler=lambda payloads: [], max_queue_depth=2)
+        prompt_ready = asyncio.Event()
+
+        async def prepare():
+            # The LLM prompt stage, still running
+            await prompt_ready.wait()
+
+        jobs = [scheduler.submit_deferred(prepare()) for _ in range(2)]
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            scheduler.submit_deferred(prepare())
+
+        scheduler.cancel(jobs[0])
+        scheduler.admit()
+        scheduler.stop()
+        await asyncio.gather(*(job.prepare_task for job in jobs))
+
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+from types import SimpleNamespace
+
+from PIL import Image
+
+import main
+from pipeline import TileRequest
+from prefetch import Prefetcher
+from refine import Refiner
+from scheduler import JobScheduler
+from tile_jobs import TileJobs
+from tile_store import TileStore
+from world_canvas import CanvasStore
+from worker_pool import SamplerPool
+
+
+class BlankPipeline:
+    def __init__(self, size: int):
+        self.size = size
+
+    def run_batch(self, requests):
+        return [Image.new("RGB", (self.size, self.size)) for _ in requests]
+
+
+def build_blank_pipeline(size: int) -> BlankPipeline:
+    """
+    SamplerPool factory, imported by the workers from this module.
+    """
+    return BlankPipeline(size)
+
+
+async def submit_nothing(*args):
+    return None
+
+
+def test_stats_report_sampler_workers(tmp_path, monkeypatch):
+    pool = SamplerPool("test_stats:build_blank_pipeline", num_workers=1, factory_kwargs={"size": 8})
+    pool.start()
+    try:
+        pool.run_batch([TileRequest("gen", "a forest", "", world="stats")])
+
+        scheduler = JobScheduler(batch_handler=lambda requests: [])
+        tile_store = TileStore(str(tmp_path / "tiles"))
+        monkeypatch.setattr(
+            main.app,
+            "package",
+            {
+                "pipeline": pool,
+                "gpt_helper": SimpleNamespace(cache=None),
+                "tile_store": tile_store,
+                "canvas": CanvasStore(str(tmp_path / "canvas")),
+                "prefetcher": Prefetcher(scheduler, tile_store, submit_nothing),
+                "refiner": Refiner(scheduler, submit_nothing),
+                "scheduler": scheduler,
+                "tile_jobs": TileJobs(scheduler),
+            },
+            raising=False,
+        )
+
+        stats = main.get_stats()
+    finally:
+        pool.stop()
+
+    [worker] = stats["sampler_pool"]["workers"]
+    assert worker["alive"]
+    assert isinstance(worker["pid"], int)
+    assert (worker["batches"], worker["tiles"]) == (1, 1)
@@ -0,0 +1,77 @@
+import asyncio
+from typing import Dict, Optional, Tuple
+
+from previews import PreviewStream
+from scheduler import Job, JobScheduler
+
+# (world, x, y, kind)
+TileJobKey = Tuple[str, int, int, str]
+
+
+class TileJobs:
+    def __init__(self, scheduler: JobScheduler):
+        """
+        Foreground tile jobs in flight, so identical requests arriving together share one job instead of
+        sampling the tile twice.
+
+        Every client waiting for a job holds it: a client going away only releases the job (see release_job in
+        main) once no other client waits for it. Must be used from the event loop.
+        """
+        self.scheduler = scheduler
+        self._jobs: Dict[TileJobKey, Job] = {}
+        # job id -> clients waiting for it
+        self._holders: Dict[str, int] = {}
+        self.joined = 0
+
+    def join(
+        self, key: TileJobKey, priority: int, preview: Optional[PreviewStream] = None
+    ) -> Optional[Job]:
+        """
+        The job in flight for key, held for one more client, or None if there is none.
+
+        :param preview: Stream of the joining client. It only gets the previews if the job's prompt stage
+            is done and nobody streams them yet.
+        """
+        job = self._jobs.get(key)
+        if job is None or job.future.done() or job.cancel_event.is_set():
+            return None
+        self._holders[job.id] = self._holders.get(job.id, 0) + 1
+        if priority < job.priority:
+            self.scheduler.reprioritize(job, priority)
+        if preview is not None and job.payload is not None and job.payload.preview is None:
+            job.payload.preview = preview
+        self.joined += 1
+        return job
+
+    def add(self, key: TileJobKey, job: Job):
+        """
+        Register a job just submitted (or claimed from the prefetcher) for key, held by its client.
+        """
+        self._jobs[key] = job
+        self._holders[job.id] = 1
+        loop = asyncio.get_running_loop()
+        # Finished on the sampling thread
+        job.future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._forget, key, job)
+        )
+
+    def leave(self, job: Job) -> bool:
+        """
+        A client stopped waiting for job. Returns whether nobody else waits for it, so it can be released.
+        """
+        holders = self._holders.get(job.id)
+        if holders is None:
+            return True
+        if holders > 1:
+            self._holders[job.id] = holders - 1
+            return False
+        del self._holders[job.id]
+        return True
+
+    def _forget(self, key: TileJobKey, job: Job):
+        if self._jobs.get(key) is job:
+            del self._jobs[key]
+        self._holders.pop(job.id, None)
+
+    def stats(self) -> Dict[str, int]:
+        return {"inflight": len(self._jobs), "joined": self.joined}
@@ -0,0 +1,208 @@
+import hashlib
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+TileKey = Tuple[str, int, int]
+
+
+class TileRecord:
+    def __init__(
+        self,
+        world: str,
+        x: int,
+        y: int,
+        digest: str,
+        prompt: str,
+        seed: Optional[int],
+        png: Optional[bytes] = None,
+    ):
+        self.world = world
+        self.x = x
+        self.y = y
+        self.digest = digest
+        self.prompt = prompt
+        self.seed = seed
+        self.png = png
+
+    @property
+    def key(self) -> TileKey:
+        return (self.world, self.x, self.y)
+
+
+class TileStore:
+    def __init__(self, root: str = "tiles", hot_cache_bytes: int = 64 * 1024 * 1024):
+        """
+        Persistent store of generated tiles keyed by (world, x, y).
+
+        PNGs are content addressed under root/blobs/<first two hex digits>/<sha256>.png and
+        written atomically (temp file + fsync + rename). An SQLite index maps each tile to its blob,
+        prompt and seed and is updated in the same call, so the store is consistent after a crash.
+        Recently used tiles are kept in an in-memory LRU bounded by hot_cache_bytes.
+
+        :param root: Directory holding the index and the blobs.
+        :param hot_cache_bytes: Upper bound on PNG bytes kept in memory.
+        """
+        self.root = root
+        self.blob_dir = os.path.join(root, "blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+        self.hot_cache_bytes = hot_cache_bytes
+        self._hot: "OrderedDict[TileKey, TileRecord]" = OrderedDict()
+        self._hot_bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(
+            os.path.join(root, "index.sqlite3"), check_same_thread=False
+        )
+        with self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=FULL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tiles ("
+                " world TEXT NOT NULL,"
+                " x INTEGER NOT NULL,"
+                " y INTEGER NOT NULL,"
+                " digest TEXT NOT NULL,"
+                " prompt TEXT NOT NULL,"
+                # seeds go up to 2**64 which does not fit SQLite's signed INTEGER
+                " seed TEXT,"
+                " created_at REAL NOT NULL,"
+                " PRIMARY KEY (world, x, y))"
+            )
+
+    def blob_path(self, digest: str) -> str:
+        return os.path.join(self.blob_dir, digest[:2], digest + ".png")
+
+    def get(self, world: str, x: int, y: int) -> Optional[TileRecord]:
+        """
+        The tile with its PNG bytes, or None if it was never generated.
+        """
+        key = (world, x, y)
+        with self._lock:
+            record = self._hot.get(key)
+            if record is not None:
+                self._hot.move_to_end(key)
+                self.hits += 1
+                return record
+
+        record = self.get_record(world, x, y)
+        if record is not None:
+            try:
+                with open(self.blob_path(record.digest), "rb") as f:
+                    record.png = f.read()
+            except FileNotFoundError:
+                record = None
+
+        with self._lock:
+            if record is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._remember(record)
+        return record
+
+    def get_record(self, world: str, x: int, y: int) -> Optional[TileRecord]:
+        """
+        Index entry of the tile (prompt, seed, digest) without reading its PNG.
+        """
+        with self._lock:
+            record = self._hot.get((world, x, y))
+            if record is not None:
+                return record
+            row = self._conn.execute(
+                "SELECT digest, prompt, seed FROM tiles WHERE world = ? AND x = ? AND y = ?",
+                (world, x, y),
+            ).fetchone()
+        if row is None:
+            return None
+        digest, prompt, seed = row
+        return TileRecord(
+            world, x, y, digest, prompt, int(seed) if seed is not None else None
+        )
+
+    def put(
+        self,
+        world: str,
+        x: int,
+        y: int,
+        png: bytes,
+        prompt: str,
+        seed: Optional[int] = None,
+    ) -> TileRecord:
+        digest = hashlib.sha256(png).hexdigest()
+        self._write_blob(digest, png)
+        record = TileRecord(world, x, y, digest, prompt, seed, png)
+        with self._lock:
+            with self._conn:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO tiles (world, x, y, digest, prompt, seed, created_at)"
+                    " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (
+                        world,
+                        x,
+                        y,
+                        digest,
+                        prompt,
+                        str(seed) if seed is not None else None,
+                        time.time(),
+                    ),
+                )
+            self._remember(record)
+        return record
+
+    def _write_blob(self, digest: str, png: bytes):
+        path = self.blob_path(digest)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        os.makedirs(directory, exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(png)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def _remember(self, record: TileRecord):
+        """
+        Put a record in the hot LRU. Caller holds the lock.
+        """
+        previous = self._hot.pop(record.key, None)
+        if previous is not None:
+            self._hot_bytes -= len(previous.png or b"")
+        size = len(record.png or b"")
+        if size > self.hot_cache_bytes:
+            return
+        self._hot[record.key] = record
+        self._hot_bytes += size
+        while self._hot_bytes > self.hot_cache_bytes:
+            _, evicted = self._hot.popitem(last=False)
+            self._hot_bytes -= len(evicted.png or b"")
+
+    def __len__(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM tiles").fetchone()[0]
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "hot_entries": len(self._hot),
+                "hot_bytes": self._hot_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+            }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
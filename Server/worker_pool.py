@@ -0,0 +1,262 @@
+import copy
+import importlib
+import multiprocessing
+import os
+import threading
+import zlib
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import torch
+from PIL import Image
+
+from scheduler import JobCancelled
+
+
+def load_factory(factory: str):
+    module_name, _, function_name = factory.partition(":")
+    return getattr(importlib.import_module(module_name), function_name)
+
+
+class RelayedPreview:
+    def __init__(self, index: int, every: int):
+        """
+        Worker-side stand-in for the PreviewStream of the request at index: sends its previews to the server.
+        """
+        self.index = index
+        self.every = every
+        self.conn = None
+
+    def wants(self, step: int) -> bool:
+        return step % self.every == 0
+
+    def publish(self, step: int, total_steps: int, pixels: np.ndarray):
+        self.conn.send(("preview", self.index, step, total_steps, pixels))
+
+
+def sampler_worker_main(
+    conn, factory: str, factory_kwargs: Dict[str, Any], num_threads: int, abort
+):
+    """
+    Entry point of a sampler process: build the pipeline, then run the batches sent over conn until None arrives.
+
+    :param abort: Event the server sets once every tile of the running batch is cancelled.
+    """
+    torch.set_num_threads(num_threads)
+    pipeline = load_factory(factory)(**factory_kwargs)
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            requests = conn.recv()
+        except EOFError:
+            break
+        if requests is None:
+            break
+        for request in requests:
+            request.cancel_event = abort
+            if request.preview is not None:
+                request.preview.conn = conn
+        try:
+            images = pipeline.run_batch(requests)
+            conn.send(("ok", [np.asarray(image) for image in images]))
+        except JobCancelled as e:
+            conn.send(("cancelled", str(e)))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+    conn.close()
+
+
+class SamplerWorker:
+    def __init__(self, index: int, process, conn, abort):
+        self.index = index
+        self.process = process
+        self.conn = conn
+        self.abort = abort
+        self.pid: Optional[int] = None
+        self.batches = 0
+        self.tiles = 0
+
+
+class SamplerPool:
+    def __init__(
+        self,
+        factory: str,
+        num_workers: int,
+        factory_kwargs: Optional[Dict[str, Any]] = None,
+        threads_per_worker: Optional[int] = None,
+        start_method: str = "spawn",
+        start_timeout: float = 1800,
+    ):
+        """
+        Stand-in for TilePipeline that samples in worker processes, for CPU-only hosts where one process
+        cannot keep every core busy. Each worker builds its own pipeline through factory; with the fused
+        checkpoint mapped rather than copied (see build_worker_pipeline) the weights are in memory once,
+        however many workers there are.
+
+        A batch goes to the worker its first tile hashes to, so repeat work on a tile (regenerations,
+        refinements) finds that worker's caches warm, and to any idle worker when that one is busy.
+        Run it under a JobScheduler with num_workers set to the pool size so every worker has a batch.
+        Stage timings are recorded in the workers and do not show up in the server's /metrics.
+
+        :param factory: "module:function" building the pipeline in the worker, imported there.
+        :param num_workers: Sampler processes to start.
+        :param factory_kwargs: Keyword arguments of factory, must be picklable.
+        :param threads_per_worker: torch intra-op threads per worker, the cores split evenly when None.
+        :param start_method: multiprocessing start method. spawn, since fork does not mix with threads and CUDA.
+        :param start_timeout: Seconds a worker may take to load its models.
+        """
+        self.factory = factory
+        self.num_workers = num_workers
+        self.factory_kwargs = factory_kwargs or {}
+        self.threads_per_worker = threads_per_worker or max(
+            1, (os.cpu_count() or 1) // num_workers
+        )
+        self.start_timeout = start_timeout
+        self.context = multiprocessing.get_context(start_method)
+        self.workers: List[SamplerWorker] = []
+        self.conditioning_cache = None
+        self.latent_cache = None
+        self._idle = set()
+        # Workers whose process died, never handed a batch again
+        self._dead = set()
+        self._condition = threading.Condition()
+
+    def start(self):
+        # One at a time: the first worker builds the fused artifact if it is missing, the others only map it
+        for index in range(self.num_workers):
+            parent_conn, child_conn = self.context.Pipe()
+            abort = self.context.Event()
+            process = self.context.Process(
+                target=sampler_worker_main,
+                args=(
+                    child_conn,
+                    self.factory,
+                    self.factory_kwargs,
+                    self.threads_per_worker,
+                    abort,
+                ),
+                name=f"sampler-{index}",
+                daemon=True,
+            )
+            process.start()
+            child_conn.close()
+            worker = SamplerWorker(index, process, parent_conn, abort)
+            self.workers.append(worker)
+            if not parent_conn.poll(self.start_timeout):
+                self.stop()
+                raise RuntimeError(f"Sampler worker {index} did not start in time")
+            try:
+                _, worker.pid = parent_conn.recv()
+            except EOFError:
+                process.join()
+                self.stop()
+                raise RuntimeError(
+                    f"Sampler worker {index} exited with code {process.exitcode} while starting"
+                )
+            self._idle.add(index)
+            print(f"Sampler worker {index} ready (pid {worker.pid})")
+
+    def route(self, requests) -> int:
+        first = requests[0]
+        key = f"{first.world}:{first.tile[0]},{first.tile[1]}".encode("utf-8")
+        return zlib.crc32(key) % self.num_workers
+
+    def _acquire(self, preferred: int) -> SamplerWorker:
+        with self._condition:
+            while not self._idle:
+                if len(self._dead) == len(self.workers):
+                    raise RuntimeError("Every sampler worker died")
+                self._condition.wait()
+            index = preferred if preferred in self._idle else min(self._idle)
+            self._idle.remove(index)
+            return self.workers[index]
+
+    def _release(self, worker: SamplerWorker):
+        with self._condition:
+            self._idle.add(worker.index)
+            self._condition.notify()
+
+    def _drop(self, worker: SamplerWorker):
+        with self._condition:
+            self._dead.add(worker.index)
+            # Batches waiting for a worker may have to fail now
+            self._condition.notify_all()
+        print(
+            f"Sampler worker {worker.index} (pid {worker.pid}) died with code "
+            f"{worker.process.exitcode}, {len(self.workers) - len(self._dead)} left"
+        )
+
+    def _send(self, worker: SamplerWorker, requests):
+        # Cancellation events and preview streams are per process, the worker gets stand-ins
+        stripped = []
+        for index, request in enumerate(requests):
+            request = copy.copy(request)
+            request.cancel_event = None
+            if request.preview is not None:
+                request.preview = RelayedPreview(index, request.preview.every)
+            stripped.append(request)
+        worker.abort.clear()
+        worker.conn.send(stripped)
+
+    def _receive(self, worker: SamplerWorker, requests):
+        while True:
+            while not worker.conn.poll(0.1):
+                if not worker.abort.is_set() and all(
+                    request.cancelled for request in requests
+                ):
+                    worker.abort.set()
+            message = worker.conn.recv()
+            if message[0] != "preview":
+                return message
+            _, index, step, total_steps, pixels = message
+            requests[index].preview.publish(step, total_steps, pixels)
+
+    def run_batch(self, requests) -> List[Image.Image]:
+        worker = self._acquire(self.route(requests))
+        try:
+            self._send(worker, requests)
+            status, payload = self._receive(worker, requests)
+        except (EOFError, OSError):
+            # The pipe broke: the process is gone, keep every later batch away from it
+            worker.process.join(1)
+            self._drop(worker)
+            raise RuntimeError(f"Sampler worker {worker.index} (pid {worker.pid}) died")
+        except BaseException:
+            self._release(worker)
+            raise
+        self._release(worker)
+        if status == "cancelled":
+            raise JobCancelled(payload)
+        if status != "ok":
+            raise RuntimeError(f"Sampler worker {worker.index}: {payload}")
+        worker.batches += 1
+        worker.tiles += len(requests)
+        return [Image.fromarray(pixels) for pixels in payload]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "workers": [
+                {
+                    "pid": worker.pid,
+                    "alive": worker.index not in self._dead,
+                    "batches": worker.batches,
+                    "tiles": worker.tiles,
+                }
+                for worker in self.workers
+            ]
+        }
+
+    def stop(self, timeout: float = 30):
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except (BrokenPipeError, OSError):
+                pass
+        for worker in self.workers:
+            worker.process.join(timeout)
+            if worker.process.is_alive():
+                worker.process.terminate()
+            worker.conn.close()
+        self.workers = []
+        self._idle.clear()
+        self._dead.clear()
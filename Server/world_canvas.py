@@ -0,0 +1,289 @@
+import os
+import struct
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+from typing import Dict, Iterator, Optional, Set, Tuple
+
+import numpy as np
+
+from inpaint_source import ORTHOGONAL_OFFSETS, extend_direction
+
+# Index records: (kind, a, b, slot). Chunks map (cx, cy) to a slot of the chunk file, tiles only mark (x, y) as generated.
+INDEX_RECORD = struct.Struct("<iiii")
+RECORD_CHUNK = 0
+RECORD_TILE = 1
+
+
+class WorldCanvas:
+    def __init__(self, directory: str, tile_size: int = 768, initial_chunks: int = 64):
+        """
+        The pixels of one world as a sparse grid of chunks in a memory-mapped file.
+
+        Tiles are placed half a tile apart, so chunks are half a tile wide and every tile covers exactly
+        2x2 of them: tile (x, y) spans chunk columns x, x+1 and chunk rows -y, -y+1 (rows grow downwards,
+        tile y upwards). Chunks are allocated on first write in directory/chunks.u8 and found through a
+        dict, rebuilt at open from the append-only directory/index.i32. Where tiles overlap, the chunk
+        holds the pixels of the tile generated last.
+
+        Chunk contents live in the page cache, not in the process heap, so memory stays flat however far
+        the world extends; only the index grows, by a few dozen bytes per chunk.
+
+        :param tile_size: Tile width and height in pixels, must be even.
+        :param initial_chunks: Chunk capacity of a new file. It doubles whenever it runs out.
+        """
+        self.directory = directory
+        self.tile_size = tile_size
+        self.chunk_size = tile_size // 2
+        os.makedirs(directory, exist_ok=True)
+        self._chunk_bytes = self.chunk_size * self.chunk_size * 3
+        self._data_path = os.path.join(directory, "chunks.u8")
+        self._index_path = os.path.join(directory, "index.i32")
+        self._lock = threading.Lock()
+        self._slots: Dict[Tuple[int, int], int] = {}
+        self._tiles: Set[Tuple[int, int]] = set()
+
+        if os.path.exists(self._index_path):
+            with open(self._index_path, "rb") as f:
+                data = f.read()
+            # A torn last record (crash mid-append) is ignored
+            usable = len(data) - len(data) % INDEX_RECORD.size
+            for kind, a, b, slot in INDEX_RECORD.iter_unpack(data[:usable]):
+                if kind == RECORD_CHUNK:
+                    self._slots[(a, b)] = slot
+                else:
+                    self._tiles.add((a, b))
+        self._index = open(self._index_path, "ab")
+
+        capacity = max(initial_chunks, len(self._slots))
+        if os.path.exists(self._data_path):
+            capacity = max(capacity, os.path.getsize(self._data_path) // self._chunk_bytes)
+        self._map(capacity)
+
+    def _map(self, capacity: int):
+        with open(self._data_path, "ab") as f:
+            if f.tell() < capacity * self._chunk_bytes:
+                f.truncate(capacity * self._chunk_bytes)
+        self.capacity = capacity
+        # Views handed out earlier keep the previous mapping alive, the file is the same
+        self._chunks = np.memmap(
+            self._data_path,
+            dtype=np.uint8,
+            mode="r+",
+            shape=(capacity, self.chunk_size, self.chunk_size, 3),
+        )
+
+    @staticmethod
+    def tile_chunks(x: int, y: int) -> Iterator[Tuple[Tuple[int, int], int, int]]:
+        """
+        The 2x2 chunks of tile (x, y): ((cx, cy), row offset, column offset) in units of chunks.
+        """
+        for row in range(2):
+            for column in range(2):
+                yield (x + column, -y + row), row, column
+
+    def chunk(self, cx: int, cy: int) -> Optional[np.ndarray]:
+        """
+        (C, C, 3) view of a chunk in the memory map, without copying. None if nothing was drawn there.
+        """
+        slot = self._slots.get((cx, cy))
+        return None if slot is None else self._chunks[slot]
+
+    def has_tile(self, x: int, y: int) -> bool:
+        return (x, y) in self._tiles
+
+    def write_tile(self, x: int, y: int, pixels: np.ndarray):
+        """
+        Draw a generated tile. Thread-safe.
+
+        :param pixels: (H, W, 3+) uint8 tile in image order, alpha is dropped.
+        """
+        size = self.chunk_size
+        with self._lock:
+            for key, row, column in self.tile_chunks(x, y):
+                slot = self._slots.get(key)
+                if slot is None:
+                    slot = len(self._slots)
+                    if slot >= self.capacity:
+                        self._chunks.flush()
+                        self._map(self.capacity * 2)
+                    self._slots[key] = slot
+                    self._index.write(INDEX_RECORD.pack(RECORD_CHUNK, key[0], key[1], slot))
+                self._chunks[slot] = pixels[
+                    row * size : (row + 1) * size, column * size : (column + 1) * size, :3
+                ]
+            if (x, y) not in self._tiles:
+                self._tiles.add((x, y))
+                self._index.write(INDEX_RECORD.pack(RECORD_TILE, x, y, -1))
+            self._index.flush()
+
+    def read_region(
+        self,
+        left: int,
+        top: int,
+        width: int,
+        height: int,
+        step: int = 1,
+        out: Optional[np.ndarray] = None,
+    ) -> np.ndarray:
+        """
+        RGB pixels of any region of the world, across chunk boundaries. Undrawn areas are black.
+
+        Each chunk overlapping the region is copied once, straight from the map into out, subsampled
+        by step (e.g. for a minimap).
+
+        :param left: World pixel column of the region, tile (x, y) starts at column x * C.
+        :param top: World pixel row of the region, tile (x, y) starts at row -y * C.
+        :param step: Keep every step-th pixel in both directions.
+        :param out: (ceil(height / step), ceil(width / step), 3) uint8 array to fill, allocated when None.
+        """
+        size = self.chunk_size
+        rows, columns = -(-height // step), -(-width // step)
+        if out is None:
+            out = np.zeros((rows, columns, 3), dtype=np.uint8)
+        else:
+            out[...] = 0
+        for cy in range(top // size, (top + height - 1) // size + 1):
+            for cx in range(left // size, (left + width - 1) // size + 1):
+                chunk = self.chunk(cx, cy)
+                if chunk is None:
+                    continue
+                # First region pixel (on the step grid) inside this chunk, in world coordinates
+                y0 = max(top, cy * size)
+                x0 = max(left, cx * size)
+                y0 += -(y0 - top) % step
+                x0 += -(x0 - left) % step
+                y1 = min(top + height, (cy + 1) * size)
+                x1 = min(left + width, (cx + 1) * size)
+                if y0 >= y1 or x0 >= x1:
+                    continue
+                source = chunk[
+                    y0 - cy * size : y1 - cy * size : step,
+                    x0 - cx * size : x1 - cx * size : step,
+                ]
+                out_y, out_x = (y0 - top) // step, (x0 - left) // step
+                out[out_y : out_y + source.shape[0], out_x : out_x + source.shape[1]] = source
+        return out
+
+    def inpaint_source(self, x: int, y: int) -> Optional[Tuple[np.ndarray, str]]:
+        """
+        Half-masked RGBA inpaint source of tile (x, y), like compose_inpaint_source but read from the canvas.
+
+        As in MapGenerator.cs only generated orthogonal neighbours contribute: each fills the two chunks
+        it shares with the target.
+
+        :return: ((H, W, 4) uint8, transparent where the tile has to be generated, extend direction),
+            or None when the generated neighbours do not describe an extension.
+        """
+        offsets = [
+            offset
+            for offset in ORTHOGONAL_OFFSETS
+            if self.has_tile(x - offset[0], y - offset[1])
+        ]
+        direction = extend_direction(offsets)
+        if direction is None:
+            return None
+        known = set()
+        for dx, dy in offsets:
+            neighbour_chunks = {key for key, _, _ in self.tile_chunks(x - dx, y - dy)}
+            known.update(key for key, _, _ in self.tile_chunks(x, y) if key in neighbour_chunks)
+
+        size = self.chunk_size
+        rgba = np.zeros((self.tile_size, self.tile_size, 4), dtype=np.uint8)
+        for key, row, column in self.tile_chunks(x, y):
+            chunk = self.chunk(*key) if key in known else None
+            if chunk is None:
+                continue
+            target = rgba[row * size : (row + 1) * size, column * size : (column + 1) * size]
+            target[..., :3] = chunk
+            target[..., 3] = 255
+        return rgba, direction
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "tiles": len(self._tiles),
+            "chunks": len(self._slots),
+            "capacity": self.capacity,
+            "file_bytes": self.capacity * self._chunk_bytes,
+        }
+
+    def close(self):
+        with self._lock:
+            self._chunks.flush()
+            self._index.close()
+
+
+class CanvasStore:
+    def __init__(self, root: str = "canvas", tile_size: int = 768, max_open: int = 8):
+        """
+        The WorldCanvas of every world under root/<world>, with at most max_open of them mapped at once.
+
+        Canvases are borrowed through use. One evicted while borrowed is only closed once the last
+        borrower is done, and handed out again if its world is asked for before that.
+        """
+        self.root = root
+        self.tile_size = tile_size
+        self.max_open = max_open
+        self._open: "OrderedDict[str, WorldCanvas]" = OrderedDict()
+        # Evicted but still borrowed, closed by the last borrower
+        self._closing: Dict[str, WorldCanvas] = {}
+        self._users: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def use(self, world: str) -> Iterator[WorldCanvas]:
+        """
+        The canvas of world, open until the block exits.
+        """
+        with self._lock:
+            canvas = self._open_canvas(world)
+            self._users[world] = self._users.get(world, 0) + 1
+        try:
+            yield canvas
+        finally:
+            with self._lock:
+                self._users[world] -= 1
+                if self._users[world] == 0:
+                    del self._users[world]
+                    evicted = self._closing.pop(world, None)
+                    if evicted is not None:
+                        evicted.close()
+
+    def _open_canvas(self, world: str) -> WorldCanvas:
+        """
+        Caller holds the lock.
+        """
+        canvas = self._open.get(world)
+        if canvas is not None:
+            self._open.move_to_end(world)
+            return canvas
+        # Never two canvases over the same files: an evicted one still in use is taken back
+        canvas = self._closing.pop(world, None)
+        if canvas is None:
+            # World ids are hex digests, but keep anything else from escaping root
+            name = "".join(c if c.isalnum() or c in "-_" else "_" for c in world)
+            canvas = WorldCanvas(os.path.join(self.root, name), tile_size=self.tile_size)
+        self._open[world] = canvas
+        while len(self._open) > self.max_open:
+            evicted_world, evicted = self._open.popitem(last=False)
+            if self._users.get(evicted_world):
+                self._closing[evicted_world] = evicted
+            else:
+                evicted.close()
+        return canvas
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            canvases = list(self._open.values())
+        return {
+            "open_worlds": len(canvases),
+            "tiles": sum(canvas.stats()["tiles"] for canvas in canvases),
+            "chunks": sum(canvas.stats()["chunks"] for canvas in canvases),
+        }
+
+    def close(self):
+        with self._lock:
+            for canvas in list(self._open.values()) + list(self._closing.values()):
+                canvas.close()
+            self._open.clear()
+            self._closing.clear()